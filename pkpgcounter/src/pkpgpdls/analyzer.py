@@ -27,30 +27,42 @@ input files, by automatically detecting the best parser to use."""
 import os
 import sys
 import tempfile
-from pkpgpdls import bj
-from pkpgpdls import cfax
-from pkpgpdls import dvi
-from pkpgpdls import escp2
-from pkpgpdls import escpages03
-from pkpgpdls import hbp
-from pkpgpdls import inkcoverage
-from pkpgpdls import lidil
-from pkpgpdls import mscrap
-from pkpgpdls import ooo
-from pkpgpdls import pcl345
-from pkpgpdls import pclxl
-from pkpgpdls import pdf
+import importlib
 from pkpgpdls import pdlparser
-from pkpgpdls import pil
-from pkpgpdls import oxps
-from pkpgpdls import plain
-from pkpgpdls import pnmascii
-from pkpgpdls import postscript
-from pkpgpdls import qpdl
-from pkpgpdls import spl1
-from pkpgpdls import tiff
 from pkpgpdls import version
-from pkpgpdls import zjstream
+
+# The parsers' modules, in the order they are tried. Each module is
+# only imported when all the parsers before it have failed to
+# recognize the input file, so that the most common formats are
+# detected without importing all the parsers.
+# IMPORTANT: the order is important below. FIXME.
+PARSERS = ("postscript",
+           "pclxl",
+           "pdf",
+           "qpdl",
+           "spl1",
+           "dvi",
+           "tiff",
+           "cfax",
+           "zjstream",
+           "ooo",
+           "hbp",
+           "lidil",
+           "pcl345",
+           "escp2",
+           "escpages03",
+           "bj",
+           "pnmascii",
+           "pil",
+           "mscrap",
+           "oxps",
+           "plain",     # IMPORTANT: don't move this one up !
+           )
+
+
+def load_parser(name):
+    """Returns a parser's module, importing it if needed."""
+    return importlib.import_module(f"pkpgpdls.{name}")
 
 
 class AnalyzerOptions:
@@ -107,6 +119,7 @@ class PDLAnalyzer:
                 filename = dummyfile.name
                 try:
                     pdlhandler.convert_to_tiff_multi_page_24nc(filename, self.options.resolution)
+                    from pkpgpdls import inkcoverage  # imports PIL
                     result = inkcoverage.get_ink_coverage(filename, cspace)
                 finally:
                     dummyfile.close()
@@ -169,32 +182,11 @@ class PDLAnalyzer:
             raise pdlparser.PDLParserError(f"input file {str(self.filename)} is empty !")
         (firstblock, lastblock) = self.read_first_last_blocks(self.workfile)
 
-        # IMPORTANT: the order is important below. FIXME.
-        for module in (postscript,
-                       pclxl,
-                       pdf,
-                       qpdl,
-                       spl1,
-                       dvi,
-                       tiff,
-                       cfax,
-                       zjstream,
-                       ooo,
-                       hbp,
-                       lidil,
-                       pcl345,
-                       escp2,
-                       escpages03,
-                       bj,
-                       pnmascii,
-                       pil,
-                       mscrap,
-                       oxps,
-                       plain):     # IMPORTANT: don't move this one up !
+        for name in PARSERS:
             try:
-                return module.Parser(self, self.filename, firstblock, lastblock)
+                return load_parser(name).Parser(self, self.filename, firstblock, lastblock)
             except pdlparser.PDLParserError:
-                pass  # try next parser
+                pass  # try next parser, this one may also need a missing module
         raise pdlparser.PDLParserError("Analysis of first data block failed.")
 
 
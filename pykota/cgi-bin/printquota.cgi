@@ -94,6 +94,7 @@ footer = """
 
 class PyKotaReportGUI(PyKotaTool):
     """PyKota Administrative GUI"""
+    readonlystorage = True
 
     def guiDisplay(self):
         """Displays the administrative interface."""
@@ -94,6 +94,7 @@ footer = """
 
 class PyKotMeGUI(PyKotaTool):
     """PyKota Quote's Generator GUI"""
+    readonlystorage = True
 
     def guiDisplay(self):
         """Displays the administrative interface."""
@@ -132,7 +132,75 @@ CREATE INDEX jobhistory_u_id_ix ON jobhistory (userid);
 CREATE INDEX jobhistory_p_id_ix ON jobhistory (printerid);
 CREATE INDEX jobhistory_pd_id_ix ON jobhistory (printerid, jobdate);
 CREATE INDEX jobhistory_hostname_ix ON jobhistory (hostname);
+
+--
+-- Create the archive of old jobs, see pkarchive
+--
+CREATE TABLE jobhistoryarchive(id INT4 PRIMARY KEY NOT NULL,
+                               jobid TEXT,
+                               userid INT4,
+                               printerid INT4,
+                               pagecounter INT4 DEFAULT 0,
+                               jobsizebytes INT8,
+                               jobsize INT4,
+                               jobprice FLOAT,
+                               action TEXT,
+                               filename TEXT,
+                               title TEXT,
+                               copies INT4,
+                               options TEXT,
+                               hostname VARCHAR(255),
+                               md5sum TEXT,
+                               pages TEXT,
+                               billingcode TEXT,
+                               precomputedjobsize INT4,
+                               precomputedjobprice FLOAT,
+                               jobdate TIMESTAMP,
+                               INDEX (userid),
+                               INDEX (printerid, jobdate),
+                               INDEX (jobdate)) TYPE=INNODB;
+
+--
+-- Create the table which points to each printer's last job
+--
+CREATE TABLE printerlastjob(printerid INT4 PRIMARY KEY NOT NULL,
+                            jobhistoryid INT4 NOT NULL,
+                            FOREIGN KEY (printerid) REFERENCES printers(id)) TYPE=INNODB;
                         
+--
+-- Create the table which holds the daily usage rollups
+--
+CREATE TABLE jobrollup(day DATE NOT NULL,
+                       userid INT4 NOT NULL,
+                       printerid INT4 NOT NULL,
+                       action VARCHAR(32) NOT NULL DEFAULT '',
+                       billingcode VARCHAR(255) NOT NULL DEFAULT '',
+                       hostname VARCHAR(255) NOT NULL DEFAULT '',
+                       nbjobs INT4 DEFAULT 0,
+                       nbprintedjobs INT4 DEFAULT 0,
+                       jobsize INT8 DEFAULT 0,
+                       jobsizebytes INT8 DEFAULT 0,
+                       jobprice FLOAT DEFAULT 0.0,
+                       printedjobprice FLOAT DEFAULT 0.0,
+                       precomputedjobsize INT8 DEFAULT 0,
+                       precomputedjobprice FLOAT DEFAULT 0.0,
+                       PRIMARY KEY (day, userid, printerid, action, billingcode, hostname),
+                       FOREIGN KEY (userid) REFERENCES users(id),
+                       FOREIGN KEY (printerid) REFERENCES printers(id)) TYPE=INNODB;
+CREATE INDEX jobrollup_u_id_ix ON jobrollup (userid, day);
+CREATE INDEX jobrollup_p_id_ix ON jobrollup (printerid, day);
+
+--
+-- Create the table which holds the time spent in each phase of the jobs
+--
+CREATE TABLE jobtimings(printerid INT4 NOT NULL,
+                        jobid TEXT,
+                        phase VARCHAR(32) NOT NULL,
+                        duration FLOAT NOT NULL,
+                        jobdate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (printerid) REFERENCES printers(id)) TYPE=INNODB;
+CREATE INDEX jobtimings_pd_id_ix ON jobtimings (printerid, jobdate);
+
 --
 -- Create the print quota table for groups
 --
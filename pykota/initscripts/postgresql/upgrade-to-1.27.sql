@@ -0,0 +1,249 @@
+--
+-- PyKota - Print Quotas for CUPS and LPRng
+--
+-- (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+-- This program is free software; you can redistribute it and/or modify
+-- it under the terms of the GNU General Public License as published by
+-- the Free Software Foundation; either version 2 of the License, or
+-- (at your option) any later version.
+--
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+-- 
+-- You should have received a copy of the GNU General Public License
+-- along with this program; if not, write to the Free Software
+-- Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+--
+-- $Id$
+--
+--
+--
+-- This script has to be used if you already
+-- have a pre-1.27 version of PyKota to upgrade
+-- your database schema.
+--
+-- YOU DON'T NEED TO USE IT IF YOU'VE JUST INSTALLED PYKOTA
+--
+
+--
+-- Create the table which points to each printer's last job
+--
+CREATE TABLE printerlastjob(printerid INT4 PRIMARY KEY NOT NULL REFERENCES printers(id),
+                            jobhistoryid INT4 NOT NULL);
+REVOKE ALL ON printerlastjob FROM public;
+GRANT SELECT, INSERT, UPDATE, DELETE, REFERENCES ON printerlastjob TO pykotaadmin;
+GRANT SELECT ON printerlastjob TO pykotauser;
+
+--
+-- Now populates it from the existing history
+--
+INSERT INTO printerlastjob (printerid, jobhistoryid)
+    SELECT DISTINCT ON (printerid) printerid, id FROM jobhistory
+        ORDER BY printerid, jobdate DESC, id DESC;
+
+--
+-- Create the table which holds the daily usage rollups
+--
+CREATE TABLE jobrollup(day DATE NOT NULL,
+                       userid INT4 NOT NULL REFERENCES users(id),
+                       printerid INT4 NOT NULL REFERENCES printers(id),
+                       action TEXT NOT NULL DEFAULT '',
+                       billingcode TEXT NOT NULL DEFAULT '',
+                       hostname TEXT NOT NULL DEFAULT '',
+                       nbjobs INT4 DEFAULT 0,
+                       nbprintedjobs INT4 DEFAULT 0,
+                       jobsize INT8 DEFAULT 0,
+                       jobsizebytes INT8 DEFAULT 0,
+                       jobprice FLOAT DEFAULT 0.0,
+                       printedjobprice FLOAT DEFAULT 0.0,
+                       precomputedjobsize INT8 DEFAULT 0,
+                       precomputedjobprice FLOAT DEFAULT 0.0,
+                       PRIMARY KEY (day, userid, printerid, action, billingcode, hostname));
+CREATE INDEX jobrollup_u_id_ix ON jobrollup (userid, day);
+CREATE INDEX jobrollup_p_id_ix ON jobrollup (printerid, day);
+REVOKE ALL ON jobrollup FROM public;
+GRANT SELECT, INSERT, UPDATE, DELETE, REFERENCES ON jobrollup TO pykotaadmin;
+GRANT SELECT ON jobrollup TO pykotauser;
+
+--
+-- Now populates it from the existing history
+--
+INSERT INTO jobrollup (day, userid, printerid, action, billingcode, hostname, nbjobs, nbprintedjobs, jobsize, jobsizebytes, jobprice, printedjobprice, precomputedjobsize, precomputedjobprice)
+    SELECT DATE(jobdate), userid, printerid, COALESCE(action, ''), COALESCE(billingcode, ''), COALESCE(hostname, ''),
+           COUNT(*), SUM(CASE WHEN jobsize <> 0 THEN 1 ELSE 0 END),
+           COALESCE(SUM(jobsize), 0), COALESCE(SUM(jobsizebytes), 0),
+           COALESCE(SUM(jobprice), 0.0), COALESCE(SUM(CASE WHEN jobsize <> 0 THEN jobprice ELSE 0.0 END), 0.0),
+           COALESCE(SUM(precomputedjobsize), 0), COALESCE(SUM(precomputedjobprice), 0.0)
+        FROM jobhistory
+        GROUP BY DATE(jobdate), userid, printerid, COALESCE(action, ''), COALESCE(billingcode, ''), COALESCE(hostname, '');
+
+--
+-- Partition the job history by month : the existing history becomes
+-- a single partition holding all the jobs printed until the end of
+-- the current month, and new partitions are created ahead by pkarchive.
+--
+ALTER TABLE jobhistory RENAME TO jobhistorybefore127;
+ALTER INDEX jobhistory_pkey RENAME TO jobhistorybefore127_pkey;
+ALTER INDEX jobhistory_u_id_ix RENAME TO jobhistorybefore127_u_id_ix;
+ALTER INDEX jobhistory_p_id_ix RENAME TO jobhistorybefore127_p_id_ix;
+ALTER INDEX jobhistory_pd_id_ix RENAME TO jobhistorybefore127_pd_id_ix;
+ALTER INDEX jobhistory_hostname_ix RENAME TO jobhistorybefore127_hostname_ix;
+UPDATE jobhistorybefore127 SET jobdate='1970-01-01' WHERE jobdate IS NULL;
+ALTER TABLE jobhistorybefore127 ALTER COLUMN jobdate SET NOT NULL;
+
+CREATE TABLE jobhistory(id INT4 NOT NULL DEFAULT nextval('jobhistory_id_seq'),
+                        jobid TEXT,
+                        userid INT4,
+                        printerid INT4,
+                        pagecounter INT4 DEFAULT 0,
+                        jobsizebytes INT8,
+                        jobsize INT4,
+                        jobprice FLOAT,
+                        action TEXT,
+                        filename TEXT,
+                        title TEXT,
+                        copies INT4,
+                        options TEXT,
+                        hostname TEXT,
+                        md5sum TEXT,
+                        pages TEXT,
+                        billingcode TEXT,
+                        precomputedjobsize INT4,
+                        precomputedjobprice FLOAT,
+                        jobdate TIMESTAMP NOT NULL DEFAULT now(),
+                        PRIMARY KEY (id, jobdate),
+                        CONSTRAINT checkUserPQuota FOREIGN KEY (userid, printerid) REFERENCES userpquota(userid, printerid))
+                        PARTITION BY RANGE (jobdate);
+CREATE INDEX jobhistory_u_id_ix ON jobhistory (userid);
+CREATE INDEX jobhistory_p_id_ix ON jobhistory (printerid);
+CREATE INDEX jobhistory_pd_id_ix ON jobhistory (printerid, jobdate);
+CREATE INDEX jobhistory_hostname_ix ON jobhistory (hostname);
+ALTER SEQUENCE jobhistory_id_seq OWNED BY jobhistory.id;
+DO $$
+BEGIN
+    EXECUTE format('ALTER TABLE jobhistory ATTACH PARTITION jobhistorybefore127 FOR VALUES FROM (MINVALUE) TO (%L)',
+                   date_trunc('month', now()) + interval '1 month');
+END;
+$$;
+CREATE TABLE jobhistory_default PARTITION OF jobhistory DEFAULT;
+REVOKE ALL ON jobhistory FROM public;
+GRANT SELECT, INSERT, UPDATE, DELETE, REFERENCES ON jobhistory TO pykotaadmin;
+GRANT SELECT ON jobhistory TO pykotauser;
+
+--
+-- Create the archive of old jobs, see pkarchive
+--
+CREATE TABLE jobhistoryarchive(id INT4 NOT NULL,
+                               jobid TEXT,
+                               userid INT4,
+                               printerid INT4,
+                               pagecounter INT4 DEFAULT 0,
+                               jobsizebytes INT8,
+                               jobsize INT4,
+                               jobprice FLOAT,
+                               action TEXT,
+                               filename TEXT,
+                               title TEXT,
+                               copies INT4,
+                               options TEXT,
+                               hostname TEXT,
+                               md5sum TEXT,
+                               pages TEXT,
+                               billingcode TEXT,
+                               precomputedjobsize INT4,
+                               precomputedjobprice FLOAT,
+                               jobdate TIMESTAMP NOT NULL,
+                               PRIMARY KEY (id, jobdate))
+                               PARTITION BY RANGE (jobdate);
+CREATE INDEX jobhistoryarchive_u_id_ix ON jobhistoryarchive (userid);
+CREATE INDEX jobhistoryarchive_pd_id_ix ON jobhistoryarchive (printerid, jobdate);
+CREATE INDEX jobhistoryarchive_d_ix ON jobhistoryarchive (jobdate);
+
+--
+-- The job history is partitioned by month, and partitions are
+-- created ahead by this function, see pkarchive. Jobs printed
+-- when their month's partition doesn't exist yet go to the
+-- default partition, and are moved when the partition is created.
+--
+CREATE FUNCTION jobhistory_partition(day TIMESTAMP) RETURNS VOID AS $$
+DECLARE
+    first TIMESTAMP := date_trunc('month', day);
+    next TIMESTAMP := date_trunc('month', day) + interval '1 month';
+    partition TEXT := 'jobhistory_' || to_char(day, 'YYYYMM');
+BEGIN
+    IF to_regclass(partition) IS NULL THEN
+        EXECUTE format('CREATE TABLE %I (LIKE jobhistory INCLUDING DEFAULTS)', partition);
+        EXECUTE format('WITH moved AS (DELETE FROM jobhistory_default WHERE jobdate>=%L AND jobdate<%L RETURNING *) '
+                       'INSERT INTO %I SELECT * FROM moved', first, next, partition);
+        EXECUTE format('ALTER TABLE jobhistory ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                       partition, first, next);
+    END IF;
+EXCEPTION
+    -- created concurrently, or covered by the partition of jobs older than 1.27
+    WHEN duplicate_table OR invalid_object_definition THEN NULL;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path FROM CURRENT;
+
+--
+-- Moves a month of jobs from the job history to the archive, and
+-- returns the number of jobs moved. A whole partition is directly
+-- detached and attached to the archive, optionally moving it to
+-- another tablespace, unless it contains a printer's last job.
+--
+CREATE FUNCTION jobhistory_archive(month TIMESTAMP, archivespace TEXT) RETURNS INT8 AS $$
+DECLARE
+    first TIMESTAMP := date_trunc('month', month);
+    next TIMESTAMP := date_trunc('month', month) + interval '1 month';
+    partition TEXT := 'jobhistory_' || to_char(month, 'YYYYMM');
+    archive TEXT := 'jobhistoryarchive_' || to_char(month, 'YYYYMM');
+    moved INT8;
+BEGIN
+    IF (to_regclass(partition) IS NOT NULL) AND (to_regclass(archive) IS NULL)
+       AND NOT EXISTS (SELECT 1 FROM printerlastjob, jobhistory
+                           WHERE jobhistory.id=printerlastjob.jobhistoryid
+                               AND jobdate>=first AND jobdate<next) THEN
+        EXECUTE format('SELECT COUNT(*) FROM %I', partition) INTO moved;
+        EXECUTE format('ALTER TABLE jobhistory DETACH PARTITION %I', partition);
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', partition, archive);
+        IF archivespace IS NOT NULL THEN
+            EXECUTE format('ALTER TABLE %I SET TABLESPACE %I', archive, archivespace);
+        END IF;
+        EXECUTE format('ALTER TABLE jobhistoryarchive ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                       archive, first, next);
+    ELSE
+        IF to_regclass(archive) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I PARTITION OF jobhistoryarchive FOR VALUES FROM (%L) TO (%L)',
+                           archive, first, next)
+                    || CASE WHEN archivespace IS NULL THEN '' ELSE format(' TABLESPACE %I', archivespace) END;
+        END IF;
+        WITH archived AS (DELETE FROM jobhistory
+                              WHERE jobdate>=first AND jobdate<next
+                                  AND id NOT IN (SELECT jobhistoryid FROM printerlastjob)
+                              RETURNING *)
+            INSERT INTO jobhistoryarchive SELECT * FROM archived;
+        GET DIAGNOSTICS moved = ROW_COUNT;
+    END IF;
+    RETURN moved;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path FROM CURRENT;
+
+REVOKE ALL ON jobhistoryarchive FROM public;
+GRANT SELECT, INSERT, UPDATE, DELETE, REFERENCES ON jobhistoryarchive TO pykotaadmin;
+GRANT SELECT ON jobhistoryarchive TO pykotauser;
+REVOKE ALL ON FUNCTION jobhistory_partition(TIMESTAMP), jobhistory_archive(TIMESTAMP, TEXT) FROM public;
+GRANT EXECUTE ON FUNCTION jobhistory_partition(TIMESTAMP), jobhistory_archive(TIMESTAMP, TEXT) TO pykotaadmin;
+
+--
+-- Create the table which holds the time spent in each phase of the jobs
+--
+CREATE TABLE jobtimings(printerid INT4 NOT NULL REFERENCES printers(id),
+                        jobid TEXT,
+                        phase TEXT NOT NULL,
+                        duration FLOAT NOT NULL,
+                        jobdate TIMESTAMP NOT NULL DEFAULT now());
+CREATE INDEX jobtimings_pd_id_ix ON jobtimings (printerid, jobdate);
+REVOKE ALL ON jobtimings FROM public;
+GRANT SELECT, INSERT, UPDATE, DELETE, REFERENCES ON jobtimings TO pykotaadmin;
+GRANT SELECT ON jobtimings TO pykotauser;
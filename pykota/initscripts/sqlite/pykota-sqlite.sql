@@ -103,7 +103,71 @@ CREATE INDEX jobhistory_u_id_ix ON jobhistory (userid);
 CREATE INDEX jobhistory_p_id_ix ON jobhistory (printerid);
 CREATE INDEX jobhistory_pd_id_ix ON jobhistory (printerid, jobdate);
 CREATE INDEX jobhistory_hostname_ix ON jobhistory (hostname);
+
+--
+-- Create the archive of old jobs, see pkarchive
+--
+CREATE TABLE jobhistoryarchive(id INTEGER PRIMARY KEY NOT NULL,
+                               jobid TEXT,
+                               userid INT4,
+                               printerid INT4,
+                               pagecounter INT4 DEFAULT 0,
+                               jobsizebytes INT8,
+                               jobsize INT4,
+                               jobprice FLOAT,
+                               action TEXT,
+                               filename TEXT,
+                               title TEXT,
+                               copies INT4,
+                               options TEXT,
+                               hostname TEXT,
+                               md5sum TEXT,
+                               pages TEXT,
+                               billingcode TEXT,
+                               precomputedjobsize INT4,
+                               precomputedjobprice FLOAT,
+                               jobdate TIMESTAMP);
+CREATE INDEX jobhistoryarchive_u_id_ix ON jobhistoryarchive (userid);
+CREATE INDEX jobhistoryarchive_pd_id_ix ON jobhistoryarchive (printerid, jobdate);
+CREATE INDEX jobhistoryarchive_d_ix ON jobhistoryarchive (jobdate);
+
+--
+-- Create the table which points to each printer's last job
+--
+CREATE TABLE printerlastjob(printerid INT4 PRIMARY KEY NOT NULL REFERENCES printers(id),
+                            jobhistoryid INT4 NOT NULL);
                         
+--
+-- Create the table which holds the daily usage rollups
+--
+CREATE TABLE jobrollup(day TEXT NOT NULL,
+                       userid INT4 NOT NULL REFERENCES users(id),
+                       printerid INT4 NOT NULL REFERENCES printers(id),
+                       action TEXT NOT NULL DEFAULT '',
+                       billingcode TEXT NOT NULL DEFAULT '',
+                       hostname TEXT NOT NULL DEFAULT '',
+                       nbjobs INT4 DEFAULT 0,
+                       nbprintedjobs INT4 DEFAULT 0,
+                       jobsize INT8 DEFAULT 0,
+                       jobsizebytes INT8 DEFAULT 0,
+                       jobprice FLOAT DEFAULT 0.0,
+                       printedjobprice FLOAT DEFAULT 0.0,
+                       precomputedjobsize INT8 DEFAULT 0,
+                       precomputedjobprice FLOAT DEFAULT 0.0,
+                       PRIMARY KEY (day, userid, printerid, action, billingcode, hostname));
+CREATE INDEX jobrollup_u_id_ix ON jobrollup (userid, day);
+CREATE INDEX jobrollup_p_id_ix ON jobrollup (printerid, day);
+
+--
+-- Create the table which holds the time spent in each phase of the jobs
+--
+CREATE TABLE jobtimings(printerid INT4 NOT NULL REFERENCES printers(id),
+                        jobid TEXT,
+                        phase TEXT NOT NULL,
+                        duration FLOAT NOT NULL,
+                        jobdate TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX jobtimings_pd_id_ix ON jobtimings (printerid, jobdate);
+
 --
 -- Create the print quota table for groups
 --
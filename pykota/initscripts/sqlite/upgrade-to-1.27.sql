@@ -0,0 +1,112 @@
+--
+-- PyKota - Print Quotas for CUPS and LPRng
+--
+-- (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+-- This program is free software; you can redistribute it and/or modify
+-- it under the terms of the GNU General Public License as published by
+-- the Free Software Foundation; either version 2 of the License, or
+-- (at your option) any later version.
+--
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+-- 
+-- You should have received a copy of the GNU General Public License
+-- along with this program; if not, write to the Free Software
+-- Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+--
+-- $Id$
+--
+--
+--
+-- This script has to be used if you already
+-- have a pre-1.27 version of PyKota to upgrade
+-- your database schema.
+--
+-- Launch this with sqlite with the .read command
+--
+-- YOU DON'T NEED TO USE IT IF YOU'VE JUST INSTALLED PYKOTA
+--
+
+--
+-- Create the table which points to each printer's last job
+--
+CREATE TABLE printerlastjob(printerid INT4 PRIMARY KEY NOT NULL REFERENCES printers(id),
+                            jobhistoryid INT4 NOT NULL);
+
+--
+-- Now populates it from the existing history
+--
+INSERT INTO printerlastjob (printerid, jobhistoryid)
+    SELECT printerid, MAX(id) FROM jobhistory GROUP BY printerid;
+
+--
+-- Create the table which holds the daily usage rollups
+--
+CREATE TABLE jobrollup(day TEXT NOT NULL,
+                       userid INT4 NOT NULL REFERENCES users(id),
+                       printerid INT4 NOT NULL REFERENCES printers(id),
+                       action TEXT NOT NULL DEFAULT '',
+                       billingcode TEXT NOT NULL DEFAULT '',
+                       hostname TEXT NOT NULL DEFAULT '',
+                       nbjobs INT4 DEFAULT 0,
+                       nbprintedjobs INT4 DEFAULT 0,
+                       jobsize INT8 DEFAULT 0,
+                       jobsizebytes INT8 DEFAULT 0,
+                       jobprice FLOAT DEFAULT 0.0,
+                       printedjobprice FLOAT DEFAULT 0.0,
+                       precomputedjobsize INT8 DEFAULT 0,
+                       precomputedjobprice FLOAT DEFAULT 0.0,
+                       PRIMARY KEY (day, userid, printerid, action, billingcode, hostname));
+CREATE INDEX jobrollup_u_id_ix ON jobrollup (userid, day);
+CREATE INDEX jobrollup_p_id_ix ON jobrollup (printerid, day);
+
+--
+-- Now populates it from the existing history
+--
+INSERT INTO jobrollup (day, userid, printerid, action, billingcode, hostname, nbjobs, nbprintedjobs, jobsize, jobsizebytes, jobprice, printedjobprice, precomputedjobsize, precomputedjobprice)
+    SELECT DATE(jobdate), userid, printerid, COALESCE(action, ''), COALESCE(billingcode, ''), COALESCE(hostname, ''),
+           COUNT(*), SUM(CASE WHEN jobsize <> 0 THEN 1 ELSE 0 END),
+           COALESCE(SUM(jobsize), 0), COALESCE(SUM(jobsizebytes), 0),
+           COALESCE(SUM(jobprice), 0.0), COALESCE(SUM(CASE WHEN jobsize <> 0 THEN jobprice ELSE 0.0 END), 0.0),
+           COALESCE(SUM(precomputedjobsize), 0), COALESCE(SUM(precomputedjobprice), 0.0)
+        FROM jobhistory
+        GROUP BY DATE(jobdate), userid, printerid, COALESCE(action, ''), COALESCE(billingcode, ''), COALESCE(hostname, '');
+
+--
+-- Create the archive of old jobs, see pkarchive
+--
+CREATE TABLE jobhistoryarchive(id INTEGER PRIMARY KEY NOT NULL,
+                               jobid TEXT,
+                               userid INT4,
+                               printerid INT4,
+                               pagecounter INT4 DEFAULT 0,
+                               jobsizebytes INT8,
+                               jobsize INT4,
+                               jobprice FLOAT,
+                               action TEXT,
+                               filename TEXT,
+                               title TEXT,
+                               copies INT4,
+                               options TEXT,
+                               hostname TEXT,
+                               md5sum TEXT,
+                               pages TEXT,
+                               billingcode TEXT,
+                               precomputedjobsize INT4,
+                               precomputedjobprice FLOAT,
+                               jobdate TIMESTAMP);
+CREATE INDEX jobhistoryarchive_u_id_ix ON jobhistoryarchive (userid);
+CREATE INDEX jobhistoryarchive_pd_id_ix ON jobhistoryarchive (printerid, jobdate);
+CREATE INDEX jobhistoryarchive_d_ix ON jobhistoryarchive (jobdate);
+
+--
+-- Create the table which holds the time spent in each phase of the jobs
+--
+CREATE TABLE jobtimings(printerid INT4 NOT NULL REFERENCES printers(id),
+                        jobid TEXT,
+                        phase TEXT NOT NULL,
+                        duration FLOAT NOT NULL,
+                        jobdate TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX jobtimings_pd_id_ix ON jobtimings (printerid, jobdate);
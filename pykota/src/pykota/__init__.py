@@ -20,3 +20,9 @@
 #
 # $Id: __init__.py 3133 2007-01-17 22:19:42Z jerome $
 #
+
+import os
+
+if os.environ.get("PYKOTA_IMPORT_PROFILE") == "1":
+    from pykota import importprofile
+    importprofile.install()
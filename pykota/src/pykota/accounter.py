@@ -24,9 +24,8 @@
 
 """This module defines base classes used by all accounting methods."""
 
-import os
-#import imp
-from importlib.machinery import SourceFileLoader
+from pykota.plugins import load_backend
+
 
 class PyKotaAccounterError(Exception):
     """An exception for Accounter related stuff."""
@@ -104,12 +103,7 @@ def open_accounter(kotafilter, ispreaccounter=0):
     else:
         (backend, args) = kotafilter.config.get_accounter_backend(kotafilter.PrinterName)
     try:
-        # accounterbackend = imp.load_source("accounterbackend",
-        #                                   os.path.join(os.path.dirname(__file__),
-        #                                                "accounters",
-        #                                                "%s.py" % backend.lower()))
-        accounterbackend = SourceFileLoader("accounters",
-                         f"{os.path.join(os.path.dirname(__file__))}/accounters/{backend.lower()}.py").load_module()
+        accounterbackend = load_backend("accounters", backend)
     except ImportError:
         raise PyKotaAccounterError(f"Unsupported accounter backend {backend}")
     else:
@@ -27,7 +27,6 @@ import signal
 import subprocess
 
 from pykota.accounter import AccounterBase, PyKotaAccounterError
-from pykota.accounters import snmp, pjl
 
 
 class Accounter(AccounterBase):
@@ -120,8 +119,13 @@ class Accounter(AccounterBase):
         commandline = self.arguments.strip() % locals()
         cmdlower = commandline.lower()
         if (cmdlower == "snmp") or cmdlower.startswith("snmp:"):
+            from pykota.accounters import snmp  # imports pysnmp, only when needed
+            socketpath = self.filter.config.get_snmp_poller()
+            if socketpath:
+                return snmp.PollerHandler(self, printer, skipinitialwait, socketpath).retrieveInternalPageCounter()
             return snmp.Handler(self, printer, skipinitialwait).retrieveInternalPageCounter()
         elif (cmdlower == "pjl") or cmdlower.startswith("pjl:"):
+            from pykota.accounters import pjl
             return pjl.Handler(self, printer, skipinitialwait).retrieveInternalPageCounter()
 
         if printer is None:
@@ -27,20 +27,21 @@ import os
 import socket
 import errno
 import time
-import threading
-#import Queue
-import queue
 
 from pykota import constants
+from pykota.detector import open_detector
 
-FORMFEEDCHAR = chr(0x0c)  # Form Feed character, ends PJL answers.
+FORMFEEDCHAR = b"\x0c"  # Form Feed character, ends PJL answers.
+ANSWERTIMEOUT = 5  # seconds to wait for the answer to a query
 
-# Old method : pjlMessage = "\033%-12345X@PJL USTATUSOFF\r\n@PJL INFO STATUS\r\n@PJL INFO PAGECOUNT\r\n\033%-12345X"
-# Here's a new method, which seems to work fine on my HP2300N, while the 
-# previous one didn't.
-# TODO : We could also experiment with USTATUS JOB=ON and we would know for sure 
-# when the job is finished, without having to poll the printer repeatedly.
-pjlMessage = "\033%-12345X@PJL USTATUS DEVICE=ON\r\n@PJL INFO STATUS\r\n@PJL INFO PAGECOUNT\r\n@PJL USTATUS DEVICE=OFF\033%-12345X"
+# The connection stays open during the whole accounting phase : unsolicited
+# status messages tell us when the printer's status changes, and each query
+# only asks for the status and page counter. Some printers ignore
+# USTATUS PAGE, we only use it as a hint that the printer is printing.
+pjlUEL = "\033%-12345X"  # Universal Exit Language
+pjlOpenSession = f"{pjlUEL}@PJL USTATUS DEVICE=ON\r\n@PJL USTATUS PAGE=ON\r\n"
+pjlQuery = "@PJL INFO STATUS\r\n@PJL INFO PAGECOUNT\r\n"
+pjlCloseSession = f"@PJL USTATUS DEVICE=OFF\r\n@PJL USTATUS PAGE=OFF\r\n{pjlUEL}"
 pjlStatusValues = {
     "10000": "Powersave Mode",
     "10001": "Ready Online",
@@ -66,122 +67,147 @@ class Handler:
         except (IndexError, ValueError):
             self.port = 9100
         self.printerInternalPageCounter = self.printerStatus = None
-        self.closed = False
         self.sock = None
-        self.queue = None
-        self.readthread = None
-        self.quitEvent = threading.Event()
+        self.buffer = b""
 
     def __del__(self):
         """Ensures the network connection is closed at object deletion time."""
         self.close()
 
     def open(self):
-        """Opens the network connection."""
+        """Opens the network connection and starts the PJL session."""
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             sock.settimeout(1.0)
             sock.connect((self.printerHostname, self.port))
+            sock.sendall(pjlOpenSession.encode("ascii"))
         except socket.error as msg:
+            sock.close()
             self.parent.filter.printInfo(
                 f"Problem during connection to {self.printerHostname}:{self.port} : {str(msg)}", "warn")
             return False
         else:
             self.sock = sock
-            self.closed = False
-            self.quitEvent.clear()
-            self.queue = queue.Queue(0)
-            self.readthread = threading.Thread(target=self.readloop)
-            self.readthread.start()
-            time.sleep(1)
+            self.buffer = b""
             self.parent.filter.logdebug(f"Connected to printer {self.printerHostname}:{self.port}")
             return True
 
     def close(self):
-        """Closes the network connection."""
-        if not self.closed:
-            self.quitEvent.set()
-            if self.readthread is not None:
-                self.readthread.join()
-                self.readthread = None
-            if self.sock is not None:
-                self.sock.close()
-                self.sock = None
+        """Ends the PJL session and closes the network connection."""
+        if self.sock is not None:
+            try:
+                self.sock.settimeout(1.0)
+                self.sock.sendall(pjlCloseSession.encode("ascii"))
+            except socket.error:
+                pass  # the connection may be broken already
+            self.sock.close()
+            self.sock = None
             self.parent.filter.logdebug(f"Connection to {self.printerHostname}:{self.port} is now closed.")
-            self.queue = None
-            self.closed = True
-
-    def readloop(self):
-        """Reading loop thread."""
-        self.parent.filter.logdebug("Reading thread started.")
-        buffer = []
-        while not self.quitEvent.isSet():
+
+    def readAnswer(self, timeout):
+        """Returns the next PJL answer, solicited or not, or None if none came before the timeout."""
+        deadline = time.time() + timeout
+        while FORMFEEDCHAR not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
             try:
-                answer = self.sock.recv(1)
+                data = self.sock.recv(4096)
             except socket.timeout:
-                pass
-            except socket.error as msg:
-                self.parent.filter.printInfo(
-                    f"Problem while receiving PJL answer from {self.printerHostname}:{self.port} : {str(msg)}", "warn")
-            else:
-                if answer:
-                    buffer.append(answer)
-                    if answer.endswith(FORMFEEDCHAR):
-                        self.queue.put("".join(buffer))
-                        buffer = []
-        if buffer:
-            self.queue.put("".join(buffer))
-        self.parent.filter.logdebug("Reading thread ended.")
+                return None
+            if not data:
+                raise socket.error(f"Connection closed by printer {self.printerHostname}:{self.port}")
+            self.buffer += data
+        (answer, self.buffer) = self.buffer.split(FORMFEEDCHAR, 1)
+        return answer.decode("latin-1")
+
+    def parseAnswer(self, answer):
+        """Extracts the printer's status and internal page counter from a PJL answer.
+
+           Returns the (status, pagecounter) tuple, each being None if absent.
+        """
+        self.parent.filter.logdebug(f"PJL answer : {repr(answer)}")
+        status = pagecount = None
+        if "USTATUS PAGE" in answer:
+            status = "10023"  # a page was just printed
+            self.parent.filter.logdebug(f"Printer {self.printerHostname} reported a printed page.")
+        readnext = False
+        for line in [l.strip() for l in answer.split()]:
+            if line.startswith("CODE="):
+                status = line.split("=")[1]
+                self.parent.filter.logdebug(f"Found status : {status}")
+            elif line.startswith("PAGECOUNT="):
+                try:
+                    pagecount = int(line.split('=')[1].strip())
+                except ValueError:
+                    self.parent.filter.logdebug(f"Received incorrect datas : [{line.strip()}]")
+                else:
+                    self.parent.filter.logdebug(f"Found pages counter : {pagecount}")
+            elif line.startswith("PAGECOUNT"):
+                readnext = True  # page counter is on next line
+            elif readnext:
+                try:
+                    pagecount = int(line.strip())
+                except ValueError:
+                    self.parent.filter.logdebug(f"Received incorrect datas : [{line.strip()}]")
+                else:
+                    self.parent.filter.logdebug(f"Found pages counter : {pagecount}")
+                    readnext = False
+        if status is not None:
+            self.printerStatus = status
+        if pagecount is not None:
+            # keep maximum value seen for printer's internal page counter
+            self.printerInternalPageCounter = max(pagecount, self.printerInternalPageCounter or 0)
+        return (status, pagecount)
 
     def retrievePJLValues(self):
-        """Retrieves a printer's internal page counter and status via PJL."""
-        while not self.open():
-            self.parent.filter.logdebug("Will retry in 1 second.")
-            time.sleep(1)
-        try:
+        """Retrieves a printer's internal page counter and status via PJL.
+
+           Reuses the connection to the printer, and reconnects only on error.
+        """
+        while True:
+            while (self.sock is None) and not self.open():
+                self.parent.filter.logdebug("Will retry in 1 second.")
+                time.sleep(1)
             try:
-                nbsent = self.sock.send(pjlMessage)
-                if nbsent != len(pjlMessage):
-                    raise socket.error()
+                self.sock.settimeout(ANSWERTIMEOUT)
+                self.sock.sendall(pjlQuery.encode("ascii"))
+                self.parent.filter.logdebug(f"Query sent to {self.printerHostname} : {repr(pjlQuery)}")
+                status = pagecount = None
+                while (status is None) or (pagecount is None):
+                    answer = self.readAnswer(ANSWERTIMEOUT)
+                    if answer is None:
+                        raise socket.timeout(f"no answer within {ANSWERTIMEOUT} seconds")
+                    (newstatus, newpagecount) = self.parseAnswer(answer)
+                    status = newstatus or status
+                    if newpagecount is not None:
+                        pagecount = newpagecount
+                return
             except socket.error as msg:
                 self.parent.filter.printInfo(
-                    f"Problem while sending PJL query to {self.printerHostname}:{self.port} : {str(msg)}",
-                    "warn")
-            else:
-                self.parent.filter.logdebug(f"Query sent to {self.printerHostname} : {repr(pjlMessage)}")
-                actualpagecount = self.printerStatus = None
-                while (actualpagecount is None) or (self.printerStatus is None):
-                    try:
-                        answer = self.queue.get(True, 5)
-                    except queue.Empty:
-                        self.parent.filter.logdebug(
-                            f"Timeout when reading printer's answer from {self.printerHostname}:{self.port}")
-                    else:
-                        readnext = False
-                        self.parent.filter.logdebug(f"PJL answer : {repr(answer)}")
-                        for line in [l.strip() for l in answer.split()]:
-                            if line.startswith("CODE="):
-                                self.printerStatus = line.split("=")[1]
-                                self.parent.filter.logdebug(f"Found status : {self.printerStatus}")
-                            elif line.startswith("PAGECOUNT="):
-                                try:
-                                    actualpagecount = int(line.split('=')[1].strip())
-                                except ValueError:
-                                    self.parent.filter.logdebug(f"Received incorrect datas : [{line.strip()}]")
-                                else:
-                                    self.parent.filter.logdebug(f"Found pages counter : {actualpagecount}")
-                            elif line.startswith("PAGECOUNT"):
-                                readnext = True  # page counter is on next line
-                            elif readnext:
-                                try:
-                                    actualpagecount = int(line.strip())
-                                except ValueError:
-                                    self.parent.filter.logdebug(f"Received incorrect datas : [{line.strip()}]")
-                                else:
-                                    self.parent.filter.logdebug(f"Found pages counter : {actualpagecount}")
-                                    readnext = False
-                self.printerInternalPageCounter = max(actualpagecount, self.printerInternalPageCounter)
-        finally:
+                    f"Problem while querying {self.printerHostname}:{self.port} : {str(msg)}", "warn")
+                self.close()
+
+    def pause(self, delay):
+        """Waits between two queries, unless the printer tells us its status changed."""
+        if self.sock is None:
+            time.sleep(delay)
+            return
+        deadline = time.time() + delay
+        previousstatus = self.printerStatus
+        try:
+            while True:
+                answer = self.readAnswer(deadline - time.time())
+                if answer is None:
+                    return
+                (status, pagecount) = self.parseAnswer(answer)
+                if (status is not None) and (status != previousstatus):
+                    self.parent.filter.logdebug(f"Printer {self.printerHostname}'s status changed to {status}")
+                    return
+        except socket.error as msg:
+            self.parent.filter.printInfo(
+                f"Problem while receiving PJL answer from {self.printerHostname}:{self.port} : {str(msg)}", "warn")
             self.close()
 
     def waitPrinting(self):
@@ -233,30 +259,27 @@ class Handler:
                                     "warn")
                             break
             self.parent.filter.logdebug(f"Waiting for printer {self.parent.filter.PrinterName} to be printing...")
-            time.sleep(statusstabilizationdelay)
+            self.pause(statusstabilizationdelay)
 
     def waitIdle(self):
         """Waits for printer status being 'idle'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
-        statusstabilizationloops = constants.get(self.parent.filter, "StatusStabilizationLoops")
-        idle_num = 0
+        detector = open_detector(self)
         while True:
             self.retrievePJLValues()
-            if self.printerStatus in ('10000', '10001', '35078', '40000'):
-                if (self.printerInternalPageCounter is not None) \
-                        and self.skipinitialwait \
-                        and (os.environ.get("PYKOTAPHASE") == "BEFORE"):
-                    self.parent.filter.logdebug("No need to wait for the printer to be idle, it is the case already.")
-                    return
-                idle_num += 1
-                if idle_num >= statusstabilizationloops:
-                    # printer status is stable, we can exit
-                    break
-            else:
-                idle_num = 0
+            idle_flag = self.printerStatus in ('10000', '10001', '35078', '40000')
+            if idle_flag \
+                    and (self.printerInternalPageCounter is not None) \
+                    and self.skipinitialwait \
+                    and (os.environ.get("PYKOTAPHASE") == "BEFORE"):
+                self.parent.filter.logdebug("No need to wait for the printer to be idle, it is the case already.")
+                return
+            if detector.isFinished(idle_flag, self.printerInternalPageCounter, None):
+                # printer status is stable, we can exit
+                break
             self.parent.filter.logdebug(
                 f"Waiting for printer {self.parent.filter.PrinterName}'s idle status to stabilize...")
-            time.sleep(statusstabilizationdelay)
+            self.pause(detector.nextDelay())
+        detector.logStatistics()
 
     def retrieveInternalPageCounter(self):
         """Returns the page counter from the printer via internal PJL handling."""
@@ -273,6 +296,8 @@ class Handler:
             raise
         else:
             return self.printerInternalPageCounter
+        finally:
+            self.close()
 
 
 def main(hostname):
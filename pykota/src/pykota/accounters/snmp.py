@@ -31,6 +31,7 @@ The values extracted are defined at least in RFC3805 and RFC2970.
 import sys
 import os
 import time
+import json
 import select
 import socket
 
@@ -48,7 +49,13 @@ except ImportError:
 else:
     hasV4 = True
 
+try:
+    from pysnmp.hlapi import asyncio as snmpasyncio
+except ImportError:
+    snmpasyncio = None  # pksnmpd needs pysnmp v4.4 or later
+
 from pykota import constants
+from pykota.detector import open_detector
 
 #                      
 # Documentation taken from RFC 3805 (Printer MIB v2) and RFC 2790 (Host Resource MIB)
@@ -105,6 +112,73 @@ defaultErrorMask = 0x4fcc  # [ 'No Paper',
 prtConsoleDisplayBufferTextOID = "1.3.6.1.2.1.43.16.5.1.2.1.1"  # SNMPv2-SMI::mib-2.43.16.5.1.2.1.1
 
 
+def extractErrorStates(value):
+    """Returns a list of textual error states from a binary value."""
+    states = []
+    for i in range(min(len(value), len(printerDetectedErrorStateValues))):
+        byte = ord(value[i])
+        bytedescription = printerDetectedErrorStateValues[i]
+        for (k, v) in bytedescription.items():
+            if byte & k:
+                states.append(v)
+    return states
+
+
+def errorConditions(errormask):
+    """Returns the list of textual error states set in a 16 bits error mask."""
+    return extractErrorStates([chr((errormask & 0xff00) >> 8),
+                               chr((errormask & 0x00ff)),
+                               ])
+
+
+def isIdle(printerstatus, devicestatus):
+    """Returns True if the printer is idle. Standby / Powersave is considered idle."""
+    pstatusAsString = printerStatusValues.get(printerstatus)
+    dstatusAsString = deviceStatusValues.get(devicestatus)
+    return (pstatusAsString == 'idle') or \
+        ((pstatusAsString == 'other') and (dstatusAsString == 'running'))
+
+
+async def queryPrinter(engine, hostname, community, port=161):
+    """Retrieves a printer's internal page counter and status with a shared asyncio SNMP engine.
+
+       Returns a sample as sent by pksnmpd to its clients.
+    """
+    sample = {"time": None,
+              "pagecounter": None,
+              "printerstatus": None,
+              "devicestatus": None,
+              "errorstates": None,
+              "error": None,
+              }
+    try:
+        (errorIndication, errorStatus, errorIndex, varBinds) = \
+            await snmpasyncio.getCmd(engine,
+                                     snmpasyncio.CommunityData(community, mpModel=0),
+                                     snmpasyncio.UdpTransportTarget((hostname, port)),
+                                     snmpasyncio.ContextData(),
+                                     *[snmpasyncio.ObjectType(snmpasyncio.ObjectIdentity(oid))
+                                       for oid in (pageCounterOID,
+                                                   hrPrinterStatusOID,
+                                                   hrDeviceStatusOID,
+                                                   hrPrinterDetectedErrorStateOID)])
+    except socket.gaierror as msg:
+        errorIndication = repr(msg)
+    except Exception:
+        errorIndication = "Unknown SNMP/Network error. Check your wires."
+    sample["time"] = time.time()
+    if errorIndication:
+        sample["error"] = str(errorIndication)
+    elif errorStatus:
+        sample["error"] = f"{errorStatus.prettyPrint()} at {varBinds[int(errorIndex) - 1]}"
+    else:
+        sample["pagecounter"] = int(varBinds[0][1].prettyPrint() or "0")
+        sample["printerstatus"] = int(varBinds[1][1].prettyPrint())
+        sample["devicestatus"] = int(varBinds[2][1].prettyPrint())
+        sample["errorstates"] = extractErrorStates(varBinds[3][1].asOctets().decode("latin-1"))
+    return sample
+
+
 class BaseHandler:
     """A class for SNMP print accounting."""
 
@@ -133,33 +207,28 @@ class BaseHandler:
 
     def extractErrorStates(self, value):
         """Returns a list of textual error states from a binary value."""
-        states = []
-        for i in range(min(len(value), len(printerDetectedErrorStateValues))):
-            byte = ord(value[i])
-            bytedescription = printerDetectedErrorStateValues[i]
-            for (k, v) in bytedescription.items():
-                if byte & k:
-                    states.append(v)
-        return states
+        return extractErrorStates(value)
+
+    def getErrorMask(self):
+        """Returns the mask of the error conditions to wait for."""
+        try:
+            errormask = self.parent.filter.config.get_printer_snmp_error_mask(self.parent.filter.PrinterName)
+        except AttributeError:  # debug mode
+            errormask = defaultErrorMask
+        if errormask is None:
+            errormask = defaultErrorMask
+        return errormask
 
     def checkIfError(self, errorstates):
         """Checks if any error state is fatal or not."""
         if errorstates is None:
             return True
         else:
-            try:
-                errormask = self.parent.filter.config.get_printer_snmp_error_mask(self.parent.filter.PrinterName)
-            except AttributeError:  # debug mode
-                errormask = defaultErrorMask
-            if errormask is None:
-                errormask = defaultErrorMask
-            errormaskbytes = [chr((errormask & 0xff00) >> 8),
-                              chr((errormask & 0x00ff)),
-                              ]
-            errorConditions = self.extractErrorStates(errormaskbytes)
-            self.parent.filter.logdebug(f"Error conditions for mask 0x{errormask:04x} : {errorConditions}")
+            errormask = self.getErrorMask()
+            conditions = errorConditions(errormask)
+            self.parent.filter.logdebug(f"Error conditions for mask 0x{errormask:04x} : {conditions}")
             for err in errorstates:
-                if err in errorConditions:
+                if err in conditions:
                     self.parent.filter.logdebug(
                         f"Error condition '{err}' encountered. PyKota will wait until this problem is fixed.")
                     return True
@@ -221,38 +290,32 @@ class BaseHandler:
                                     "warn")
                             break
             self.parent.filter.logdebug(f"Waiting for printer {self.parent.filter.PrinterName} to be printing...")
-            time.sleep(statusstabilizationdelay)
+            self.pause(statusstabilizationdelay)
 
     def waitIdle(self):
         """Waits for printer status being 'idle'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
-        statusstabilizationloops = constants.get(self.parent.filter, "StatusStabilizationLoops")
-        idle_num = idle_flag = 0
+        detector = open_detector(self)
         while 1:
             self.retrieveSNMPValues()
-            pstatusAsString = printerStatusValues.get(self.printerStatus)
-            dstatusAsString = deviceStatusValues.get(self.deviceStatus)
-            idle_flag = 0
-            if (not self.checkIfError(self.printerDetectedErrorState)) \
-                    and ((pstatusAsString == 'idle') or
-                         ((pstatusAsString == 'other') and
-                          (dstatusAsString == 'running'))):
-                idle_flag = 1  # Standby / Powersave is considered idle
-            if idle_flag:
-                if (self.printerInternalPageCounter is not None) \
-                        and self.skipinitialwait \
-                        and (os.environ.get("PYKOTAPHASE") == "BEFORE"):
-                    self.parent.filter.logdebug("No need to wait for the printer to be idle, it is the case already.")
-                    return
-                idle_num += 1
-                if idle_num >= statusstabilizationloops:
-                    # printer status is stable, we can exit
-                    break
-            else:
-                idle_num = 0
+            idle_flag = (not self.checkIfError(self.printerDetectedErrorState)) \
+                and isIdle(self.printerStatus, self.deviceStatus)
+            if idle_flag \
+                    and (self.printerInternalPageCounter is not None) \
+                    and self.skipinitialwait \
+                    and (os.environ.get("PYKOTAPHASE") == "BEFORE"):
+                self.parent.filter.logdebug("No need to wait for the printer to be idle, it is the case already.")
+                return
+            if detector.isFinished(idle_flag, self.printerInternalPageCounter, self.printerDetectedErrorState):
+                # printer status is stable, we can exit
+                break
             self.parent.filter.logdebug(
                 f"Waiting for printer {self.parent.filter.PrinterName}'s idle status to stabilize...")
-            time.sleep(statusstabilizationdelay)
+            self.pause(detector.nextDelay())
+        detector.logStatistics()
+
+    def pause(self, delay):
+        """Waits between two SNMP queries."""
+        time.sleep(delay)
 
     def retrieveInternalPageCounter(self):
         """Returns the page counter from the printer via internal SNMP handling."""
@@ -365,6 +428,108 @@ else:
                             return 1
 
 
+class PollerHandler(Handler):
+    """A class for SNMP print accounting through the pksnmpd shared poller.
+
+       Falls back to direct SNMP queries if pksnmpd can't be reached.
+    """
+    WAITTIMEOUT = 60  # seconds pksnmpd may wait before answering
+    WAITMARGIN = 30  # seconds to wait for pksnmpd's answer past its own timeout
+
+    def __init__(self, parent, printerhostname, skipinitialwait=False, socketpath=None):
+        Handler.__init__(self, parent, printerhostname, skipinitialwait)
+        self.socketpath = socketpath
+        self.lastsample = time.time()  # only samples taken after this time are used
+        self.polldelay = None  # set by the end of job detector
+
+    def askPoller(self, request):
+        """Sends a request to pksnmpd and returns its answer, or None if pksnmpd can't be used."""
+        request.update({"hostname": self.printerHostname,
+                        "community": self.community,
+                        "port": self.port,
+                        "delay": self.polldelay or constants.get(self.parent.filter, "StatusStabilizationDelay"),
+                        "timeout": self.WAITTIMEOUT,
+                        })
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.settimeout(self.WAITTIMEOUT + self.WAITMARGIN)
+                sock.connect(self.socketpath)
+                sock.sendall(json.dumps(request).encode("UTF-8") + b"\n")
+                answer = json.loads(sock.makefile("rb").readline())
+            finally:
+                sock.close()
+            if answer.get("error"):
+                raise ValueError(answer["error"])
+        except (OSError, ValueError) as msg:
+            self.parent.filter.printInfo(
+                f"Impossible to use the SNMP poller listening on {self.socketpath} ({msg}), querying printer {self.printerHostname} directly.",
+                "warn")
+            self.socketpath = None
+            return None
+        return answer
+
+    def useSample(self, sample):
+        """Sets a printer's internal page counter and status from a sample sent by pksnmpd."""
+        self.lastsample = sample["time"]
+        if sample["error"]:
+            self.parent.filter.printInfo(f"SNMP Error : {sample['error']}", "error")
+            self.initValues()
+        else:
+            if self.printerInternalPageCounter is None:
+                self.printerInternalPageCounter = sample["pagecounter"]
+            else:
+                self.printerInternalPageCounter = max(self.printerInternalPageCounter, sample["pagecounter"])
+            self.printerStatus = sample["printerstatus"]
+            self.deviceStatus = sample["devicestatus"]
+            self.printerDetectedErrorState = sample["errorstates"]
+            self.parent.filter.logdebug(
+                f"SNMP answer from poller : PageCounter : {self.printerInternalPageCounter}  PrinterStatus : '{printerStatusValues.get(self.printerStatus)}'  DeviceStatus : '{deviceStatusValues.get(self.deviceStatus)}'  PrinterErrorState : '{self.printerDetectedErrorState}'")
+
+    def retrieveSNMPValues(self):
+        """Retrieves the first sample pksnmpd takes after the previous one."""
+        if self.socketpath:
+            answer = self.askPoller({"request": "sample",
+                                     "after": self.lastsample,
+                                     })
+            if answer is not None:
+                self.useSample(answer["sample"])
+                return
+        Handler.retrieveSNMPValues(self)
+
+    def pause(self, delay):
+        """Waits between two SNMP queries, unless pksnmpd paces them."""
+        if self.socketpath:
+            self.polldelay = delay
+        else:
+            Handler.pause(self, delay)
+
+    def waitIdle(self):
+        """Asks pksnmpd to wait until the printer's idle status is stable."""
+        if open_detector(self).name != "fixed":
+            return Handler.waitIdle(self)  # pksnmpd only knows about the fixed detector
+        if self.skipinitialwait and (os.environ.get("PYKOTAPHASE") == "BEFORE"):
+            loops = 1  # no need to wait if the printer is idle already
+        else:
+            loops = constants.get(self.parent.filter, "StatusStabilizationLoops")
+        after = time.time()
+        while self.socketpath:
+            answer = self.askPoller({"request": "idle",
+                                     "after": after,
+                                     "loops": loops,
+                                     "errormask": self.getErrorMask(),
+                                     })
+            if answer is None:
+                break
+            if answer["sample"] is not None:
+                self.useSample(answer["sample"])
+            if answer["idle"]:
+                return
+            self.parent.filter.logdebug(
+                f"Waiting for printer {self.parent.filter.PrinterName}'s idle status to stabilize...")
+        Handler.waitIdle(self)
+
+
 def main(hostname):
     """Tries SNMP accounting for a printer host."""
 
@@ -0,0 +1,313 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module generates pkbanner's banners from cached templates.
+
+The static part of a banner, its logo, fonts and url, is rendered once
+in PostScript for each page size, logo, url and toner saving factor,
+and saved into a cache directory. Each banner then only consists of
+this template followed by a few lines of PostScript which write the
+job's variables, so neither ReportLab nor pkbanner are needed anymore.
+"""
+
+import os
+import time
+import stat
+import shlex
+import getopt
+import base64
+import hashlib
+import tempfile
+
+TEMPLATEVERSION = 1  # increment it when render_template() changes
+
+# pkbanner's command line
+SHORTOPTIONS = "vhs:l:p:u:"
+LONGOPTIONS = ["help", "version", "savetoner=", "pagesize=", "logo=", "url="]
+DEFAULTS = {"savetoner": "0",
+            "pagesize": "a4",
+            "logo": "/usr/share/pykota/logos/pykota.jpeg",
+            "url": "http://www.pykota.com/",
+            }
+
+CM = 72.0 / 2.54  # points per centimeter
+
+# page sizes in points, as ReportLab defines them
+PAGESIZES = {"a3": (29.7 * CM, 42.0 * CM),
+             "a4": (21.0 * CM, 29.7 * CM),
+             "a5": (14.8 * CM, 21.0 * CM),
+             "b4": (25.0 * CM, 35.3 * CM),
+             "b5": (17.6 * CM, 25.0 * CM),
+             "letter": (612.0, 792.0),
+             "legal": (612.0, 1008.0),
+             "elevenseventeen": (792.0, 1224.0),
+             }
+
+MAXLOGOSIZE = 1000  # in pixels, about 300 dpi at 8 cm wide
+
+PROLOG = """/reencode {
+  findfont dup length dict begin
+    { 1 index /FID ne { def } { pop pop } ifelse } forall
+    /Encoding ISOLatin1Encoding def
+    currentdict
+  end definefont pop
+} bind def
+/Helvetica-Bold-L1 /Helvetica-Bold reencode
+/Courier-Bold-L1 /Courier-Bold reencode
+/printvar {
+  /size exch def /value exch def /label exch def /x exch def
+  gsave
+  /Helvetica-Bold-L1 findfont size scalefont setfont labelcolor
+  x label stringwidth pop sub ypos moveto label show
+  /Courier-Bold-L1 findfont size scalefont setfont valuecolor
+  x %(indent).2f add ypos moveto value show
+  grestore
+  /ypos ypos size 4 add sub def
+} bind def
+/skip { ypos exch sub /ypos exch def } bind def
+"""
+
+
+class PyKotaBannerError(Exception):
+    """An exception for banner related stuff."""
+
+    def __init__(self, message=""):
+        self.message = message
+        Exception.__init__(self, message)
+
+    def __repr__(self):
+        return self.message
+
+    __str__ = __repr__
+
+
+def parse_command(command):
+    """Returns pkbanner's options if command only launches pkbanner, else None.
+
+       The words which aren't options are joined into the 'text' option.
+    """
+    if [c for c in "|&;<>`$()" if c in command]:
+        return None
+    try:
+        arguments = shlex.split(command)
+        if os.path.basename(arguments[0]) != "pkbanner":
+            return None
+        (opts, args) = getopt.getopt(arguments[1:], SHORTOPTIONS, LONGOPTIONS)
+    except (ValueError, IndexError, getopt.GetoptError):
+        return None
+    options = DEFAULTS.copy()
+    for (option, value) in opts:
+        option = {"-s": "savetoner", "-l": "logo", "-p": "pagesize", "-u": "url"}.get(option, option[2:])
+        if option in DEFAULTS:
+            options[option] = value
+        else:
+            return None  # help or version
+    options["text"] = " ".join(args).strip()
+    return options
+
+
+def ps_string(value):
+    """Returns a value as a PostScript string in the ISO-8859-1 encoding."""
+    escaped = []
+    for byte in str(value).encode("ISO-8859-1", "replace"):
+        if byte in b"()\\" or not (32 <= byte < 127):
+            escaped.append(f"\\{byte:03o}")
+        else:
+            escaped.append(chr(byte))
+    return f"({''.join(escaped)})"
+
+
+def ps_color(name, rgb, savetoner):
+    """Returns the definition of a color, lightened by the toner saving factor."""
+    (r, g, b) = [color + (savetoner * (1.0 - color)) for color in rgb]
+    return f"/{name} {{ {r:.3f} {g:.3f} {b:.3f} setrgbcolor }} bind def\n"
+
+
+def render_logo(logo, xcenter, ypos):
+    """Returns the PostScript code which draws a logo 8 cm wide, and its height."""
+    try:
+        import PIL.Image  # only needed to render templates
+    except ImportError:
+        raise PyKotaBannerError("The Python Imaging Library is missing. Download it from http://www.pythonware.com/downloads")
+    try:
+        image = PIL.Image.open(logo)
+        image = image.convert("RGB")
+    except (IOError, OSError, ValueError):
+        return ("", 0.0)  # as pkbanner does, the banner has no logo
+    image.thumbnail((MAXLOGOSIZE, MAXLOGOSIZE))
+    (pixwidth, pixheight) = image.size
+    width = 8 * CM
+    height = pixheight * width / pixwidth
+    datas = base64.a85encode(image.tobytes(), wrapcol=76).decode("ascii")
+    return (f"gsave\n"
+            f"{xcenter - width / 2.0:.2f} {ypos - height:.2f} translate {width:.2f} {height:.2f} scale\n"
+            f"{pixwidth} {pixheight} 8 [{pixwidth} 0 0 -{pixheight} 0 {pixheight}]\n"
+            f"currentfile /ASCII85Decode filter false 3 colorimage\n"
+            f"{datas}~>\n"
+            f"grestore\n", height)
+
+
+def render_template(pagesize, logo, url, savetoner):
+    """Renders the static part of a banner in PostScript.
+
+       The page is left open, the job's variables being written
+       by stamp() at the vertical position left in ypos.
+    """
+    (width, height) = pagesize
+    xcenter = width / 2.0
+    ypos = height - (2 * CM)
+    template = [f"%!PS-Adobe-3.0\n%%Creator: PyKota\n%%Title: PyKota generated Banner\n"
+                f"%%BoundingBox: 0 0 {int(width)} {int(height)}\n%%LanguageLevel: 2\n%%Pages: 1\n%%EndComments\n",
+                PROLOG % {"indent": 0.5 * CM},
+                ps_color("labelcolor", (0, 0, 0), savetoner),
+                ps_color("valuecolor", (1, 0, 0), savetoner),
+                f"/xcenter {xcenter:.2f} def\n",
+                "%%Page: 1 1\n"]
+    if logo:
+        (code, logoheight) = render_logo(logo, xcenter, ypos)
+        template.append(code)
+        ypos -= logoheight
+    if url:
+        template.append(ps_color("urlcolor", (0, 0, 1), savetoner))
+        template.append(f"/Courier-Bold-L1 findfont 16 scalefont setfont urlcolor\n"
+                        f"{ps_string(url)} dup stringwidth pop 2 div xcenter exch sub {2 * CM:.2f} moveto show\n")
+    ypos -= (1 * CM) + 20
+    template.append(f"/ypos {ypos:.2f} def\n")
+    return "".join(template).encode("ISO-8859-1")
+
+
+def check_directory(cachedir):
+    """Creates the cache directory if needed, and checks that nobody else can write into it."""
+    try:
+        os.makedirs(cachedir, mode=0o700, exist_ok=True)
+        infos = os.stat(cachedir)
+    except OSError as msg:
+        raise PyKotaBannerError(f"Impossible to create the banner cache {cachedir} : {msg}")
+    if (infos.st_uid not in (0, os.geteuid())) or (infos.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise PyKotaBannerError(f"The banner cache {cachedir} can be modified by other users")
+
+
+def load_template(cachedir, options):
+    """Returns the static part of a banner, rendering it into the cache if needed.
+
+       options are pkbanner's options, as returned by parse_command().
+    """
+    pagesize = PAGESIZES.get(options["pagesize"].strip().lower())
+    if pagesize is None:
+        raise PyKotaBannerError(f"Unknown page size {options['pagesize']}")
+    try:
+        savetoner = int(options["savetoner"])
+        if (savetoner < 0) or (savetoner > 99):
+            raise ValueError
+    except ValueError:
+        raise PyKotaBannerError(f"Invalid 'savetoner' option {options['savetoner']}")
+    logo = options["logo"].strip()
+    url = options["url"].strip()
+    try:
+        infos = os.stat(logo)
+        logostamp = (infos.st_mtime_ns, infos.st_size)
+    except OSError:
+        logostamp = None  # the logo may appear later
+    key = repr((TEMPLATEVERSION, pagesize, logo, logostamp, url, savetoner)).encode("UTF-8")
+    filename = os.path.join(cachedir, f"banner-{hashlib.sha1(key).hexdigest()}.ps")
+    check_directory(cachedir)
+    try:
+        with open(filename, "rb") as cached:
+            return cached.read()
+    except FileNotFoundError:
+        pass
+    except OSError as msg:
+        raise PyKotaBannerError(f"Impossible to read the cached banner {filename} : {msg}")
+
+    template = render_template(pagesize, logo, url, savetoner / 100.0)
+    try:
+        (fd, tempname) = tempfile.mkstemp(prefix=".banner-", dir=cachedir)
+        try:
+            with os.fdopen(fd, "wb") as cached:
+                cached.write(template)
+            os.replace(tempname, filename)
+        except:
+            os.unlink(tempname)
+            raise
+    except OSError as msg:
+        raise PyKotaBannerError(f"Impossible to save the cached banner {filename} : {msg}")
+    return template
+
+
+def banner_variables(environ, text):
+    """Returns the job's variables written on the banner, like pkbanner does.
+
+       Each item is either an (x, label, value, size) tuple, x being
+       a PostScript expression, or the number of points to skip.
+    """
+
+    def getvar(varname):
+        return environ.get(varname) or "Unknown"
+
+    printername = getvar("PYKOTAPRINTERNAME")
+    variables = [("xcenter", "Username", getvar("PYKOTAUSERNAME"), 20)]
+    if text:
+        variables.append(("xcenter", "More Info", text, 20))
+    variables.append(("xcenter", "Job", f"{printername} - {getvar('PYKOTAJOBID')}", 14))
+    variables.append(("xcenter", "Date", time.strftime("%c", time.localtime()), 14))
+    action = getvar("PYKOTAACTION")
+    action = {"ALLOW": "Allowed",
+              "DENY": "Denied",
+              "WARN": "Allowed with Warning",
+              "PROBLEM": "Problem",
+              "CANCEL": "Cancelled",
+              }.get(action, action)
+    variables.append(("xcenter", "Result", action, 14))
+    variables.append(20)
+    variables.append(("xcenter 2 div", "Title", getvar("PYKOTATITLE"), 10))
+    variables.append(("xcenter 2 div", "Filename", getvar("PYKOTAFILENAME"), 10))
+    variables.append(20)
+    variables.append(("xcenter", f"Pages printed so far on {printername}", getvar("PYKOTAPAGECOUNTER"), 14))
+    limitby = getvar("PYKOTALIMITBY")
+    if limitby == "balance":
+        variables.append(("xcenter", "Account balance", getvar("PYKOTABALANCE"), 14))
+    elif limitby == "quota":
+        variables.append(("xcenter", "Soft Limit", getvar("PYKOTASOFTLIMIT"), 14))
+        variables.append(("xcenter", "Hard Limit", getvar("PYKOTAHARDLIMIT"), 14))
+        variables.append(("xcenter", "Date Limit", getvar("PYKOTADATELIMIT"), 14))
+    else:
+        msg = {"noquota": "No Limit",
+               "nochange": "No Accounting",
+               "noprint": "Forbidden",
+               }.get(limitby, "Unknown")
+        variables.append(("xcenter", "Printing Mode", msg, 14))
+    return variables
+
+
+def stamp(template, environ, text=""):
+    """Returns a complete banner, writing the job's variables onto a template."""
+    lines = [template]
+    for variable in banner_variables(environ, text):
+        if isinstance(variable, tuple):
+            (x, label, value, size) = variable
+            lines.append(f"{x} {ps_string(f'{label} :')} {ps_string(value)} {size} printvar\n".encode("ascii"))
+        else:
+            lines.append(f"{variable} skip\n".encode("ascii"))
+    lines.append(b"showpage\n%%Trailer\n%%EOF\n")
+    return b"".join(lines)
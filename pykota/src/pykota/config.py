@@ -25,9 +25,14 @@
 """This module defines classes used to parse PyKota configuration files."""
 
 import os
+import stat
+import marshal
 import tempfile
+import functools
 import configparser
 
+SNAPSHOTVERSION = 1  # to be increased whenever the snapshot's format changes
+
 
 class PyKotaConfigError(Exception):
     """An exception for PyKota config related stuff."""
@@ -42,6 +47,21 @@ class PyKotaConfigError(Exception):
     __str__ = __repr__
 
 
+def memoized(getter):
+    """Remembers the values a getter returns, the configuration doesn't change while we run."""
+
+    @functools.wraps(getter)
+    def wrapper(self, *args):
+        key = (getter.__name__,) + args
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = self.cache[key] = getter(self, *args)
+            return value
+
+    return wrapper
+
+
 class PyKotaConfig:
     """A class to deal with PyKota's configuration."""
 
@@ -59,8 +79,100 @@ class PyKotaConfig:
             raise PyKotaConfigError(f"Configuration file {self.adminfilename} not found.")
         if os.access(self.adminfilename, os.R_OK):
             self.isAdmin = 1
-        self.config = configparser.ConfigParser()
-        self.config.read([self.filename], encoding='ISO-8859-2')
+        self.snapshotfilename = os.path.join(directory, "pykota.conf.snapshot")
+        self.cache = {}
+        self.options = self.loadSnapshot()
+        self.fromSnapshot = self.options is not None
+        if not self.fromSnapshot:
+            self.options = self.parseConfig()
+
+    def parseConfig(self):
+        """Parses the configuration file.
+
+           Returns a mapping of the sections' names to the mappings of
+           their options' values, printers' sections also containing
+           the global options they don't redefine.
+        """
+        config = configparser.ConfigParser()
+        try:
+            config.read([self.filename], encoding='ISO-8859-2')
+        except configparser.Error as msg:
+            raise PyKotaConfigError(f"Invalid configuration file {self.filename} : {msg}")
+        globaloptions = {}
+        if config.has_section("global"):
+            globaloptions = dict(config.items("global", raw=True))
+        options = {"global": globaloptions}
+        for section in config.sections():
+            if section != "global":
+                options[section] = globaloptions.copy()
+                options[section].update(config.items(section, raw=True))
+        return options
+
+    def getSnapshotKey(self):
+        """Returns what tells if the snapshot was made from the current configuration file."""
+        filestat = os.stat(self.filename)
+        return (SNAPSHOTVERSION, filestat.st_mtime_ns, filestat.st_size)
+
+    def loadSnapshot(self):
+        """Returns the options saved by saveSnapshot(), or None if they are not up to date."""
+        try:
+            with open(self.snapshotfilename, "rb") as snapshot:
+                (key, options) = marshal.load(snapshot)
+            if tuple(key) == self.getSnapshotKey():
+                return options
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        return None
+
+    def saveSnapshot(self):
+        """Saves the parsed configuration file, for the next runs to not parse it again.
+
+           The snapshot gets the same owner and permissions as the configuration file.
+        """
+        key = self.getSnapshotKey()  # before parsing, in case the file changes meanwhile
+        options = self.parseConfig()
+        filestat = os.stat(self.filename)
+        (fd, tempname) = tempfile.mkstemp(prefix="pykota.conf.", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as snapshot:
+                marshal.dump((key, options), snapshot)
+            os.chmod(tempname, stat.S_IMODE(filestat.st_mode))
+            try:
+                os.chown(tempname, filestat.st_uid, filestat.st_gid)
+            except OSError:
+                pass  # not allowed, keeps ours
+            os.replace(tempname, self.snapshotfilename)
+        except:
+            os.remove(tempname)
+            raise
+
+    def check(self):
+        """Checks the configuration by calling all the getters, globally and for each printer.
+
+           The configuration file is parsed again, in case a snapshot was used.
+           Returns the list of the problems found, possibly empty.
+        """
+        import inspect
+        self.options = self.parseConfig()
+        self.cache.clear()
+        problems = []
+        unchecked = ["get_printer_names", "get_global_option", "get_printer_option"]
+        if (self.get_global_option("storagebackend", ignore=1) or "").strip().lower() != "ldapstorage":
+            unchecked.append("get_ldap_info")
+        sections = ["global"] + self.get_printer_names()
+        for name in sorted(dir(self)):
+            if name.startswith("get_") and (name not in unchecked):
+                getter = getattr(self, name)
+                if list(inspect.signature(getter).parameters) == ["printername"]:
+                    calls = [(section,) for section in sections]
+                else:
+                    calls = [()]
+                for args in calls:
+                    try:
+                        getter(*args)
+                    except (PyKotaConfigError, ValueError, TypeError, AttributeError) as msg:
+                        problems.append(f"{name}({', '.join(args)}) : {msg}")
+        return problems
 
     def is_true(self, option):
         """Returns True if option is set to true, else False."""
@@ -78,29 +190,22 @@ class PyKotaConfig:
 
     def get_printer_names(self):
         """Returns the list of configured printers, i.e. all sections names minus 'global'."""
-        return [pname for pname in self.config.sections() if pname != "global"]
+        return [pname for pname in self.options if pname != "global"]
 
     def get_global_option(self, option, ignore=0):
         """Returns an option from the global section, or raises a PyKotaConfigError if ignore is not set,
         else returns None. """
-        try:
-            return self.config.get("global", option, raw=True)
-        except (configparser.NoSectionError, configparser.NoOptionError):
-            if ignore:
-                return None
-            else:
-                raise PyKotaConfigError(f"Option {option} not found in section global of {self.filename}")
+        value = self.options["global"].get(option.lower())
+        if (value is None) and not ignore:
+            raise PyKotaConfigError(f"Option {option} not found in section global of {self.filename}")
+        return value
 
     def get_printer_option(self, printername, option):
         """Returns an option from the printer section, or the global section, or raises a PyKotaConfigError."""
-        globaloption = self.get_global_option(option, ignore=1)
-        try:
-            return self.config.get(printername, option, raw=True)
-        except (configparser.NoSectionError, configparser.NoOptionError):
-            if globaloption is not None:
-                return globaloption
-            else:
-                raise PyKotaConfigError(f"Option {option} not found in section {printername} of {self.filename}")
+        value = self.options.get(printername, self.options["global"]).get(option.lower())
+        if value is None:
+            raise PyKotaConfigError(f"Option {option} not found in section {printername} of {self.filename}")
+        return value
 
     def get_storage_backend(self):
         """Returns the storage backend information as a Python mapping."""
@@ -151,6 +256,28 @@ class PyKotaConfig:
                     pass
         return backendinfo
 
+    @memoized
+    def get_storage_replicas(self):
+        """Returns the list of the read-only replicas of the storage server, possibly empty."""
+        replicas = self.get_global_option("storagereplicas", ignore=1)
+        if not replicas:
+            return []
+        return [replica.strip() for replica in replicas.split(",") if replica.strip()]
+
+    @memoized
+    def get_storage_replica_max_lag(self):
+        """Returns the number of seconds a replica can lag behind the storage server."""
+        lag = self.get_global_option("storagereplicamaxlag", ignore=1)
+        if lag is None:
+            return 60.0  # default value
+        try:
+            lag = float(lag.strip())
+            if lag < 0.0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaConfigError(f"Invalid value {lag} for storagereplicamaxlag directive in section global")
+        return lag
+
     def get_ldap_info(self):
         """Returns some hints for the LDAP backend."""
         ldapinfo = {}
@@ -177,8 +304,29 @@ class PyKotaConfig:
             if not os.access(ldapinfo["cacert"] or "", os.R_OK):
                 raise PyKotaConfigError(
                     f"Option ldaptls is set, but certificate {str(ldapinfo['cacert'])} is not readable.")
+
+        # size of the pages for paged results (RFC 2696), 0 disables paging
+        pagesize = self.get_global_option("ldappagesize", ignore=1)
+        try:
+            ldapinfo["ldappagesize"] = int((pagesize or "500").strip())
+            if ldapinfo["ldappagesize"] < 0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaConfigError(f"Invalid value {pagesize} for ldappagesize directive in section global")
+        # should the server sort the results (RFC 2891), by default (if unset) value is NO
+        ldapinfo["ldapserversort"] = self.is_true(self.get_global_option("ldapserversort", ignore=1))
+
+        # number of outstanding asynchronous writes in a transaction, 0 disables pipelining
+        pipeline = self.get_global_option("ldappipeline", ignore=1)
+        try:
+            ldapinfo["ldappipeline"] = int((pipeline or "0").strip())
+            if ldapinfo["ldappipeline"] < 0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaConfigError(f"Invalid value {pipeline} for ldappipeline directive in section global")
         return ldapinfo
 
+    @memoized
     def get_logging_backend(self):
         """Returns the logging backend information."""
         validloggers = ["stderr", "system"]
@@ -190,18 +338,21 @@ class PyKotaConfig:
             raise PyKotaConfigError(f"Option logger only supports values in {str(validloggers)}")
         return logger
 
+    @memoized
     def get_logo_url(self):
         """Returns the URL to use for the logo in the CGI scripts."""
         url = self.get_global_option("logourl", ignore=1) or \
               "http://www.pykota.com/pykota.png"
         return url.strip()
 
+    @memoized
     def get_logo_link(self):
         """Returns the URL to go to when the user clicks on the logo in the CGI scripts."""
         url = self.get_global_option("logolink", ignore=1) or \
               "http://www.pykota.com/"
         return url.strip()
 
+    @memoized
     def get_pre_accounter_backend(self, printername):
         """Returns the preaccounter backend to use for a given printer."""
         validaccounters = ["software", "ink"]
@@ -225,6 +376,7 @@ class PyKotaConfig:
             raise PyKotaConfigError(
                 f"Option preaccounter in section {printername} only supports values in {str(validaccounters)}")
 
+    @memoized
     def get_accounter_backend(self, printername):
         """Returns the accounter backend to use for a given printer."""
         validaccounters = ["hardware", "software", "ink"]
@@ -248,6 +400,7 @@ class PyKotaConfig:
             raise PyKotaConfigError(
                 f"Option accounter in section {printername} only supports values in {str(validaccounters)}")
 
+    @memoized
     def get_pre_hook(self, printername):
         """Returns the prehook command line to launch, or None if unset."""
         try:
@@ -255,6 +408,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return  # No command to launch in the pre-hook
 
+    @memoized
     def get_post_hook(self, printername):
         """Returns the posthook command line to launch, or None if unset."""
         try:
@@ -262,6 +416,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return  # No command to launch in the post-hook
 
+    @memoized
     def get_strip_title(self, printername):
         """Returns the striptitle directive's content, or None if unset."""
         try:
@@ -269,6 +424,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return  # No prefix to strip off
 
+    @memoized
     def get_ask_confirmation(self, printername):
         """Returns the askconfirmation directive's content, or None if unset."""
         try:
@@ -276,6 +432,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return  # No overwriting will be done
 
+    @memoized
     def get_overwrite_job_ticket(self, printername):
         """Returns the overwrite_jobticket directive's content, or None if unset."""
         try:
@@ -283,6 +440,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return  # No overwriting will be done
 
+    @memoized
     def get_unknown_billing_code(self, printername):
         """Returns the unknown_billingcode directive's content, or the default value if unset."""
         validvalues = ["CREATE", "DENY"]
@@ -308,6 +466,7 @@ class PyKotaConfig:
                     f"Directive unknown_billingcode in section {printername} only supports values in {str(validvalues)}")
             return (value, args)
 
+    @memoized
     def get_printer_enforcement(self, printername):
         """Returns if quota enforcement should be strict or laxist for the current printer."""
         validenforcements = ["STRICT", "LAXIST"]
@@ -322,6 +481,7 @@ class PyKotaConfig:
                     f"Option enforcement in section {printername} only supports values in {str(validenforcements)}")
             return enforcement
 
+    @memoized
     def get_printer_on_backend_error(self, printername):
         """Returns what must be done whenever the real CUPS backend fails."""
         validactions = ["CHARGE", "NOCHARGE"]
@@ -346,6 +506,7 @@ class PyKotaConfig:
                     f"Option onbackenderror in section {printername} only supports values 'charge', 'nocharge', and 'retry:num:delay'")
             return action
 
+    @memoized
     def get_printer_on_accounter_error(self, printername):
         """Returns what must be done whenever the accounter fails."""
         validactions = ["CONTINUE", "STOP"]
@@ -360,6 +521,7 @@ class PyKotaConfig:
                     f"Option onaccountererror in section {printername} only supports values in {str(validactions)}")
             return action
 
+    @memoized
     def get_printer_policy(self, printername):
         """Returns the default policy for the current printer."""
         validpolicies = ["ALLOW", "DENY", "EXTERNAL"]
@@ -385,6 +547,7 @@ class PyKotaConfig:
                     f"Option policy in section {printername} only supports values in {str(validpolicies)}")
             return (policy, args)
 
+    @memoized
     def get_crash_recipient(self):
         """Returns the email address of the software crash messages recipient."""
         try:
@@ -392,6 +555,7 @@ class PyKotaConfig:
         except:
             return
 
+    @memoized
     def get_smtp_server(self):
         """Returns the SMTP server to use to send messages to users."""
         try:
@@ -399,6 +563,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return "localhost"
 
+    @memoized
     def get_mail_domain(self):
         """Returns the mail domain to use to send messages to users."""
         try:
@@ -406,6 +571,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return
 
+    @memoized
     def get_admin_mail(self, printername):
         """Returns the Email address of the Print Quota Administrator."""
         try:
@@ -413,6 +579,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return "root@localhost"
 
+    @memoized
     def get_admin(self, printername):
         """Returns the full name of the Print Quota Administrator."""
         try:
@@ -420,6 +587,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return "root"
 
+    @memoized
     def get_mail_to(self, printername):
         """Returns the recipient of email messages."""
         validmailtos = ["EXTERNAL", "NOBODY", "NONE", "NOONE", "BITBUCKET", "DEVNULL", "BOTH", "USER", "ADMIN"]
@@ -445,6 +613,7 @@ class PyKotaConfig:
                     f"Option mailto in section {printername} only supports values in {str(validmailtos)}")
             return (mailto, args)
 
+    @memoized
     def get_max_deny_banners(self, printername):
         """Returns the maximum number of deny banners to be printed for a particular user on a particular printer."""
         try:
@@ -460,6 +629,7 @@ class PyKotaConfig:
         else:
             return value
 
+    @memoized
     def get_print_cancelled_banners(self, printername):
         """Returns True if a banner should be printed when a job is cancelled, else False."""
         try:
@@ -467,6 +637,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return True
 
+    @memoized
     def get_grace_delay(self, printername):
         """Returns the grace delay in days."""
         try:
@@ -478,6 +649,7 @@ class PyKotaConfig:
         except (TypeError, ValueError):
             raise PyKotaConfigError(f"Invalid grace delay {gd}")
 
+    @memoized
     def get_poor_man(self):
         """Returns the poor man's threshold."""
         try:
@@ -489,6 +661,7 @@ class PyKotaConfig:
         except (TypeError, ValueError):
             raise PyKotaConfigError(f"Invalid poor man's threshold {pm}")
 
+    @memoized
     def get_balance_zero(self):
         """Returns the value of the zero for balance limitation."""
         try:
@@ -500,6 +673,7 @@ class PyKotaConfig:
         except (TypeError, ValueError):
             raise PyKotaConfigError(f"Invalid balancezero value {bz}")
 
+    @memoized
     def get_poor_warn(self):
         """Returns the poor man's warning message."""
         try:
@@ -507,6 +681,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return "Your Print Quota account balance is Low.\nSoon you'll not be allowed to print anymore.\nPlease contact the Print Quota Administrator to solve the problem."
 
+    @memoized
     def get_hard_warn(self, printername):
         """Returns the hard limit error message."""
         try:
@@ -514,6 +689,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return f"You are not allowed to print anymore because\nyour Print Quota is exceeded on printer {printername}."
 
+    @memoized
     def get_soft_warn(self, printername):
         """Returns the soft limit error message."""
         try:
@@ -521,30 +697,138 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return f"You will soon be forbidden to print anymore because\nyour Print Quota is almost reached on printer {printername}."
 
+    @memoized
     def get_privacy(self):
         """Returns True if privacy is activated, else False."""
         return self.is_true(self.get_global_option("privacy", ignore=1))
 
+    @memoized
     def get_debug(self):
         """Returns True if debugging is activated, else False."""
         return self.is_true(self.get_global_option("debug", ignore=1))
 
+    @memoized
     def get_caching(self):
         """Returns True if database caching is enabled, else False."""
         return self.is_true(self.get_global_option("storagecaching", ignore=1))
 
+    @memoized
     def get_ldap_cache(self):
         """Returns True if low-level LDAP caching is enabled, else False."""
         return self.is_true(self.get_global_option("ldapcache", ignore=1))
 
+    @memoized
+    def get_ldap_cache_size(self):
+        """Returns the maximum number of entries in the low-level LDAP cache."""
+        size = self.get_global_option("ldapcachesize", ignore=1)
+        if size is None:
+            return 1000  # default value
+        try:
+            size = int(size.strip())
+            if size <= 0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaConfigError(f"Invalid value {size} for ldapcachesize directive in section global")
+        return size
+
+    @memoized
+    def get_ldap_cache_ttls(self):
+        """Returns a mapping of low-level LDAP cache lifetimes, in seconds.
+
+           Lifetimes are keyed by lowercase objectClass, "*" being the
+           default lifetime set with ldapcachettl.
+        """
+        branchbasename = "ldapcachettl_"
+        branches = [(k, v) for (k, v) in self.options["global"].items() if k.startswith(branchbasename)]
+        branches.append(("ldapcachettl_*", self.get_global_option("ldapcachettl", ignore=1) or "300"))
+        ttls = {}
+        for (k, v) in branches:
+            k = k.split('_', 1)[1].lower()
+            try:
+                ttls[k] = int(v.strip())
+                if ttls[k] < 0:
+                    raise ValueError
+            except ValueError:
+                raise PyKotaConfigError(f"Invalid LDAP cache lifetime {v} for {k} in section global")
+        return ttls
+
+    @memoized
+    def get_sqlite_busy_timeout(self):
+        """Returns the number of milliseconds to wait for a locked SQLite database."""
+        timeout = self.get_global_option("sqlitebusytimeout", ignore=1)
+        if timeout is None:
+            return 10000  # default value
+        try:
+            timeout = int(timeout.strip())
+            if timeout < 0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaConfigError(f"Invalid value {timeout} for sqlitebusytimeout directive in section global")
+        return timeout
+
+    @memoized
+    def get_sqlite_cache_size(self):
+        """Returns the size of SQLite's page cache, in kilobytes."""
+        size = self.get_global_option("sqlitecachesize", ignore=1)
+        if size is None:
+            return 8192  # default value
+        try:
+            size = int(size.strip())
+            if size <= 0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaConfigError(f"Invalid value {size} for sqlitecachesize directive in section global")
+        return size
+
+    @memoized
+    def get_sqlite_mmap_size(self):
+        """Returns the size of the SQLite database mapped in memory, in bytes."""
+        size = self.get_global_option("sqlitemmapsize", ignore=1)
+        if size is None:
+            return 0  # default value
+        try:
+            size = int(size.strip())
+            if size < 0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaConfigError(f"Invalid value {size} for sqlitemmapsize directive in section global")
+        return size
+
+    @memoized
+    def get_slow_query(self):
+        """Returns the duration in seconds above which storage queries are logged, or None."""
+        duration = self.get_global_option("slowquery", ignore=1)
+        if duration is None:
+            return None  # default value : disabled
+        try:
+            duration = float(duration.strip())
+            if duration < 0.0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaConfigError(f"Invalid value {duration} for slowquery directive in section global")
+        return duration
+
+    @memoized
     def get_disable_history(self):
         """Returns True if we want to disable history, else False."""
         return self.is_true(self.get_global_option("disablehistory", ignore=1))
 
+    @memoized
+    def get_history_journal(self):
+        """Returns the path to the job history journal file, else None if the journal is disabled."""
+        value = self.get_global_option("historyjournal", ignore=1)
+        if (value is None) or self.is_false(value):
+            return None
+        if self.is_true(value):
+            return os.path.join(self.get_printer_directory("global"), "pykota-history.journal")
+        return value.strip()
+
+    @memoized
     def get_user_name_to_lower(self):
         """Deprecated."""
         return self.get_global_option("utolower", ignore=1)
 
+    @memoized
     def get_user_name_case(self):
         """Returns value for user name case: upper, lower or native"""
         validvalues = ["upper", "lower", "native"]
@@ -556,10 +840,12 @@ class PyKotaConfig:
             raise PyKotaConfigError(f"Option usernamecase only supports values in {str(validvalues)}")
         return value
 
+    @memoized
     def get_reject_unknown(self):
         """Returns True if we want to reject the creation of unknown users or groups, else False."""
         return self.is_true(self.get_global_option("reject_unknown", ignore=1))
 
+    @memoized
     def get_printer_keep_files(self, printername):
         """Returns True if files must be kept on disk, else False."""
         try:
@@ -567,6 +853,23 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return False
 
+    @memoized
+    def get_printer_streaming(self, printername):
+        """Returns True if jobs must be sent to the printer while they are received, else False."""
+        try:
+            return self.is_true(self.get_printer_option(printername, "streaming"))
+        except PyKotaConfigError:
+            return False
+
+    @memoized
+    def get_printer_job_timings(self, printername):
+        """Returns True if the time spent in each phase of the jobs must be saved, else False."""
+        try:
+            return self.is_true(self.get_printer_option(printername, "jobtimings"))
+        except PyKotaConfigError:
+            return False
+
+    @memoized
     def get_printer_directory(self, printername):
         """Returns the path to our working directory, else a directory suitable for temporary files."""
         try:
@@ -574,6 +877,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return tempfile.gettempdir()
 
+    @memoized
     def get_deny_duplicates(self, printername):
         """Returns True or a command if we want to deny duplicate jobs, else False."""
         try:
@@ -589,6 +893,15 @@ class PyKotaConfig:
                 # it's a command to run.
                 return denyduplicates
 
+    @memoized
+    def get_job_checksum(self):
+        """Returns the method used to compute the jobs' checksums : md5, blake2 or xxhash."""
+        method = (self.get_global_option("jobchecksum", ignore=1) or "md5").strip().lower()
+        if method not in ("md5", "blake2", "xxhash"):
+            raise PyKotaConfigError(f"Incorrect value {method} for the jobchecksum directive")
+        return method
+
+    @memoized
     def get_duplicates_delay(self, printername):
         """Returns the number of seconds after which two identical jobs are not considered a duplicate anymore."""
         try:
@@ -602,6 +915,7 @@ class PyKotaConfig:
                 raise PyKotaConfigError(
                     f"Incorrect value {str(duplicatesdelay)} for the duplicatesdelay directive in section {printername}")
 
+    @memoized
     def get_no_printing_max_delay(self, printername):
         """Returns the max number of seconds to wait for the printer to be in 'printing' mode."""
         try:
@@ -619,6 +933,7 @@ class PyKotaConfig:
             else:
                 return maxdelay
 
+    @memoized
     def get_status_stabilization_loops(self, printername):
         """Returns the number of times the printer must return the 'idle' status to consider it stable."""
         try:
@@ -636,6 +951,7 @@ class PyKotaConfig:
             else:
                 return stab
 
+    @memoized
     def get_status_stabilization_delay(self, printername):
         """Returns the number of seconds to wait between two checks of the printer's status."""
         try:
@@ -653,6 +969,7 @@ class PyKotaConfig:
             else:
                 return stab
 
+    @memoized
     def get_printer_snmp_error_mask(self, printername):
         """Returns the SNMP error mask for a particular printer, or None if not defined."""
         try:
@@ -675,10 +992,27 @@ class PyKotaConfig:
                 raise PyKotaConfigError(
                     f"Incorrect value {errmask} for the snmperrormask directive in section {printername}")
 
+    @memoized
+    def get_printer_end_of_job_detector(self, printername):
+        """Returns the name of the end of job detector to use with hardware accounting."""
+        try:
+            detector = self.get_printer_option(printername, "endofjobdetector").strip().lower()
+        except PyKotaConfigError:
+            return "fixed"
+        return detector or "fixed"
+
+    @memoized
+    def get_snmp_poller(self):
+        """Returns the path to the Unix socket pksnmpd listens on, or None if not defined."""
+        socketpath = (self.get_global_option("snmppoller", ignore=1) or "").strip()
+        return socketpath or None
+
+    @memoized
     def get_winbind_separator(self):
         """Returns the winbind separator's value if it is set, else None."""
         return self.get_global_option("winbind_separator", ignore=1)
 
+    @memoized
     def get_account_banner(self, printername):
         """Returns which banner(s) to account for: NONE, BOTH, STARTING, ENDING."""
         validvalues = ["NONE", "BOTH", "STARTING", "ENDING"]
@@ -693,6 +1027,7 @@ class PyKotaConfig:
                     f"Option accountbanner in section {printername} only supports values in {str(validvalues)}")
             return value
 
+    @memoized
     def get_avoid_duplicate_banners(self, printername):
         """Returns normalized value for avoiding extra banners. """
         try:
@@ -712,6 +1047,7 @@ class PyKotaConfig:
                     value = avoidduplicatebanners
             return value
 
+    @memoized
     def get_starting_banner(self, printername):
         """Returns the startingbanner value if set, else None."""
         try:
@@ -719,6 +1055,7 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return None
 
+    @memoized
     def get_ending_banner(self, printername):
         """Returns the endingbanner value if set, else None."""
         try:
@@ -726,6 +1063,20 @@ class PyKotaConfig:
         except PyKotaConfigError:
             return None
 
+    @memoized
+    def get_banner_cache(self, printername):
+        """Returns the path to the directory which caches the banners' templates, else None if disabled."""
+        try:
+            value = self.get_printer_option(printername, "bannercache")
+        except PyKotaConfigError:
+            return None
+        if self.is_false(value):
+            return None
+        if self.is_true(value):
+            return os.path.join(self.get_printer_directory(printername), "pykota-banners")
+        return value.strip()
+
+    @memoized
     def get_trust_job_size(self, printername):
         """Returns the normalized value of the trustjobsize's directive."""
         try:
@@ -751,41 +1102,25 @@ class PyKotaConfig:
                 raise PyKotaConfigError(f"Option trustjobsize for printer {printername} is incorrect")
             return (limit, replacement)
 
+    @memoized
     def get_printer_coefficients(self, printername):
         """Returns a mapping of coefficients for a particular printer."""
         branchbasename = "coefficient_"
-        try:
-            globalbranches = [(k, self.config.get("global", k)) for k in self.config.options("global") if
-                              k.startswith(branchbasename)]
-        except configparser.NoSectionError as msg:
-            raise PyKotaConfigError(f"Invalid configuration file : {msg}")
-        try:
-            sectionbranches = [(k, self.config.get(printername, k)) for k in self.config.options(printername) if
-                               k.startswith(branchbasename)]
-        except configparser.NoSectionError as msg:
-            sectionbranches = []
         branches = {}
-        for (k, v) in globalbranches:
-            k = k.split('_', 1)[1]
-            value = v.strip()
-            if value:
-                try:
-                    branches[k] = float(value)
-                except ValueError:
-                    raise PyKotaConfigError(f"Invalid coefficient {k} ({value}) for printer {printername}")
-
-        for (k, v) in sectionbranches:
-            k = k.split('_', 1)[1]
-            value = v.strip()
-            if value:
-                try:
-                    branches[k] = float(value)  # overwrite any global option or set a new value
-                except ValueError:
-                    raise PyKotaConfigError(f"Invalid coefficient {k} ({value}) for printer {printername}")
-            else:
-                del branches[k]  # empty value disables a global option
+        # the printer's options already overwrite the global ones,
+        # and an empty value disables a global option
+        for (k, v) in self.options.get(printername, self.options["global"]).items():
+            if k.startswith(branchbasename):
+                k = k.split('_', 1)[1]
+                value = v.strip()
+                if value:
+                    try:
+                        branches[k] = float(value)
+                    except ValueError:
+                        raise PyKotaConfigError(f"Invalid coefficient {k} ({value}) for printer {printername}")
         return branches
 
+    @memoized
     def get_printer_skip_initial_wait(self, printername):
         """Returns True if we want to skip the initial waiting loop, else False."""
         try:
@@ -0,0 +1,102 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines base classes used by all end of job detectors.
+
+An end of job detector decides, from successive readings of a printer's
+status and internal page counter, when a job is entirely printed.
+"""
+
+import time
+
+from pykota import constants
+from pykota.plugins import load_backend
+
+
+class PyKotaDetectorError(Exception):
+    """An exception for end of job detectors related stuff."""
+
+    def __init__(self, message=""):
+        self.message = message
+        Exception.__init__(self, message)
+
+    def __repr__(self):
+        return self.message
+
+    __str__ = __repr__
+
+
+class DetectorBase:
+    """A class to detect when a printer is done with a job."""
+
+    def __init__(self, handler):
+        """Initializes the detector for a SNMP or PJL handler."""
+        self.handler = handler
+        self.filter = handler.parent.filter
+        self.delay = constants.get(self.filter, "StatusStabilizationDelay")
+        self.loops = constants.get(self.filter, "StatusStabilizationLoops")
+        self.starttime = self.lastchange = time.time()
+        self.readings = 0
+        self.previous = None
+
+    def record(self, idle, pagecounter, errorstates):
+        """Records a reading, and returns True if it differs from the previous one."""
+        reading = (idle, pagecounter, errorstates)
+        changed = (self.previous is not None) and (reading != self.previous)
+        if changed:
+            self.lastchange = time.time()
+        self.previous = reading
+        self.readings += 1
+        return changed
+
+    def nextDelay(self):
+        """Returns the number of seconds to wait before the next reading."""
+        raise RuntimeError("You have to overload this method.")
+
+    def isFinished(self, idle, pagecounter, errorstates):
+        """Takes a reading into account, and returns True if the printer is done."""
+        raise RuntimeError("You have to overload this method.")
+
+    def logStatistics(self):
+        """Logs how long it took to detect that the printer is done."""
+        now = time.time()
+        self.filter.printInfo(
+            f"End of job detected on printer {self.filter.PrinterName} by the {self.name} detector in {now - self.starttime:.2f} seconds, {self.readings} readings, {now - self.lastchange:.2f} seconds after the last change.",
+            "info")
+
+
+def open_detector(handler):
+    """Returns the end of job detector to use with a SNMP or PJL handler."""
+    try:
+        name = handler.parent.filter.config.get_printer_end_of_job_detector(handler.parent.filter.PrinterName)
+    except AttributeError:  # testing mode
+        name = "fixed"
+    try:
+        detectorbackend = load_backend("detectors", name)
+    except ImportError:
+        raise PyKotaDetectorError(f"Unsupported end of job detector {name}")
+    else:
+        detector = detectorbackend.Detector(handler)
+        detector.name = name
+        return detector
@@ -0,0 +1,84 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines an adaptive end of job detector.
+
+Readings are taken quickly at first, then less and less often, up to
+statusstabilizationdelay seconds apart. The printer is done when
+statusstabilizationloops consecutive readings, spanning at least
+statusstabilizationdelay seconds, say it is idle with neither its page
+counter nor its error states changing. If the page counter increased
+by the precomputed job size, two such readings are enough. Any change brings the delay between readings back to its
+minimum.
+"""
+
+import os
+import time
+
+from pykota.detector import DetectorBase
+
+MINDELAY = 0.5  # seconds between the first readings
+BACKOFF = 1.5  # factor by which the delay between readings grows
+
+
+class Detector(DetectorBase):
+    """A detector which adapts its readings to the printer's activity."""
+
+    def __init__(self, handler):
+        """Initializes the detector."""
+        DetectorBase.__init__(self, handler)
+        self.interval = min(MINDELAY, self.delay)
+        self.stable = 0
+        self.stablesince = None
+        self.expected = None
+        if (os.environ.get("PYKOTASTATUS") != "CANCELLED") and \
+                (os.environ.get("PYKOTAACTION") == "ALLOW") and \
+                (os.environ.get("PYKOTAPHASE") == "AFTER"):
+            softwarejobsize = getattr(self.filter, "softwareJobSize", None)
+            lastpagecounter = handler.parent.get_last_page_counter()
+            if softwarejobsize and lastpagecounter:
+                self.expected = lastpagecounter + softwarejobsize
+
+    def nextDelay(self):
+        """Returns the number of seconds to wait before the next reading."""
+        delay = self.interval
+        self.interval = min(self.interval * BACKOFF, self.delay)
+        return delay
+
+    def isFinished(self, idle, pagecounter, errorstates):
+        """Takes a reading into account, and returns True if the printer is done."""
+        if self.record(idle, pagecounter, errorstates):
+            self.interval = min(MINDELAY, self.delay)
+            self.stable = 0
+        if not idle:
+            self.stable = 0
+            return False
+        self.stable += 1
+        if self.stable == 1:
+            self.stablesince = time.time()
+        if (self.expected is not None) and (pagecounter == self.expected) and (self.stable >= 2):
+            self.filter.logdebug(
+                f"Printer {self.filter.PrinterName}'s page counter reached the expected value {self.expected}.")
+            return True
+        return (self.stable >= self.loops) and ((time.time() - self.stablesince) >= self.delay)
@@ -0,0 +1,53 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines the historical end of job detector.
+
+The printer is done when statusstabilizationloops consecutive readings,
+statusstabilizationdelay seconds apart, say it is idle.
+"""
+
+from pykota.detector import DetectorBase
+
+
+class Detector(DetectorBase):
+    """A detector which waits for a fixed number of idle readings."""
+
+    def __init__(self, handler):
+        """Initializes the detector."""
+        DetectorBase.__init__(self, handler)
+        self.idle_num = 0
+
+    def nextDelay(self):
+        """Returns the number of seconds to wait before the next reading."""
+        return self.delay
+
+    def isFinished(self, idle, pagecounter, errorstates):
+        """Takes a reading into account, and returns True if the printer is done."""
+        self.record(idle, pagecounter, errorstates)
+        if idle:
+            self.idle_num += 1
+        else:
+            self.idle_num = 0
+        return self.idle_num >= self.loops
@@ -26,25 +26,18 @@
 import sys
 import os
 import pwd
+import math
+import itertools
 from xml.sax import saxutils
 import datetime
 
-try:
-    import jaxml
-except ImportError:
-    sys.stderr.write("The jaxml Python module is not installed. XML output is disabled.\n")
-    sys.stderr.write(
-        "Download jaxml from http://www.librelogiciel.com/software/ or from your Debian archive of choice\n")
-    hasJAXML = 0
-else:
-    hasJAXML = 1
-
 from pykota import version
 from pykota.tool import PyKotaTool, PyKotaToolError, PyKotaCommandLineError, N_
 
 
 class DumPyKota(PyKotaTool):
     """A class for dumpykota."""
+    readonlystorage = True
     validdatatypes = {"history": N_("History"),
                       "users": N_("Users"),
                       "groups": N_("Groups"),
@@ -80,7 +73,9 @@ class DumPyKota(PyKotaTool):
             raise PyKotaCommandLineError(f"{pwd.getpwuid(os.geteuid())[0]} : You're not allowed to use this command.")
 
         datatype = options["data"]
-        if datatype not in self.validdatatypes.keys():
+        if options.get("explain"):
+            datatype = "timings"
+        elif datatype not in self.validdatatypes.keys():
             raise PyKotaCommandLineError(f"Invalid modifier [{datatype}] for --data command line option, see help.")
 
         orderby = options["orderby"]
@@ -115,19 +110,28 @@ class DumPyKota(PyKotaTool):
                         raise PyKotaCommandLineError(f"Invalid filter value [{filterexp}], see help.")
                     else:
                         extractonly.update({filterkey: filtervalue})
+            if datatype == "timings":
+                for filterkey in list(extractonly.keys()):
+                    if filterkey not in ("printername", "jobid", "start", "end"):
+                        self.printInfo(f"Invalid filter {filterkey} for the phase times.", "warn")
+                        del extractonly[filterkey]
 
         format = options["format"]
         if (format not in self.validformats.keys()) or (
                 (format == "cups") and ((datatype != "history") or options["sum"])):
             raise PyKotaCommandLineError(f"Invalid modifier [{format}] for --format command line option, see help.")
 
-        if (format == "xml") and not hasJAXML:
-            raise PyKotaToolError("XML output is disabled because the jaxml module is not available.")
+        if format == "xml":
+            try:
+                import jaxml  # only needed for XML output
+            except ImportError:
+                raise PyKotaToolError(
+                    "XML output is disabled because the jaxml module is not available. Download jaxml from http://www.librelogiciel.com/software/ or from your Debian archive of choice")
 
-        if datatype not in ("payments", "history"):
+        if datatype not in ("payments", "history", "timings"):
             if options["sum"]:
                 raise PyKotaCommandLineError(f"Invalid data type [{datatype}] for --sum command line option, see help.")
-            if extractonly.has_key("start") or extractonly.has_key("end"):
+            if ("start" in extractonly) or ("end" in extractonly):
                 self.printInfo("Invalid filter for the {datatype} data type.".format(**locals()), "warn")
                 try:
                     del extractonly["start"]
@@ -164,11 +168,36 @@ class DumPyKota(PyKotaTool):
                     neededdatatypes.remove(datatype)
             retcode = self.dump_xml(allentries, neededdatatypes)
         else:
-            entries = getattr(self.storage, f"extract{datatype.title()}")(extractonly, orderby)
-            if entries:
-                nbentries = len(entries)
-                retcode = getattr(self, f"dump{format.title()}")(
-                    [self.summarize_datas(entries, datatype, extractonly, options["sum"])], [datatype])
+            extractor = getattr(self.storage, f"extract{datatype.title()}", None)
+            summarizer = getattr(self.storage, f"extract{datatype.title()}Summary", None)
+            mustsummarize = options["sum"]
+            if datatype == "timings":
+                if not hasattr(self.storage, "extractJobTimings"):
+                    raise PyKotaCommandLineError("The phase times can't be explained with this backend.")
+                entries = self.explain_timings(self.storage.extractJobTimings(extractonly))
+                mustsummarize = None
+            elif mustsummarize and (summarizer is not None):
+                # let the database compute the totals
+                (keys, totalize) = self.summary_fields(datatype, extractonly)
+                entries = summarizer(extractonly, keys, totalize)
+                mustsummarize = None
+            elif datatype in ("payments", "history"):
+                # these can be huge, so we stream them
+                if format == "cups":
+                    orderby = ["+jobdate"]
+                entries = extractor(extractonly, orderby, streaming=True)
+            else:
+                entries = extractor(extractonly, orderby)
+            entries = iter(entries or [])
+            try:
+                headers = next(entries)
+            except StopIteration:
+                pass
+            else:
+                nbentries = 1
+                entries = itertools.chain([headers], entries)
+                retcode = getattr(self, f"dump_{format}")(
+                    [self.summarize_datas(entries, datatype, extractonly, mustsummarize)], [datatype])
 
         if mustclose:
             self.outfile.close()
@@ -177,73 +206,84 @@ class DumPyKota(PyKotaTool):
 
         return retcode
 
-    def cmp(self, val1, val2):
-        return (val1 > val2) - (val1 < val2)
+    def summary_fields(self, datatype, extractonly):
+        """Returns the keys and the fields to totalize when summarizing datas."""
+        if datatype == "payments":
+            totalize = [("amount", float)]
+            keys = ["username"]
+        else:  # elif datatype == "history"
+            totalize = [("jobsize", int),
+                        ("jobprice", float),
+                        ("jobsizebytes", int),
+                        ("precomputedjobsize", int),
+                        ("precomputedjobprice", float),
+                        ]
+            keys = [k for k in ("username", "printername", "hostname", "billingcode") if k in extractonly.keys()]
+        return (keys, totalize)
 
     def summarize_datas(self, entries, datatype, extractonly, sum=0):
         """Transforms the datas into a summarized view (with totals).
         
+           entries can be any iterable, the first item being the headers.
+           Totals are computed on the fly, so only one record per
+           summary line is kept in memory.
+
            If sum is false, returns the entries unchanged.
         """
         if not sum:
             return entries
         else:
-            headers = entries[0]
+            entries = iter(entries)
+            headers = next(entries)
             nbheaders = len(headers)
             fieldnumber = {}
-            fieldname = {}
             for i in range(nbheaders):
                 fieldnumber[headers[i]] = i
 
-            if datatype == "payments":
-                totalize = [("amount", float)]
-                keys = ["username"]
-            else:  # elif datatype == "history"
-                totalize = [("jobsize", int),
-                            ("jobprice", float),
-                            ("jobsizebytes", int),
-                            ("precomputedjobsize", int),
-                            ("precomputedjobprice", float),
-                            ]
-                keys = [k for k in ("username", "printername", "hostname", "billingcode") if k in extractonly.keys()]
+            (keys, totalize) = self.summary_fields(datatype, extractonly)
+            keyfields = [fieldnumber[k] for k in keys]
+            totalfields = [(fieldnumber[k], convert) for (k, convert) in totalize]
+            totals = {}
+            for entry in entries:
+                keyvalue = tuple([entry[i] for i in keyfields])
+                try:
+                    values = totals[keyvalue]
+                except KeyError:
+                    values = totals[keyvalue] = [0.0] * len(totalfields)
+                for (j, (i, convert)) in enumerate(totalfields):
+                    values[j] += convert(entry[i] or 0.0)
 
             newentries = [headers]
-            sortedentries = entries[1:]
-            if keys:
-                # If we have several keys, we can sort only on the first one, because they
-                # will vary the same way.
-                sortedentries.sort(lambda x, y, fnum=fieldnumber[keys[0]]: self.cmp(x[fnum], y[fnum]))
-            totals = {}
-            for (k, t) in totalize:
-                totals[k] = {"convert": t, "value": 0.0}
-            prevkeys = {}
-            for k in keys:
-                prevkeys[k] = sortedentries[0][fieldnumber[k]]
-            for entry in sortedentries:
-                curval = '-'.join([str(entry[fieldnumber[k]]) for k in keys])
-                prevval = '-'.join([str(prevkeys[k]) for k in keys])
-                if curval != prevval:
-                    summary = ["*"] * nbheaders
-                    for k in keys:
-                        summary[fieldnumber[k]] = prevkeys[k]
-                    for k in totals.keys():
-                        summary[fieldnumber[k]] = totals[k]["convert"](totals[k]["value"])
-                    newentries.append(summary)
-                    for k in totals.keys():
-                        totals[k]["value"] = totals[k]["convert"](entry[fieldnumber[k]])
-                else:
-                    for k in totals.keys():
-                        totals[k]["value"] += totals[k]["convert"](entry[fieldnumber[k]] or 0.0)
-                for k in keys:
-                    prevkeys[k] = entry[fieldnumber[k]]
-            summary = ["*"] * nbheaders
-            for k in keys:
-                summary[fieldnumber[k]] = prevkeys[k]
-            for k in totals.keys():
-                summary[fieldnumber[k]] = totals[k]["convert"](totals[k]["value"])
-            newentries.append(summary)
+            for keyvalue in sorted(totals.keys(), key=lambda kv: [str(v) for v in kv]):
+                summary = ["*"] * nbheaders
+                for (i, value) in zip(keyfields, keyvalue):
+                    summary[i] = value
+                for ((i, convert), value) in zip(totalfields, totals[keyvalue]):
+                    summary[i] = convert(value)
+                newentries.append(summary)
             return newentries
 
+    def explain_timings(self, entries):
+        """Computes statistics about the time spent in each phase of the jobs on each printer.
+
+           entries can be any iterable of (printername, phase, seconds)
+           records ordered by printer, phase and seconds, the first item
+           being the headers. The records of a single phase on a single
+           printer are kept in memory at once.
+        """
+        entries = iter(entries)
+        try:
+            next(entries)  # replaced by our own headers
+        except StopIteration:
+            return
+        yield ["printername", "phase", "nbjobs", "mean", "p50", "p90", "p99", "max"]
+        for ((printername, phase), records) in itertools.groupby(entries, key=lambda r: (r[0], r[1])):
+            durations = [float(r[2]) for r in records]
+            nbjobs = len(durations)
+            percentiles = [durations[max(0, math.ceil(nbjobs * p / 100) - 1)] for p in (50, 90, 99)]
+            yield [printername, phase, nbjobs] \
+                + [round(seconds, 3) for seconds in [sum(durations) / nbjobs] + percentiles + [durations[-1]]]
+
     def dump_with_separator(self, separator, allentries):
         """Dumps datas with a separator."""
         for entries in allentries:
@@ -276,14 +316,12 @@ class DumPyKota(PyKotaTool):
     def dump_cups(self, allentries, dummy):
         """Dumps history datas as CUPS' page_log format."""
         months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-        entries = allentries[0]
-        fieldnames = entries[0]
+        entries = iter(allentries[0])
+        fieldnames = next(entries)
         fields = {}
         for i in range(len(fieldnames)):
             fields[fieldnames[i]] = i
-        sortindex = fields["jobdate"]
-        entries = entries[1:]
-        entries.sort(lambda m, n, si=sortindex: self.cmp(m[si], n[si]))
+        # NB : entries were extracted ordered by jobdate
         for entry in entries:
             printername = entry[fields["printername"]]
             username = entry[fields["username"]]
@@ -303,13 +341,15 @@ class DumPyKota(PyKotaTool):
 
     def dump_xml(self, allentries, datatypes):
         """Dumps datas as XML."""
+        import jaxml
         x = jaxml.XML_document(encoding="UTF-8")
         x.pykota(version=version.__version__, author=version.__author__)
         for (entries, datatype) in zip(allentries, datatypes):
             x._push()
             x.dump(storage=self.config.get_storage_backend()["storagebackend"], type=datatype)
-            headers = entries[0]
-            for entry in entries[1:]:
+            entries = iter(entries)
+            headers = next(entries)
+            for entry in entries:
                 x._push()
                 x.entry()
                 for (header, value) in zip(headers, entry):
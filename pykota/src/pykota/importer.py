@@ -0,0 +1,432 @@
+# PyKota Print Quota Data Importer
+#
+# PyKota - Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module handles the restoration of the datas dumped by dumpykota."""
+
+import sys
+import os
+import pwd
+import re
+import gzip
+import time
+from xml.sax import saxutils
+from xml.etree import ElementTree
+
+from pykota.tool import PyKotaTool, PyKotaToolError, PyKotaCommandLineError
+
+IMPORTBATCHSIZE = 10000  # number of entries loaded in each transaction
+
+# for each data type : the table it goes into, the field naming its
+# entries if any, the fields resolved from names as (field, table,
+# namefield, dumped field), and the other fields restored as is.
+IMPORTS = {"printers": ("printers", "printername", [],
+                        ["printername", "description", "priceperpage", "priceperjob", "passthrough", "maxjobsize"]),
+           "pmembers": ("printergroupsmembers", None,
+                        [("groupid", "printers", "printername", "pgroupname"),
+                         ("printerid", "printers", "printername", "printername")],
+                        []),
+           "users": ("users", "username", [],
+                     ["username", "email", "balance", "lifetimepaid", "limitby", "description", "overcharge"]),
+           "groups": ("groups", "groupname", [],
+                      ["groupname", "description", "limitby"]),
+           "billingcodes": ("billingcodes", "billingcode", [],
+                            ["billingcode", "description", "balance", "pagecounter"]),
+           "umembers": ("groupsmembers", None,
+                        [("groupid", "groups", "groupname", "groupname"),
+                         ("userid", "users", "username", "username")],
+                        []),
+           "upquotas": ("userpquota", None,
+                        [("userid", "users", "username", "username"),
+                         ("printerid", "printers", "printername", "printername")],
+                        ["lifepagecounter", "pagecounter", "softlimit", "hardlimit", "datelimit", "maxjobsize",
+                         "warncount"]),
+           "gpquotas": ("grouppquota", None,
+                        [("groupid", "groups", "groupname", "groupname"),
+                         ("printerid", "printers", "printername", "printername")],
+                        ["softlimit", "hardlimit", "maxjobsize", "datelimit"]),
+           "payments": ("payments", None,
+                        [("userid", "users", "username", "username")],
+                        ["amount", "description", "date"]),
+           "history": ("jobhistory", None,
+                       [("userid", "users", "username", "username"),
+                        ("printerid", "printers", "printername", "printername")],
+                       ["jobid", "pagecounter", "jobsizebytes", "jobsize", "jobprice", "action", "filename", "title",
+                        "copies", "options", "hostname", "md5sum", "pages", "billingcode", "precomputedjobsize",
+                        "precomputedjobprice", "jobdate"]),
+           }
+
+INTFIELDS = ("maxjobsize", "pagecounter", "lifepagecounter", "softlimit", "hardlimit", "warncount",
+             "jobsizebytes", "jobsize", "copies", "precomputedjobsize")
+FLOATFIELDS = ("priceperpage", "priceperjob", "balance", "lifetimepaid", "overcharge", "amount", "jobprice",
+               "precomputedjobprice")
+
+# the fields which identify each data type in a CSV dump, most specific first
+SIGNATURES = [("history", ("jobid",)),
+              ("payments", ("amount",)),
+              ("gpquotas", ("groupname", "printername")),
+              ("upquotas", ("username", "printername")),
+              ("umembers", ("groupname", "username")),
+              ("pmembers", ("pgroupname",)),
+              ("billingcodes", ("billingcode",)),
+              ("printers", ("printername",)),
+              ("groups", ("groupname",)),
+              ("users", ("username",)),
+              ]
+
+
+class ImPyKota(PyKotaTool):
+    """A class for pkimport."""
+    validdatatypes = ("history", "users", "groups", "printers", "upquotas", "gpquotas", "payments", "pmembers",
+                      "umembers", "billingcodes")
+    separators = {"csv": ",",
+                  "ssv": ";",
+                  "tsv": "\t",
+                  }
+
+    def openDump(self, filename, binary=False):
+        """Opens a dump file, compressed or not, or stdin if filename is '-'."""
+        if filename == "-":
+            if binary:
+                return sys.stdin.buffer
+            return sys.stdin
+        try:
+            if filename.endswith(".gz"):
+                if binary:
+                    return gzip.open(filename, "rb")
+                return gzip.open(filename, "rt", encoding="UTF-8")
+            if binary:
+                return open(filename, "rb")
+            return open(filename, "r", encoding="UTF-8")
+        except (IOError, OSError) as msg:
+            raise PyKotaCommandLineError(f"Impossible to open {filename} : {msg}")
+
+    def guessFormat(self, filename):
+        """Guesses the format of a dump file from its first character."""
+        infile = self.openDump(filename, binary=True)
+        try:
+            start = infile.read(64).lstrip()
+        finally:
+            infile.close()
+        if start.startswith(b"<"):
+            return "xml"
+        elif start.startswith(b'"'):
+            firstfield = start.split(b'"')[1]
+            for (format, separator) in self.separators.items():
+                if start[len(firstfield) + 2:].startswith(separator.encode()):
+                    return format
+        raise PyKotaCommandLineError(f"Impossible to guess the format of {filename}, see help.")
+
+    def guessDataType(self, headers):
+        """Guesses the data type of a CSV dump from its headers."""
+        for (datatype, fields) in SIGNATURES:
+            if not [field for field in fields if field not in headers]:
+                return datatype
+        raise PyKotaToolError(f"Impossible to guess the data type from the headers {', '.join(headers)}, see help.")
+
+    def readXML(self, infile):
+        """Yields (datatype, entry) for each entry of an XML dump, entries being dicts."""
+        datatype = None
+        dump = None
+        for (event, element) in ElementTree.iterparse(infile, events=("start", "end")):
+            if event == "start":
+                if element.tag == "dump":
+                    (datatype, dump) = (element.get("type"), element)
+            elif element.tag == "entry":
+                entry = {}
+                for attribute in element:
+                    name = attribute.get("name")
+                    value = attribute.text or ""
+                    if attribute.get("type") == "NoneType":
+                        value = None
+                    elif name in ("filename", "title", "options", "billingcode"):
+                        value = saxutils.unescape(value, {"&apos;": "'", "&quot;": '"'})
+                    entry[name] = value
+                yield (datatype, entry)
+                dump.clear()
+
+    def readSeparated(self, infile, separator, datatype=None):
+        """Yields (datatype, entry) for each entry of a CSV, SSV or TSV dump, entries being dicts.
+
+           Values are quoted when they are strings, with the separator
+           and the double quotes escaped by a backslash. Quoted 'None'
+           values were NULL.
+        """
+        sep = re.escape(separator)
+        field = re.compile(r'(?:"((?:[^"\\]|\\.)*)"|([^"%s\n]*))(%s|\n|$)' % (sep, sep), re.S)
+        escaped = re.compile(r'\\([%s"])' % sep)
+        headers = None
+        for line in infile:
+            values = None
+            while values is None:
+                values = []
+                position = 0
+                while True:
+                    match = field.match(line, position)
+                    if match is None:
+                        values = None  # a quoted value spans several lines
+                        break
+                    (quoted, unquoted, end) = match.groups()
+                    if quoted is not None:
+                        if quoted == "None":
+                            quoted = None
+                        elif "\\" in quoted:
+                            quoted = escaped.sub(r"\1", quoted)
+                        values.append(quoted)
+                    else:
+                        values.append(unquoted)
+                    position = match.end()
+                    if end != separator:
+                        break
+                if (values is None) or (position < len(line)):
+                    nextline = infile.readline()
+                    if not nextline:
+                        raise PyKotaToolError(f"Incorrect dump line : {line!r}")
+                    line += nextline
+                    values = None
+            if headers is None:
+                headers = values
+                datatype = datatype or self.guessDataType(headers)
+            else:
+                yield (datatype, dict(zip(headers, values)))
+
+    def convert(self, field, value):
+        """Converts a dumped value to the type of its field."""
+        if value in (None, "", "None"):
+            return None
+        elif field in INTFIELDS:
+            try:
+                return int(value)
+            except ValueError:
+                return int(float(value))
+        elif field in FLOATFIELDS:
+            return float(value)
+        elif field == "passthrough":
+            return (value in ("1", "t", "true", "TRUE", "True") and "t") or "f"
+        return value
+
+    def identifiers(self, table, namefield):
+        """Returns the mapping from names to ids of a table's records, loading it if needed."""
+        if (table not in self.idents) or (table in self.stale):
+            self.idents[table] = self.storage.retrieveIdentifiers(table, namefield)
+            self.stale.discard(table)
+        return self.idents[table]
+
+    def pairs(self, table, fields):
+        """Returns the set of the existing pairs of ids in a relationship table, loading it if needed."""
+        if table not in self.existing:
+            self.existing[table] = self.storage.retrieveExistingPairs(table, fields)
+        return self.existing[table]
+
+    def prepareBatch(self, datatype, entries):
+        """Transforms a batch of dumped entries into records ready to be inserted.
+
+           Entries already present in the database, or for which a
+           name can't be resolved, are skipped.
+        """
+        (table, namefield, references, fields) = IMPORTS[datatype]
+        resolvers = [(field, self.identifiers(reftable, refnamefield), dumpfield)
+                     for (field, reftable, refnamefield, dumpfield) in references]
+        if namefield is not None:
+            # the ids of the new names are not needed before the next data type
+            idents = self.idents.get(table)
+            if idents is None:
+                idents = self.identifiers(table, namefield)
+        elif datatype not in ("payments", "history"):
+            existing = self.pairs(table, [ref[0] for ref in references])
+        records = []
+        for entry in entries:
+            record = {}
+            for (field, mapping, dumpfield) in resolvers:
+                record[field] = mapping.get(entry.get(dumpfield))
+                if record[field] is None:
+                    self.logdebug(f"Unknown name {entry.get(dumpfield)} in {datatype}, skipped.")
+                    break
+            else:
+                for field in fields:
+                    if (field in entry) or (datatype in ("payments", "history")):
+                        record[field] = self.convert(field, entry.get(field))
+                if namefield is not None:
+                    if (record.get(namefield) is None) or (record[namefield] in idents):
+                        continue
+                    idents[record[namefield]] = None
+                    self.stale.add(table)
+                elif datatype not in ("payments", "history"):
+                    key = tuple([record[ref[0]] for ref in references])
+                    if key in existing:
+                        continue
+                    existing.add(key)
+                records.append(record)
+        return records
+
+    def loadBatch(self, datatype, entries, checkexisting):
+        """Loads a batch of dumped entries in a single transaction.
+
+           Returns the number of entries inserted.
+        """
+        (table, namefield, references, fields) = IMPORTS[datatype]
+        records = self.prepareBatch(datatype, entries)
+        self.storage.beginTransaction()
+        try:
+            if datatype == "history":
+                nbinserted = self.storage.importJobs(records, checkexisting)
+                self.printerids.update([r["printerid"] for r in records])
+            elif datatype == "payments":
+                nbinserted = self.storage.importPayments(records, checkexisting)
+            else:
+                # fields missing from the dump keep their default values
+                allfields = [ref[0] for ref in references] + [f for f in fields if records and (f in records[0])]
+                self.storage.insertManyRecords(table, allfields, [[r[f] for f in allfields] for r in records])
+                nbinserted = len(records)
+        except:
+            self.storage.rollbackTransaction()
+            self.idents.pop(table, None)
+            self.existing.pop(table, None)
+            raise
+        else:
+            self.storage.commitTransaction()
+        return nbinserted
+
+    def readCheckpoint(self):
+        """Returns the (section, nbentries) position reached by a previous run, if any."""
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            try:
+                with open(self.checkpoint, "r") as checkpoint:
+                    (section, nbentries) = [int(value) for value in checkpoint.read().split()]
+            except (IOError, OSError, ValueError) as msg:
+                raise PyKotaToolError(f"Incorrect checkpoint file {self.checkpoint} : {msg}")
+            self.printInfo(f"Resuming the import after the entry {nbentries} of the dump number {section + 1}.")
+            return (section, nbentries)
+        return (0, 0)
+
+    def writeCheckpoint(self, section, nbentries):
+        """Atomically saves the position of the last entry loaded."""
+        if self.checkpoint:
+            temporary = f"{self.checkpoint}.tmp"
+            with open(temporary, "w") as checkpoint:
+                checkpoint.write(f"{section} {nbentries}\n")
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+            os.rename(temporary, self.checkpoint)
+
+    def finishSection(self, datatype, nbentries, nbinserted, before):
+        """Finishes the import of a data type, and displays the number of entries loaded per second."""
+        if datatype is None:
+            return
+        if (datatype == "history") and self.printerids:
+            self.storage.beginTransaction()
+            try:
+                self.storage.updatePrinterLastJobs(sorted(self.printerids))
+            except:
+                self.storage.rollbackTransaction()
+                raise
+            else:
+                self.storage.commitTransaction()
+            self.printerids = set()
+        elapsed = max(time.time() - before, 0.001)
+        self.display("\r")
+        print(f"{datatype} : {nbinserted} entries imported, {nbentries - nbinserted} skipped, in {elapsed:.1f} seconds ({nbentries / elapsed:.0f} entries/s)")
+
+    def main(self, arguments, options):
+        """Print Quota Data Importer."""
+        if not self.config.isAdmin:
+            raise PyKotaCommandLineError(f"{pwd.getpwuid(os.geteuid())[0]} : You're not allowed to use this command.")
+
+        if not hasattr(self.storage, "insertManyRecords"):
+            raise PyKotaCommandLineError("Datas can't be imported with this backend.")
+
+        datatype = options["data"]
+        if datatype and (datatype not in self.validdatatypes):
+            raise PyKotaCommandLineError(f"Invalid modifier [{datatype}] for --data command line option, see help.")
+
+        try:
+            batchsize = int(options["batchsize"])
+            if batchsize <= 0:
+                raise ValueError
+        except ValueError:
+            raise PyKotaCommandLineError(
+                f"Incorrect value '{options['batchsize']}' for the --batchsize command line option")
+
+        filename = arguments[0]
+        format = options["format"]
+        if not format:
+            if filename == "-":
+                raise PyKotaCommandLineError("The -f | --format command line option is mandatory when reading from stdin, see help.")
+            format = self.guessFormat(filename)
+        if format not in ("xml",) + tuple(self.separators.keys()):
+            raise PyKotaCommandLineError(f"Invalid modifier [{format}] for --format command line option, see help.")
+        if format == "xml":
+            infile = self.openDump(filename, binary=True)
+            entries = self.readXML(infile)
+        else:
+            infile = self.openDump(filename)
+            entries = self.readSeparated(infile, self.separators[format], datatype)
+
+        self.checkpoint = (filename != "-") and f"{filename}.progress"
+        (resumesection, resumeentries) = self.readCheckpoint()
+        self.idents = {}
+        self.stale = set()
+        self.existing = {}
+        self.printerids = set()
+        section = -1
+        currenttype = None
+        batch = []
+        nbentries = nbinserted = 0
+        checkexisting = False
+        before = time.time()
+        try:
+            for (entrytype, entry) in entries:
+                if entrytype != currenttype:
+                    if batch:
+                        nbinserted += self.loadBatch(currenttype, batch, checkexisting)
+                        self.writeCheckpoint(section, nbentries)
+                        batch = []
+                    self.finishSection(currenttype, nbentries, nbinserted, before)
+                    section += 1
+                    currenttype = entrytype
+                    nbentries = nbinserted = 0
+                    before = time.time()
+                nbentries += 1
+                if (section < resumesection) or ((section == resumesection) and (nbentries <= resumeentries)):
+                    # already loaded by a previous run, which may have
+                    # stopped after loading the next batch too
+                    checkexisting = True
+                    continue
+                batch.append(entry)
+                if len(batch) >= batchsize:
+                    nbinserted += self.loadBatch(currenttype, batch, checkexisting)
+                    self.writeCheckpoint(section, nbentries)
+                    checkexisting = False
+                    batch = []
+                    self.display(f"\r{currenttype} : {nbentries} entries")
+            if batch:
+                nbinserted += self.loadBatch(currenttype, batch, checkexisting)
+                self.writeCheckpoint(section, nbentries)
+            self.finishSection(currenttype, nbentries, nbinserted, before)
+        except ElementTree.ParseError as msg:
+            raise PyKotaToolError(f"Incorrect XML dump {filename} : {msg}")
+        finally:
+            if infile not in (sys.stdin, sys.stdin.buffer):
+                infile.close()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return 0
@@ -0,0 +1,127 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+
+"""This module measures how long each module takes to be imported.
+
+When the PYKOTA_IMPORT_PROFILE environment variable is set to 1, the
+pykota package installs this profiler before importing anything else,
+and the measurements are written to stderr when the command exits.
+For cupspykota, they end up in CUPS' error_log. The format is the same
+as with python -X importtime : the time spent in the module itself, the
+time including the modules it imports, both in microseconds, then the
+module's name, indented by its nesting level. The modules imported
+before the pykota package are not measured.
+"""
+
+import sys
+import time
+import atexit
+
+
+class TimedLoader:
+    """A loader which measures the time another loader takes to load a module."""
+
+    def __init__(self, loader, profiler):
+        """Wraps a loader."""
+        self.loader = loader
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        """Delegates everything else to the wrapped loader."""
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        """Creates the module, extension modules are loaded at this time."""
+        self.profiler.begin(spec.name)
+        try:
+            create_module = getattr(self.loader, "create_module", None)
+            if create_module is not None:
+                return create_module(spec)
+            return None
+        except:
+            self.profiler.end(spec.name)
+            raise
+
+    def exec_module(self, module):
+        """Executes the module."""
+        self.profiler.begin(module.__name__)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler.end(module.__name__)
+
+
+class ImportProfiler:
+    """A meta path finder which wraps the loaders the other finders return."""
+
+    def __init__(self):
+        """Initializes the profiler."""
+        self.stack = []  # modules being imported, as [name, start, time spent in children, depth]
+        self.current = {}  # the same, by name
+        self.entries = []  # (depth, name, self time, cumulative time) in the order imports end
+
+    def find_spec(self, fullname, path, target=None):
+        """Asks the other finders for the module, then wraps its loader."""
+        for finder in sys.meta_path:
+            if (finder is not self) and hasattr(finder, "find_spec"):
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    if hasattr(spec.loader, "exec_module"):
+                        spec.loader = TimedLoader(spec.loader, self)
+                    return spec
+        return None
+
+    def begin(self, name):
+        """Starts measuring a module's import, unless already started."""
+        if name not in self.current:
+            entry = self.current[name] = [name, time.perf_counter(), 0.0, len(self.stack)]
+            self.stack.append(entry)
+
+    def end(self, name):
+        """Ends measuring a module's import."""
+        entry = self.current.pop(name, None)
+        if entry is not None:
+            cumulative = time.perf_counter() - entry[1]
+            self.stack.remove(entry)
+            if self.stack:
+                self.stack[-1][2] += cumulative
+            self.entries.append((entry[3], name, cumulative - entry[2], cumulative))
+
+    def report(self):
+        """Writes the measurements to stderr."""
+        lines = ["import time: self [us] | cumulative | imported package"]
+        for (depth, name, selftime, cumulative) in self.entries:
+            lines.append(f"import time: {int(selftime * 1000000):>9} | {int(cumulative * 1000000):>10} | {'  ' * depth}{name}")
+        lines.append(f"import time: {len(self.entries)} modules imported in {sum(e[3] for e in self.entries if not e[0]):.3f} seconds")
+        sys.stderr.write("".join(f"{line}\n" for line in lines))
+        sys.stderr.flush()
+
+
+def install():
+    """Starts measuring the imports, and reports them when the command exits."""
+    profiler = ImportProfiler()
+    sys.meta_path.insert(0, profiler)
+    atexit.register(profiler.report)
+    return profiler
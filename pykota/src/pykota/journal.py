@@ -0,0 +1,175 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+
+"""This module defines a write-behind journal for the job history.
+
+When enabled, cupspykota appends each job history record to a journal
+file instead of inserting it into the database while the user's quota
+is being updated. The journal's content is later flushed to the database
+in batches. Each record is written on a single line and fsync()ed, so
+a crash can at worst leave a truncated last line, which is ignored.
+Before being replayed, records are moved to a second file, so that
+jobs can be journalled while the database is being written to.
+"""
+
+import os
+import json
+import fcntl
+
+JOURNALBATCHSIZE = 250  # number of history records inserted at once
+
+
+class PyKotaJournalError(Exception):
+    """An exception for history journal related stuff."""
+
+    def __init__(self, message=""):
+        self.message = message
+        Exception.__init__(self, message)
+
+    def __repr__(self):
+        return self.message
+
+    __str__ = __repr__
+
+
+class HistoryJournal:
+    """A crash safe, append only, journal of job history records."""
+
+    def __init__(self, tool, filename, batchsize=JOURNALBATCHSIZE):
+        """Initializes the journal."""
+        self.tool = tool
+        self.filename = filename
+        self.replayname = f"{filename}.replay"
+        self.batchsize = batchsize
+
+    def append(self, record):
+        """Appends a record to the journal and waits for it to be on disk."""
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        try:
+            fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        except OSError as msg:
+            raise PyKotaJournalError(f"Impossible to open history journal {self.filename} : {msg}")
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            os.write(fd, line.encode("UTF-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)  # also releases the lock
+        self.tool.logdebug(f"Job {record.get('jobid')} on printer {record.get('printername')} journalled.")
+
+    def isEmpty(self):
+        """Returns True if there's nothing to flush."""
+        for filename in (self.filename, self.replayname):
+            try:
+                if os.path.getsize(filename):
+                    return False
+            except OSError:
+                pass
+        return True
+
+    def readRecords(self, journal):
+        """Returns the list of complete records from an opened journal."""
+        records = []
+        journal.seek(0)
+        for line in journal:
+            if not line.endswith(b"\n"):
+                # torn write, the job was not fully journalled before a crash
+                self.tool.logdebug(f"Ignoring incomplete last record in {journal.name}")
+                break
+            try:
+                records.append(json.loads(line.decode("UTF-8")))
+            except ValueError:
+                self.tool.printInfo(f"Ignoring corrupted record in history journal {journal.name}", "warn")
+        return records
+
+    def lastRecord(self, printername):
+        """Returns the last record journalled for a printer, or None."""
+        for filename in (self.filename, self.replayname):
+            try:
+                journal = open(filename, "rb")
+            except IOError:
+                continue
+            try:
+                fcntl.lockf(journal, fcntl.LOCK_SH)
+                for record in reversed(self.readRecords(journal)):
+                    if record.get("printername") == printername:
+                        return record
+            finally:
+                journal.close()
+        return None
+
+    def moveRecords(self, replay):
+        """Moves the journalled records at the end of the opened replay file.
+
+           The journal is only locked while its content is copied,
+           so that appending jobs doesn't wait for the database.
+        """
+        try:
+            journal = open(self.filename, "rb+")
+        except FileNotFoundError:
+            return
+        try:
+            fcntl.lockf(journal, fcntl.LOCK_EX)
+            content = journal.read()
+            if content:
+                replay.seek(0, os.SEEK_END)
+                replay.write(content)
+                replay.flush()
+                os.fsync(replay.fileno())
+                # if we crash now, records are replayed twice, which is harmless
+                journal.truncate(0)
+                journal.flush()
+                os.fsync(journal.fileno())
+        finally:
+            journal.close()
+
+    def flush(self, storage):
+        """Replays the journal into the database, then empties it.
+
+           Records are first moved to the replay file, then handed to
+           storage.writeManyJobs() in batches. If anything goes wrong
+           the replay file is left untouched, and since replaying is
+           idempotent the same records can safely be replayed later.
+        """
+        if self.isEmpty():
+            return 0
+        try:
+            replay = os.fdopen(os.open(self.replayname, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o640), "ab+")
+        except OSError as msg:
+            raise PyKotaJournalError(f"Impossible to open history journal {self.replayname} : {msg}")
+        try:
+            fcntl.lockf(replay, fcntl.LOCK_EX)  # only one replay at a time
+            try:
+                self.moveRecords(replay)
+            except IOError as msg:
+                raise PyKotaJournalError(f"Impossible to read history journal {self.filename} : {msg}")
+            records = self.readRecords(replay)
+            for i in range(0, len(records), self.batchsize):
+                storage.writeManyJobs(records[i:i + self.batchsize])
+            replay.truncate(0)
+            replay.flush()
+            os.fsync(replay.fileno())
+        finally:
+            replay.close()
+        self.tool.logdebug(f"{len(records)} records flushed from history journal {self.filename}")
+        return len(records)
@@ -23,10 +23,8 @@
 #
 
 """This module defines base classes used by all logging backends."""
-import os
-# import imp
-from importlib.machinery import SourceFileLoader
-import sys
+
+from pykota.plugins import load_backend
 
 
 class PyKotaLoggingError(Exception):
@@ -45,14 +43,7 @@ class PyKotaLoggingError(Exception):
 def open_logger(backend):
     """Returns the appropriate logger subsystem object."""
     try:
-        # loggingbackend = imp.load_source("loggingbackend",
-        #                                os.path.join(os.path.dirname(__file__),
-        #                                             "loggers",
-        #                                             f"{backend.lower()}.py"))
-        #sys.stderr.write(f"{os.path.join(os.path.dirname(__file__))}/loggers/{backend}\n\n\n\n\n\n")
-        loggingbackend = SourceFileLoader("loggers",
-                                          f"{os.path.join(os.path.dirname(__file__))}/loggers/{backend.lower()}.py").load_module()
-
+        loggingbackend = load_backend("loggers", backend)
     except ImportError:
         raise PyKotaLoggingError(f"Unsupported logging subsystem {backend}")
     else:
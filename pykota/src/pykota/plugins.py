@@ -0,0 +1,54 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+
+"""This module loads PyKota's backends, only when they are first needed.
+
+Accounters, end of job detectors, loggers, reporters and storages live
+in their own subpackages, which only contain the backends listed below.
+A backend is imported the first time it is asked for, so that only the
+modules a command really uses, and the optional modules they need, are
+imported.
+"""
+
+import importlib
+
+BACKENDS = {"accounters": ("hardware", "ink", "software"),
+            "detectors": ("adaptive", "fixed"),
+            "loggers": ("stderr", "system"),
+            "reporters": ("html", "text"),
+            "storages": ("ldapstorage", "mysqlstorage", "pgstorage", "sqlitestorage"),
+            }
+
+
+def load_backend(kind, name):
+    """Returns the module of a backend, importing it if needed.
+
+       Raises ImportError if there's no such backend, or if
+       a module it needs is not installed.
+    """
+    name = name.strip().lower()
+    if name not in BACKENDS.get(kind, ()):
+        raise ImportError(f"No backend named {name} in pykota.{kind}")
+    return importlib.import_module(f"pykota.{kind}.{name}")
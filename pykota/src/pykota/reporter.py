@@ -24,10 +24,10 @@
 
 """This module defines bases classes used by all reporters."""
 
-import os
-import imp
 from datetime import datetime
 
+from pykota.plugins import load_backend
+
 
 class PyKotaReporterError(Exception):
     """An exception for Reporter related stuff."""
@@ -160,10 +160,7 @@ class BaseReporter:
 def openReporter(tool, reporttype, printers, ugnames, isgroup):
     """Returns a reporter instance of the proper reporter."""
     try:
-        reporterbackend = imp.load_source("reporterbackend",
-                                          os.path.join(os.path.dirname(__file__),
-                                                       "reporters",
-                                                       f"{reporttype.lower()}.py"))
+        reporterbackend = load_backend("reporters", reporttype)
     except ImportError:
         raise PyKotaReporterError(f"Unsupported reporter backend {reporttype}")
     else:
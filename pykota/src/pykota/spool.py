@@ -0,0 +1,183 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module spools print jobs' datas while computing their checksum.
+
+Regular files are hard linked when possible, else copied by the kernel
+while another thread computes the checksum. Streams are read into a
+single buffer, which is both written and checksummed without being
+copied, and which can also be written to a pipe at the same time.
+"""
+
+import os
+import stat
+import hashlib
+import threading
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+BUFFERSIZE = 1024 * 1024  # 1 Mb, as large as a pipe's buffer can be on Linux
+
+
+def new_checksum(method):
+    """Returns a new checksum object for the md5, blake2 or xxhash methods.
+
+       All of them produce 32 hexadecimal digits, like MD5 does, so they
+       can be stored in the job history the same way. Without the xxhash
+       module, blake2 is used instead of xxhash.
+    """
+    if method == "xxhash" and xxhash is not None:
+        return xxhash.xxh3_128()
+    elif method in ("blake2", "xxhash"):
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.md5()
+
+
+def checksum_file(fd, checksum):
+    """Feeds a checksum with the content of a file descriptor, returns its size.
+
+       The file descriptor's position is left untouched.
+    """
+    offset = 0
+    buffer = bytearray(BUFFERSIZE)
+    view = memoryview(buffer)
+    while True:
+        nbread = os.preadv(fd, [buffer], offset)
+        if not nbread:
+            break
+        checksum.update(view[:nbread])
+        offset += nbread
+    return offset
+
+
+def copy_file(infd, outfd, size):
+    """Copies size bytes between two file descriptors without reading them ourselves."""
+    copied = 0
+    try:
+        while copied < size:
+            nbcopied = os.copy_file_range(infd, outfd, size - copied)
+            if not nbcopied:
+                break
+            copied += nbcopied
+    except (AttributeError, OSError):  # Python < 3.8, not Linux, or different filesystems
+        while copied < size:
+            nbcopied = os.sendfile(outfd, infd, copied, size - copied)
+            if not nbcopied:
+                break
+            copied += nbcopied
+    return copied
+
+
+def link_file(inputfilename, datafilename, checksum):
+    """Hard links a file to datafilename and feeds a checksum with it.
+
+       Both names then designate the same file, so this must only be
+       used when nothing will modify datafilename.
+       Returns its size, or None if it can't be linked.
+    """
+    try:
+        os.link(inputfilename, datafilename)
+    except OSError:
+        return None  # different filesystems, or not allowed
+    with open(datafilename, "rb") as infile:
+        return checksum_file(infile.fileno(), checksum)
+
+
+def spool_file(infile, outfile, checksum):
+    """Copies a binary file object into another one and feeds a checksum with it.
+
+       The kernel copies regular files while another thread computes
+       the checksum, whose errors are raised here once the copy is done.
+       Returns the number of bytes copied.
+    """
+    if not stat.S_ISREG(os.fstat(infile.fileno()).st_mode):
+        return spool_stream(infile, outfile, checksum)
+    outfile.flush()
+    size = os.fstat(infile.fileno()).st_size
+    errors = []
+
+    def hash_file():
+        """Computes the checksum, keeping any error for the caller."""
+        try:
+            checksum_file(infile.fileno(), checksum)
+        except Exception as error:
+            errors.append(error)
+
+    hashing = threading.Thread(target=hash_file)
+    hashing.start()
+    try:
+        size = copy_file(infile.fileno(), outfile.fileno(), size)
+    finally:
+        hashing.join()
+    if errors:
+        raise errors[0]  # else the checksum would silently be wrong
+    return size
+
+
+def spool_stream(infile, outfile, checksum):
+    """Spools a binary stream into a binary file object and feeds a checksum with it.
+
+       Returns the number of bytes spooled.
+    """
+    size = 0
+    buffer = bytearray(BUFFERSIZE)
+    view = memoryview(buffer)
+    while True:
+        nbread = infile.readinto(buffer)
+        if not nbread:
+            break
+        chunk = view[:nbread]
+        outfile.write(chunk)
+        checksum.update(chunk)
+        size += nbread
+    return size
+
+
+def tee_stream(infile, outfile, pipefd, checksum):
+    """Spools a binary stream like spool_stream() does, writing it to a pipe at the same time.
+
+       Datas are written to the pipe as soon as they are received. If
+       nobody reads the pipe anymore, the rest of the stream is only
+       spooled. Returns the number of bytes spooled.
+    """
+    size = 0
+    buffer = bytearray(BUFFERSIZE)
+    view = memoryview(buffer)
+    while True:
+        nbread = infile.readinto1(buffer)
+        if not nbread:
+            break
+        chunk = view[:nbread]
+        outfile.write(chunk)
+        checksum.update(chunk)
+        size += nbread
+        while (pipefd is not None) and chunk:
+            try:
+                chunk = chunk[os.write(pipefd, chunk):]
+            except BrokenPipeError:
+                pipefd = None
+    return size
@@ -26,9 +26,12 @@
 
 import os
 import sys
-# import imp
+import re
+import time
+import random
 from datetime import datetime
-from importlib.machinery import SourceFileLoader
+
+from pykota.plugins import load_backend
 
 
 class PyKotaStorageError(Exception):
@@ -210,9 +213,14 @@ class StoragePrinter(StorageObject):
                         copies=None, options=None, clienthost=None, jobsizebytes=None, jobmd5sum=None, jobpages=None,
                         jobbilling=None, precomputedsize=None, precomputedprice=None):
         """Adds a job to the printer's history."""
-        self.parent.writeJobNew(self, user, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies,
-                                options, clienthost, jobsizebytes, jobmd5sum, jobpages, jobbilling, precomputedsize,
-                                precomputedprice)
+        if self.parent.historyjournal is not None:
+            self.parent.journalJobNew(self, user, jobid, pagecounter, action, jobsize, jobprice, filename, title,
+                                      copies, options, clienthost, jobsizebytes, jobmd5sum, jobpages, jobbilling,
+                                      precomputedsize, precomputedprice)
+        else:
+            self.parent.writeJobNew(self, user, jobid, pagecounter, action, jobsize, jobprice, filename, title,
+                                    copies, options, clienthost, jobsizebytes, jobmd5sum, jobpages, jobbilling,
+                                    precomputedsize, precomputedprice)
         # TODO : update LastJob object ? Probably not needed.
 
     def addPrinterToGroup(self, printer):
@@ -380,12 +388,12 @@ class StorageUserPQuota(StorageObject):
         """Increase the value of used pages and money."""
         jobprice = self.computeJobPrice(jobsize, inkusage)
         if jobsize:
+            userpquotas = [self] + self.ParentPrintersUserPQuota
+            (balance, counters) = self.parent.chargeJob(userpquotas, jobsize, jobprice)
             if jobprice:
-                self.User.consumeAccountBalance(jobprice)
-            for upq in [self] + self.ParentPrintersUserPQuota:
-                self.parent.increaseUserPQuotaPagesCounters(upq, jobsize)
-                upq.PageCounter = int(upq.PageCounter or 0) + jobsize
-                upq.LifePageCounter = int(upq.LifePageCounter or 0) + jobsize
+                self.User.AccountBalance = balance
+            for upq in userpquotas:
+                (upq.PageCounter, upq.LifePageCounter) = counters[upq.ident]
         return jobprice
 
     def delete(self):
@@ -592,6 +600,69 @@ class StorageBillingCode(StorageObject):
         self.consume(-pages, -price)
 
 
+class StorageStatistics:
+    """Counts and times the queries sent to a storage backend, see --stats."""
+    maxsamples = 10000  # number of durations kept per query template, to compute percentiles
+
+    literals = [(re.compile(r"'(?:[^']|'')*'"), "?"),
+                (re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"), "?"),
+                (re.compile(r"\bNULL\b", re.I), "?"),
+                (re.compile(r"\?(?:\s*,\s*\?)+"), "?, ..."),
+                (re.compile(r"\(\?(?:, \.\.\.)?\)(?:\s*,\s*\(\?(?:, \.\.\.)?\))+"), "(?, ...), ..."),
+                (re.compile(r"\s+"), " "),
+                ]
+
+    def __init__(self):
+        """Initializes the counters."""
+        self.queries = {}  # template -> [count, total duration, rows, max duration, durations]
+        self.cachehits = 0
+        self.cachemisses = 0
+
+    def template(self, query):
+        """Returns the template of a query, its literal values being replaced by '?'."""
+        for (regexp, replacement) in self.literals:
+            query = regexp.sub(replacement, query)
+        return query.strip().rstrip(";")
+
+    def record(self, template, duration, nbrows):
+        """Accounts for a query."""
+        try:
+            counters = self.queries[template]
+        except KeyError:
+            counters = self.queries[template] = [0, 0.0, 0, 0.0, []]
+        counters[0] += 1
+        counters[1] += duration
+        counters[2] += nbrows
+        counters[3] = max(counters[3], duration)
+        samples = counters[4]
+        if len(samples) < self.maxsamples:
+            samples.append(duration)
+        else:
+            # reservoir sampling keeps an unbiased set of durations
+            index = random.randrange(counters[0])
+            if index < self.maxsamples:
+                samples[index] = duration
+
+    def percentile(self, samples, percent):
+        """Returns a percentile of sorted durations."""
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def summary(self, maxtemplates=20):
+        """Returns the statistics as a list of lines, the most time consuming queries first."""
+        nbqueries = sum([counters[0] for counters in self.queries.values()])
+        totaltime = sum([counters[1] for counters in self.queries.values()])
+        lines = [f"Storage : {nbqueries} queries in {totaltime:.3f} seconds, cache {self.cachehits} hits {self.cachemisses} misses"]
+        if self.queries:
+            lines.append(f"{'total':>9} {'count':>7} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'rows':>8}  template")
+            templates = sorted(self.queries.items(), key=lambda item: item[1][1], reverse=True)
+            for (template, (count, total, nbrows, maximum, samples)) in templates[:maxtemplates]:
+                samples = sorted(samples)
+                lines.append(f"{total:9.3f} {count:7d} {total / count:8.4f} {self.percentile(samples, 50):8.4f} {self.percentile(samples, 95):8.4f} {self.percentile(samples, 99):8.4f} {maximum:8.4f} {nbrows:8d}  {template[:200]}")
+            if len(templates) > maxtemplates:
+                lines.append(f"... and {len(templates) - maxtemplates} other query templates")
+        return lines
+
+
 class BaseStorage:
     def __init__(self, pykotatool):
         """Opens the storage connection."""
@@ -600,6 +671,8 @@ class BaseStorage:
         self.usecache = pykotatool.config.get_caching()
         self.disablehistory = pykotatool.config.get_disable_history()
         self.privacy = pykotatool.config.get_privacy()
+        self.statistics = StorageStatistics()
+        self.slowquery = pykotatool.config.get_slow_query()
         if self.privacy:
             pykotatool.logdebug("Jobs' title, filename and options will be hidden because of privacy concerns.")
         if self.usecache:
@@ -612,6 +685,17 @@ class BaseStorage:
                            "JOBS": {},
                            "LASTJOBS": {},
                            "BILLINGCODES": {}}
+        self.historyjournal = None
+        journalname = pykotatool.config.get_history_journal()
+        if journalname is not None:
+            if self.disablehistory:
+                self.tool.logdebug("Job history is disabled, history journal won't be used.")
+            elif not hasattr(self, "writeManyJobs"):
+                self.tool.logdebug("History journal is not supported by this storage backend.")
+            else:
+                from pykota.journal import HistoryJournal
+                self.historyjournal = HistoryJournal(self.tool, journalname)
+                self.tool.logdebug(f"Job history will be written behind through {journalname}")
 
     def close(self):
         """Must be overriden in children classes."""
@@ -621,13 +705,35 @@ class BaseStorage:
         """Ensures that the database connection is closed."""
         self.close()
 
+    def recordQuery(self, query, duration, nbrows=0):
+        """Accounts for a query which lasted duration seconds, and logs it if it was too slow."""
+        template = self.statistics.template(query)
+        self.statistics.record(template, duration, nbrows)
+        if (self.slowquery is not None) and (duration >= self.slowquery):
+            self.tool.logger.log_message(f"Slow storage query ({duration:.3f} seconds) : {template}", "warn")
+
+    def reportStatistics(self):
+        """Reports the storage statistics when the connection is closed.
+
+           They are written to stderr with --stats, else logged in debug mode.
+        """
+        if getattr(self.tool, "showstats", False):
+            for line in self.statistics.summary():
+                sys.stderr.write(f"{line}\n")
+            sys.stderr.flush()
+        else:
+            for line in self.statistics.summary():
+                self.tool.logdebug(line)
+
     def getFromCache(self, cachetype, key):
         """Tries to extract something from the cache."""
         if self.usecache:
             entry = self.caches[cachetype].get(key)
             if entry is not None:
+                self.statistics.cachehits += 1
                 self.tool.logdebug(f"Cache hit ({cachetype}->{key})")
             else:
+                self.statistics.cachemisses += 1
                 self.tool.logdebug(f"Cache miss ({cachetype}->{key})")
             return entry
 
@@ -647,6 +753,13 @@ class BaseStorage:
             else:
                 self.tool.logdebug(f"Cache flush ({cachetype}->{key})")
 
+    def flushCaches(self):
+        """Empties the caches."""
+        if self.usecache:
+            for cache in self.caches.values():
+                cache.clear()
+            self.tool.logdebug("Caches flushed.")
+
     def getUser(self, username):
         """Returns the user from cache."""
         user = self.getFromCache("USERS", username)
@@ -693,7 +806,15 @@ class BaseStorage:
         """Extracts last job information for a given printer from cache."""
         lastjob = self.getFromCache("LASTJOBS", printer.Name)
         if lastjob is None:
-            lastjob = self.getPrinterLastJobFromBackend(printer)
+            record = None
+            if self.historyjournal is not None:
+                # the last job may still be in the journal, not yet in the database
+                record = self.historyjournal.lastRecord(printer.Name)
+            if record is not None:
+                record = dict(record, jobdate=self.journalDateToDatabase(record["jobdate"]))
+                lastjob = self.storageLastJobFromRecord(printer, record)
+            else:
+                lastjob = self.getPrinterLastJobFromBackend(printer)
             self.cacheEntry("LASTJOBS", printer.Name, lastjob)
         return lastjob
 
@@ -709,10 +830,12 @@ class BaseStorage:
         """Extracts parent printers information for a given printer from cache."""
         if self.usecache:
             if not hasattr(printer, "Parents"):
+                self.statistics.cachemisses += 1
                 self.tool.logdebug(f"Cache miss ({printer.Name}->Parents)")
                 printer.Parents = self.getParentPrintersFromBackend(printer)
                 self.tool.logdebug(f"Cache store ({printer.Name}->Parents)")
             else:
+                self.statistics.cachehits += 1
                 self.tool.logdebug(f"Cache hit ({printer.Name}->Parents)")
         else:
             printer.Parents = self.getParentPrintersFromBackend(printer)
@@ -728,10 +851,12 @@ class BaseStorage:
         """Returns the group's members list from in-group cache."""
         if self.usecache:
             if not hasattr(group, "Members"):
+                self.statistics.cachemisses += 1
                 self.tool.logdebug(f"Cache miss ({group.Name}->Members)")
                 group.Members = self.getGroupMembersFromBackend(group)
                 self.tool.logdebug(f"Cache store ({group.Name}->Members)")
             else:
+                self.statistics.cachehits += 1
                 self.tool.logdebug(f"Cache hit ({group.Name}->Members)")
         else:
             group.Members = self.getGroupMembersFromBackend(group)
@@ -741,10 +866,12 @@ class BaseStorage:
         """Returns the user's groups list from in-user cache."""
         if self.usecache:
             if not hasattr(user, "Groups"):
+                self.statistics.cachemisses += 1
                 self.tool.logdebug(f"Cache miss ({user.Name}->Groups)")
                 user.Groups = self.getUserGroupsFromBackend(user)
                 self.tool.logdebug(f"Cache store ({user.Name}->Groups)")
             else:
+                self.statistics.cachehits += 1
                 self.tool.logdebug(f"Cache hit ({user.Name}->Groups)")
         else:
             user.Groups = self.getUserGroupsFromBackend(user)
@@ -768,6 +895,52 @@ class BaseStorage:
                 gpquotas.append(gpq)
         return gpquotas
 
+    def journalJobNew(self, printer, user, jobid, pagecounter, action, jobsize=None, jobprice=None, filename=None,
+                      title=None, copies=None, options=None, clienthost=None, jobsizebytes=None, jobmd5sum=None,
+                      jobpages=None, jobbilling=None, precomputedsize=None, precomputedprice=None):
+        """Appends a job to the history journal, to be written later by writeManyJobs()."""
+        if self.privacy:
+            # For legal reasons, we want to hide the title, filename and options
+            title = filename = options = "hidden"
+        self.historyjournal.append({"printerid": printer.ident,
+                                    "printername": printer.Name,
+                                    "userid": user.ident,
+                                    "username": user.Name,
+                                    "jobid": jobid,
+                                    "pagecounter": pagecounter,
+                                    "action": action,
+                                    "jobsize": jobsize,
+                                    "jobprice": jobprice,
+                                    "filename": self.userCharsetToDatabase(filename),
+                                    "title": self.userCharsetToDatabase(title),
+                                    "copies": copies,
+                                    "options": self.userCharsetToDatabase(options),
+                                    "hostname": clienthost,
+                                    "jobsizebytes": jobsizebytes,
+                                    "md5sum": jobmd5sum,
+                                    "pages": jobpages,
+                                    "billingcode": self.userCharsetToDatabase(jobbilling),
+                                    "precomputedjobsize": precomputedsize,
+                                    "precomputedjobprice": precomputedprice,
+                                    "jobdate": time.time()})
+        self.flushEntry("LASTJOBS", printer.Name)
+
+    def flushHistoryJournal(self):
+        """Writes the journalled jobs into the database, if any.
+
+           Failures are only logged : the journal is kept intact
+           and will be replayed the next time. MUST NOT be called from
+           within a transaction, since the jobs are written in their own.
+        """
+        if (self.historyjournal is None) or self.historyjournal.isEmpty():
+            return 0
+        from pykota.journal import PyKotaJournalError
+        try:
+            return self.historyjournal.flush(self)
+        except (PyKotaJournalError, PyKotaStorageError) as msg:
+            self.tool.printInfo(f"Impossible to flush the history journal : {msg}", "warn")
+            return 0
+
     def databaseToUserCharset(self, text):
         """Converts from database format (UTF-8) to user's charset."""
         return self.tool.UTF8ToUserCharset(text)
@@ -877,18 +1050,57 @@ class BaseStorage:
         return (start, end)
 
 
+class ReadOnlyStorage:
+    """Mixin for the connections to a read-only replica of the storage server.
+
+       Writes are rejected before reaching the replica.
+    """
+
+    def rejectWrite(self, *args, **kwargs):
+        """Refuses to modify the datas."""
+        raise PyKotaStorageError("Datas can't be modified through a read-only replica of the storage server.")
+
+    doModify = insertManyRecords = chargeJob = prepareHistoryPartition = archiveHistoryMonth = rejectWrite
+
+
+def openReplica(pykotatool, storagebackend, database, user, passwd):
+    """Returns a read-only connection to an up to date replica of the storage server, or None."""
+    replicas = pykotatool.config.get_storage_replicas()
+    if not replicas:
+        return None
+    if not hasattr(storagebackend.Storage, "replicationLag"):
+        pykotatool.logdebug("Replicas are not supported by this storage backend, the storage server will be used.")
+        return None
+    maxlag = pykotatool.config.get_storage_replica_max_lag()
+    storageclass = type("ReadOnlyStorage", (ReadOnlyStorage, storagebackend.Storage), {})
+    replicas = random.sample(replicas, len(replicas))  # spreads the load, without shuffling the cached list
+    for replica in replicas:
+        try:
+            storage = storageclass(pykotatool, replica, database, user, passwd)
+        except Exception as msg:  # each database module has its own errors
+            pykotatool.logdebug(f"Replica {replica} is unavailable : {msg}")
+            continue
+        try:
+            lag = storage.replicationLag()
+        except PyKotaStorageError as msg:
+            pykotatool.logdebug(f"Impossible to know how far replica {replica} lags behind : {msg}")
+            lag = None
+        if (lag is not None) and (lag <= maxlag):
+            pykotatool.logdebug(f"Using replica {replica}, {lag:.1f} seconds behind the storage server.")
+            storage.historyjournal = None  # the journal is flushed by the writers
+            return storage
+        pykotatool.logdebug(f"Replica {replica} lags too far behind the storage server.")
+        storage.close()
+    pykotatool.logdebug("No replica is up to date, the storage server will be used.")
+    return None
+
+
 def openConnection(pykotatool: object) -> object:
     """Returns a connection handle to the appropriate database."""
     backendinfo = pykotatool.config.get_storage_backend()
     backend = backendinfo["storagebackend"]
     try:
-        # storagebackend = imp.load_source("storagebackend",
-        #                                 os.path.join(os.path.dirname(__file__),
-        #                                              "storages",
-        #                                              "%s.py" % backend.lower()))
-        storagebackend = SourceFileLoader("storagebackend",
-                                          f"{os.path.join(os.path.dirname(__file__))}/storages/{backend.lower()}.py").load_module()
-        #sys.stdout.write('moduco importado')
+        storagebackend = load_backend("storages", backend)
     except ImportError:
         raise PyKotaStorageError(f"Unsupported quota storage backend {backend}")
     else:
@@ -897,4 +1109,8 @@ def openConnection(pykotatool: object) -> object:
         admin = backendinfo["storageadmin"] or backendinfo["storageuser"]
         adminpw = backendinfo["storageadminpw"] or backendinfo["storageuserpw"]
         #sys.stderr.write(f"({pykotatool.config.get_storage_backend},{host}, {database}, {admin}, {adminpw})")
+        if getattr(pykotatool, "readonlystorage", False):
+            replica = openReplica(pykotatool, storagebackend, database, admin, adminpw)
+            if replica is not None:
+                return replica
         return storagebackend.Storage(pykotatool, host, database, admin, adminpw)
@@ -30,13 +30,14 @@ is 16868. Use this as a base to extend the LDAP schema.
 """
 
 import sys
-import types
+import re
 import time
 # import md5
 import base64
 import random
 
 from datetime import datetime
+from collections import OrderedDict
 
 from pykota.storage import PyKotaStorageError, BaseStorage, \
     StorageUser, StorageGroup, StoragePrinter, \
@@ -46,6 +47,7 @@ from pykota.storage import PyKotaStorageError, BaseStorage, \
 try:
     import ldap
     import ldap.modlist
+    from ldap.controls import SimplePagedResultsControl
 except ImportError:
     raise PyKotaStorageError(
         f"This python version ({sys.version.split()[0]}) doesn't seem to have the python-ldap module installed correctly.")
@@ -62,6 +64,138 @@ else:
         class cidict(UserDict.UserDict):
             pass  # Fake it all, and don't care for case insensitivity : users who need it will have to upgrade.
 
+    try:
+        from ldap.controls.sss import SSSRequestControl
+    except ImportError:
+        SSSRequestControl = None  # too old python-ldap : no server side sorting
+
+
+class LDAPCache:
+    """A bounded, least recently used, cache of LDAP entries and search results.
+
+       Entries expire after a lifetime depending on their objectClass.
+       Search results are stored as lists of DNs, and are only served
+       if all their entries are still cached. Writing to an entry
+       invalidates the results of all searches made from one of its
+       ancestors, since the entry may now match or not.
+    """
+
+    def __init__(self, tool, maxentries, ttls):
+        """Initializes an empty cache."""
+        self.tool = tool
+        self.maxentries = maxentries
+        self.ttls = ttls
+        self.entries = OrderedDict()  # dn => (expiration time, attributes)
+        self.searches = OrderedDict()  # (base, scope, filter, attributes) => (expiration time, [dn, ...])
+        self.hits = 0
+        self.misses = 0
+
+    def lifetime(self, attributes):
+        """Returns the lifetime of an entry, the shortest one of its object classes."""
+        default = self.ttls.get("*", 0)
+        return min([self.ttls.get(oc.lower(), default) for oc in attributes.get("objectClass", [])] or [default])
+
+    def evict(self, cache):
+        """Removes the least recently used items from a cache above its maximal size."""
+        while len(cache) > self.maxentries:
+            cache.popitem(last=False)
+
+    def lookup(self, cache, key):
+        """Returns a cached value, or None if it's missing or expired."""
+        item = cache.get(key)
+        if item is not None:
+            if item[0] >= time.time():
+                cache.move_to_end(key)
+                return item[1]
+            del cache[key]
+        return None
+
+    def getEntry(self, dn):
+        """Returns a cached entry's attributes, or None."""
+        attributes = self.lookup(self.entries, dn)
+        if attributes is None:
+            self.misses += 1
+            self.tool.logdebug(f"LDAP cache miss {dn}")
+        else:
+            self.hits += 1
+            self.tool.logdebug(f"LDAP cache hit {dn} => {attributes}")
+        return attributes
+
+    def storeEntry(self, dn, attributes):
+        """Caches an entry, if its object classes can be cached."""
+        lifetime = self.lifetime(attributes)
+        if lifetime > 0:
+            self.tool.logdebug(f"LDAP cache store {dn} => {attributes}")
+            self.entries[dn] = (time.time() + lifetime, attributes)
+            self.entries.move_to_end(dn)
+            self.evict(self.entries)
+        return lifetime
+
+    def getSearch(self, key):
+        """Returns a cached search result, or None."""
+        dns = self.lookup(self.searches, key)
+        if dns is not None:
+            result = []
+            for dn in dns:
+                attributes = self.lookup(self.entries, dn)
+                if attributes is None:
+                    del self.searches[key]  # an entry expired or was evicted
+                    break
+                result.append((dn, attributes))
+            else:
+                self.hits += 1
+                self.tool.logdebug(f"LDAP cache hit {key}")
+                return result
+        self.misses += 1
+        self.tool.logdebug(f"LDAP cache miss {key}")
+        return None
+
+    def storeSearch(self, key, result):
+        """Caches a search result and the entries it contains."""
+        lifetimes = [self.storeEntry(dn, attributes) for (dn, attributes) in result]
+        lifetime = min(lifetimes or [self.ttls.get("*", 0)])
+        if lifetime > 0:
+            self.searches[key] = (time.time() + lifetime, [dn for (dn, attributes) in result])
+            self.evict(self.searches)
+
+    def invalidateSearches(self, dn):
+        """Forgets the results of the searches which may have changed because dn was written."""
+        dn = dn.lower()
+        for key in [key for key in self.searches.keys() if dn.endswith(key[0].lower())]:
+            del self.searches[key]
+
+    def clear(self):
+        """Forgets all the entries and search results."""
+        self.entries.clear()
+        self.searches.clear()
+        self.tool.logdebug("LDAP cache cleared.")
+
+    def invalidate(self, dn):
+        """Forgets an entry and all the search results it may be part of."""
+        self.entries.pop(dn, None)
+        self.invalidateSearches(dn)
+        self.tool.logdebug(f"LDAP cache del {dn}")
+
+    def updateEntry(self, dn, modlist):
+        """Applies a modification list to a cached entry."""
+        self.invalidateSearches(dn)
+        attributes = self.lookup(self.entries, dn)
+        if attributes is not None:
+            for (mop, mtyp, mval) in modlist:
+                if mop in (ldap.MOD_ADD, ldap.MOD_REPLACE):
+                    attributes[mtyp] = mval
+                elif mop == ldap.MOD_DELETE:
+                    attributes.pop(mtyp, None)
+                else:
+                    del self.entries[dn]  # new values are only known to the server
+                    break
+            else:
+                self.tool.logdebug(f"LDAP cache update {dn} => {attributes}")
+
+    def statistics(self):
+        """Returns a string describing the cache's usage."""
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} entries, {len(self.searches)} searches"
+
 
 class Storage(BaseStorage):
     def __init__(self, pykotatool, host, dbname, user, passwd):
@@ -74,6 +208,8 @@ class Storage(BaseStorage):
         self.saveddbname = dbname
         self.saveduser = user
         self.savedpasswd = passwd
+        self.pipeline = None  # outstanding asynchronous writes, when pipelining
+        self.pipelineerrors = []
         self.secondStageInit()
 
     def secondStageInit(self):
@@ -105,9 +241,12 @@ class Storage(BaseStorage):
                 time.sleep(2)
             else:
                 self.useldapcache = self.tool.config.get_ldap_cache()
-                if self.useldapcache:
+                if self.useldapcache and (getattr(self, "ldapcache", None) is None):
                     self.tool.logdebug("Low-Level LDAP Caching enabled.")
-                    self.ldapcache = {}  # low-level cache specific to LDAP backend
+                    # low-level cache specific to LDAP backend, kept when reconnecting
+                    self.ldapcache = LDAPCache(self.tool,
+                                               self.tool.config.get_ldap_cache_size(),
+                                               self.tool.config.get_ldap_cache_ttls())
                 self.closed = 0
                 self.tool.logdebug(
                     f"Database opened (host={self.savedhost}, dbname={self.saveddbname}, user={self.saveduser})")
@@ -116,10 +255,21 @@ class Storage(BaseStorage):
 
     def close(self):
         """Closes the database connection."""
+        if self.pipeline:
+            self.flushPipeline()
         if not self.closed:
             self.database.unbind_s()
             self.closed = 1
             self.tool.logdebug("Database closed.")
+            if self.useldapcache:
+                self.tool.logdebug(f"LDAP cache : {self.ldapcache.statistics()}")
+            self.reportStatistics()
+
+    def flushCaches(self):
+        """Empties the caches, the LDAP cache included."""
+        BaseStorage.flushCaches(self)
+        if self.useldapcache:
+            self.ldapcache.clear()
 
     def genUUID(self):
         """Generates an unique identifier.
@@ -130,8 +280,8 @@ class Storage(BaseStorage):
 
     def normalizeFields(self, fields):
         """Ensure all items are lists."""
-        for (k, v) in fields.items():
-            if type(v) not in (types.TupleType, types.ListType):
+        for (k, v) in list(fields.items()):
+            if not isinstance(v, (tuple, list)):
                 if not v:
                     del fields[k]
                 else:
@@ -139,24 +289,185 @@ class Storage(BaseStorage):
         return fields
 
     def beginTransaction(self):
-        """Starts a transaction."""
+        """Starts a transaction.
+
+           There are no transactions in LDAP, but if ldappipeline is set
+           writes are sent asynchronously until the transaction ends.
+        """
         self.tool.logdebug("Transaction begins... WARNING : No transactions in LDAP !")
+        if self.info["ldappipeline"] and (self.pipeline is None):
+            self.pipeline = []
+            self.pipelineerrors = []
+            self.tool.logdebug(f"LDAP writes pipelined, up to {self.info['ldappipeline']} outstanding operations.")
 
     def commitTransaction(self):
         """Commits a transaction."""
+        errors = self.endPipeline()
         self.tool.logdebug("Transaction committed. WARNING : No transactions in LDAP !")
+        if errors:
+            raise PyKotaStorageError("%i LDAP write(s) failed : %s"
+                                     % (len(errors), " ; ".join([f"{operation}({dn}) : {msg}"
+                                                                 for (operation, dn, msg) in errors])))
 
     def rollbackTransaction(self):
         """Rollbacks a transaction."""
+        for (operation, dn, msg) in self.endPipeline():
+            self.tool.printInfo(f"LDAP error : {operation}({dn}) : {msg}", "error")
         self.tool.logdebug("Transaction aborted. WARNING : No transaction in LDAP !")
 
+    def endPipeline(self):
+        """Waits for all outstanding writes and leaves pipelined mode.
+
+           Returns the list of (operation, dn, message) for failed writes.
+        """
+        if self.pipeline is None:
+            return []
+        self.flushPipeline()
+        errors = self.pipelineerrors
+        (self.pipeline, self.pipelineerrors) = (None, [])
+        return errors
+
+    def flushPipeline(self):
+        """Waits for all outstanding asynchronous writes to complete."""
+        if self.pipeline:
+            self.tool.logdebug(f"Waiting for {len(self.pipeline)} outstanding LDAP writes...")
+            while self.pipeline:
+                self.waitForOldestOperation()
+
+    def waitForOldestOperation(self):
+        """Waits for the result of the oldest outstanding write, recording any error."""
+        (msgid, operation, dn, args) = self.pipeline.pop(0)
+        try:
+            self.database.result3(msgid)
+        except ldap.NO_SUCH_OBJECT as msg:
+            if operation == "delete":
+                self.tool.printInfo(f"Entry {dn} was already missing before we deleted it. This **MAY** be normal.",
+                                    "info")
+            else:
+                self.pipelineerrors.append((operation, dn, str(msg)))
+        except ldap.NO_SUCH_ATTRIBUTE as msg:
+            if operation == "modify":
+                # a counter to increment is absent from the entry
+                self.replaceIncrements(dn, args[0])
+            else:
+                self.pipelineerrors.append((operation, dn, str(msg)))
+        except ldap.SERVER_DOWN as msg:
+            self.pipelineerrors.append((operation, dn, str(msg)))
+            self.abortPipeline(msg)
+        except ldap.LDAPError as msg:
+            self.pipelineerrors.append((operation, dn, str(msg)))
+
+    def abortPipeline(self, reason):
+        """Marks all outstanding writes as failed and reopens the connection."""
+        for (msgid, operation, dn, args) in self.pipeline:
+            self.pipelineerrors.append((operation, dn, f"aborted : {reason}"))
+        self.pipeline = []
+        self.tool.printInfo(f"LDAP error : {reason}", "error")
+        self.tool.printInfo("LDAP connection will be closed and reopened.", "warn")
+        self.close()
+        self.secondStageInit()
+
+    def pipelineOperation(self, operation, dn, *args):
+        """Sends an asynchronous write, once less than ldappipeline writes are outstanding."""
+        while len(self.pipeline) >= self.info["ldappipeline"]:
+            self.waitForOldestOperation()
+        self.tool.logdebug(f"QUERY : Asynchronous {operation}({dn}, {args})")
+        try:
+            msgid = getattr(self.database, operation)(dn, *args)
+        except ldap.LDAPError as msg:
+            self.pipelineerrors.append((operation, dn, str(msg)))
+            self.abortPipeline(msg)
+        else:
+            self.pipeline.append((msgid, operation, dn, args))
+
+    def replaceIncrements(self, dn, modlist):
+        """Applies a modification list at once, its increments being replaced by the new values.
+
+           Used when an increment was refused because the attribute was absent,
+           which is then considered to be 0, as doModify() does.
+        """
+        self.tool.logdebug(f"Increment refused by {dn}, reading it to replace the values instead.")
+        try:
+            before = time.time()
+            entry = cidict(self.database.search_s(dn, ldap.SCOPE_BASE)[0][1])
+            self.recordQuery(self.queryTemplate("SEARCH", dn), time.time() - before, 1)
+            modentry = []
+            for (mop, mtyp, mval) in modlist:
+                if mop == ldap.MOD_INCREMENT:
+                    try:
+                        oldvalue = int(entry.get(mtyp, [0])[0])
+                    except ValueError:
+                        self.tool.logdebug(f"Error converting {entry.get(mtyp)} for {mtyp}")
+                        oldvalue = 0
+                    modentry.append((ldap.MOD_REPLACE, mtyp, [str(oldvalue + int(mval[0]))]))
+                else:
+                    modentry.append((mop, mtyp, mval))
+            before = time.time()
+            self.database.modify_s(dn, modentry)
+            self.recordQuery(self.queryTemplate("MODIFY", dn), time.time() - before, 1)
+        except ldap.LDAPError as msg:
+            self.pipelineerrors.append(("modify", dn, str(msg)))
+        else:
+            if self.useldapcache:
+                self.ldapcache.updateEntry(dn, modentry)
+
+    def blindModlist(self, fields):
+        """Returns a modlist which doesn't need the entry's current content, or None.
+
+           Values are replaced, and integer counters increased with the
+           increment extension (RFC 4525). As with modifyModlist() ignoring
+           old attributes, empty values leave the attribute untouched.
+        """
+        modlist = []
+        for (k, v) in fields.items():
+            if type(v) == type({}):
+                if v["convert"] is not int:
+                    return None  # only integers can be incremented
+                if v["operator"] == '+':
+                    modlist.append((ldap.MOD_INCREMENT, k, [str(v["value"])]))
+                else:
+                    modlist.append((ldap.MOD_INCREMENT, k, [str(-v["value"])]))
+            elif k.lower() != "createtimestamp":
+                values = self.normalizeFields({k: v}).get(k)
+                if values:
+                    modlist.append((ldap.MOD_REPLACE, k, values))
+        return modlist
+
+    def queryTemplate(self, operation, dn, scope=ldap.SCOPE_BASE, key=None):
+        """Returns the template of an LDAP operation, for the storage statistics.
+
+           The values of the entry's RDN and of the search filter are
+           replaced by '?'.
+        """
+        if scope == ldap.SCOPE_BASE:
+            dn = re.sub(r"^([^=,]+)=[^,]*", r"\1=?", dn)
+        template = f"{operation} {dn}"
+        if key is not None:
+            scope = {ldap.SCOPE_BASE: "base", ldap.SCOPE_ONELEVEL: "one", ldap.SCOPE_SUBTREE: "sub"}.get(scope, scope)
+            key = re.sub(r"=[^()=&|!]+\)", "=?)", key)
+            template += f" scope={scope} filter={key}"
+        return template
+
     def doSearch(self, key, fields=None, base="", scope=ldap.SCOPE_SUBTREE, flushcache=0):
         """Does an LDAP search query."""
+        if self.pipeline:
+            self.flushPipeline()  # the server may process operations out of order
         message = ""
         for tryit in range(3):
             try:
                 base = base or self.basedn
+                result = None
                 if self.useldapcache:
+                    cachekey = (base, scope, key, tuple(fields or ()))
+                    if not flushcache:
+                        if scope == ldap.SCOPE_BASE:
+                            entry = self.ldapcache.getEntry(base)
+                            if entry is not None:
+                                result = [(base, entry)]
+                        else:
+                            result = self.ldapcache.getSearch(cachekey)
+                    if result is not None:
+                        return result
                     # Here we overwrite the fields the app want, to try and
                     # retrieve ALL user defined attributes ("*")
                     # + the createTimestamp attribute, needed by job history
@@ -166,15 +477,11 @@ class Storage(BaseStorage):
                     # and iPlanet Directory Server (5.1 SP3)
                     fields = ["*", "createTimestamp"]
 
-                if self.useldapcache and (not flushcache) and (scope == ldap.SCOPE_BASE) and self.ldapcache.has_key(
-                        base):
-                    entry = self.ldapcache[base]
-                    self.tool.logdebug(f"LDAP cache hit {base} => {entry}")
-                    result = [(base, entry)]
-                else:
-                    self.tool.logdebug(
-                        f"QUERY : Filter : {key}, BaseDN : {base}, Scope : {scope}, Attributes : {fields}")
-                    result = self.database.search_s(base, scope, key, fields)
+                self.tool.logdebug(
+                    f"QUERY : Filter : {key}, BaseDN : {base}, Scope : {scope}, Attributes : {fields}")
+                before = time.time()
+                result = self.database.search_s(base, scope, key, fields)
+                self.recordQuery(self.queryTemplate("SEARCH", base, scope, key), time.time() - before, len(result))
             except ldap.NO_SUCH_OBJECT as msg:
                 raise PyKotaStorageError(
                     f"Search base {base} doesn't seem to exist. Probable misconfiguration. Please double check /etc/pykota/pykota.conf : {msg}")
@@ -189,23 +496,105 @@ class Storage(BaseStorage):
             else:
                 self.tool.logdebug(f"QUERY : Result : {result}")
                 result = [(dn, cidict(attrs)) for (dn, attrs) in result]
+                if self.useldapcache:
+                    if scope == ldap.SCOPE_BASE:
+                        for (dn, attributes) in result:
+                            self.ldapcache.storeEntry(dn, attributes)
+                    else:
+                        self.ldapcache.storeSearch(cachekey, result)
+                return result
+        raise PyKotaStorageError(message)
+
+    def doPagedSearch(self, key, fields=None, base="", scope=ldap.SCOPE_SUBTREE, sortkeys=None, limit=None):
+        """Does an LDAP search query, retrieving the results by pages (RFC 2696).
+
+           If sortkeys is set and server side sorting (RFC 2891) is enabled,
+           entries come back sorted and we stop as soon as limit entries
+           were received. Otherwise all matching entries are returned.
+        """
+        pagesize = self.info["ldappagesize"]
+        if not pagesize:
+            return self.doSearch(key, fields, base, scope)
+        serversort = sortkeys and self.info["ldapserversort"] and (SSSRequestControl is not None)
+        if not serversort:
+            limit = None
+        elif limit:
+            pagesize = min(pagesize, int(limit))
+        if self.useldapcache:
+            fields = ["*", "createTimestamp"]  # see doSearch()
+        if self.pipeline:
+            self.flushPipeline()  # see doSearch()
+        message = ""
+        for tryit in range(3):
+            base = base or self.basedn
+            result = []
+            pagecontrol = SimplePagedResultsControl(True, size=pagesize, cookie="")
+            controls = [pagecontrol]
+            if serversort:
+                controls.append(SSSRequestControl(criticality=True, ordering=sortkeys))
+            try:
+                before = time.time()
+                while True:
+                    self.tool.logdebug(
+                        f"QUERY : Filter : {key}, BaseDN : {base}, Scope : {scope}, Attributes : {fields}, PageSize : {pagecontrol.size}, Sort : {serversort and sortkeys}")
+                    msgid = self.database.search_ext(base, scope, key, fields, serverctrls=controls)
+                    (rtype, rdata, rmsgid, serverctrls) = self.database.result3(msgid)
+                    result.extend([(dn, attrs) for (dn, attrs) in rdata if dn is not None])  # skips referrals
+                    cookie = None
+                    for control in serverctrls:
+                        if control.controlType == SimplePagedResultsControl.controlType:
+                            cookie = control.cookie
+                    if not cookie:
+                        break
+                    pagecontrol.cookie = cookie
+                    if limit and (len(result) >= limit):
+                        # we've got enough, tell the server to abandon the paged search
+                        pagecontrol.size = 0
+                        self.database.result3(self.database.search_ext(base, scope, key, fields, serverctrls=controls))
+                        break
+            except ldap.NO_SUCH_OBJECT as msg:
+                raise PyKotaStorageError(
+                    f"Search base {base} doesn't seem to exist. Probable misconfiguration. Please double check /etc/pykota/pykota.conf : {msg}")
+            except ldap.LDAPError as msg:
+                message = f"Paged search for {key}({fields}) from {base}(scope={scope}) returned no answer. : {msg}"
+                self.tool.printInfo("LDAP error : %s" % message, "error")
+                self.tool.printInfo("LDAP connection will be closed and reopened.", "warn")
+                self.close()
+                self.secondStageInit()
+            else:
+                if limit:
+                    result = result[:limit]
+                self.recordQuery(self.queryTemplate("PAGED SEARCH", base, scope, key), time.time() - before, len(result))
+                self.tool.logdebug(f"QUERY : {len(result)} entries received")
+                result = [(dn, cidict(attrs)) for (dn, attrs) in result]
                 if self.useldapcache:
                     for (dn, attributes) in result:
-                        self.tool.logdebug(f"LDAP cache store {dn} => {attributes}")
-                        self.ldapcache[dn] = attributes
+                        self.ldapcache.storeEntry(dn, attributes)
                 return result
         raise PyKotaStorageError(message)
 
+    def toGeneralizedTime(self, date):
+        """Converts a 'YYYY-mm-dd HH:MM:SS' date to LDAP's GeneralizedTime syntax."""
+        return datetime.strptime(date, "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d%H%M%SZ")
+
     def doAdd(self, dn, fields):
         """Adds an entry in the LDAP directory."""
         fields = self.normalizeFields(cidict(fields))
+        if self.pipeline is not None:
+            self.pipelineOperation("add", dn, ldap.modlist.addModlist(fields))
+            if self.useldapcache:
+                self.ldapcache.invalidate(dn)
+                self.ldapcache.storeEntry(dn, fields)
+            return dn
         message = ""
         for tryit in range(3):
             try:
                 self.tool.logdebug("QUERY : ADD(%s, %s)" % (dn, str(fields)))
                 entry = ldap.modlist.addModlist(fields)
                 self.tool.logdebug("%s" % entry)
+                before = time.time()
                 self.database.add_s(dn, entry)
+                self.recordQuery(self.queryTemplate("ADD", dn), time.time() - before, 1)
             except ldap.ALREADY_EXISTS as msg:
                 raise PyKotaStorageError(f"Entry {dn} already exists : {str(msg)}")
             except ldap.LDAPError as msg:
@@ -216,18 +605,25 @@ class Storage(BaseStorage):
                 self.secondStageInit()
             else:
                 if self.useldapcache:
-                    self.tool.logdebug(f"LDAP cache add {dn} => {fields}")
-                    self.ldapcache[dn] = fields
+                    self.ldapcache.invalidate(dn)
+                    self.ldapcache.storeEntry(dn, fields)
                 return dn
         raise PyKotaStorageError(message)
 
     def doDelete(self, dn):
         """Deletes an entry from the LDAP directory."""
+        if self.pipeline is not None:
+            self.pipelineOperation("delete", dn)
+            if self.useldapcache:
+                self.ldapcache.invalidate(dn)
+            return
         message = ""
         for tryit in range(3):
             try:
                 self.tool.logdebug(f"QUERY : Delete({dn})")
+                before = time.time()
                 self.database.delete_s(dn)
+                self.recordQuery(self.queryTemplate("DELETE", dn), time.time() - before, 1)
             except ldap.NO_SUCH_OBJECT:
                 self.tool.printInfo(f"Entry {dn} was already missing before we deleted it. This **MAY** be normal.",
                                     "info")
@@ -240,34 +636,29 @@ class Storage(BaseStorage):
                 self.secondStageInit()
             else:
                 if self.useldapcache:
-                    try:
-                        self.tool.logdebug("LDAP cache del %s" % dn)
-                        del self.ldapcache[dn]
-                    except KeyError:
-                        pass
+                    self.ldapcache.invalidate(dn)
                 return
         raise PyKotaStorageError(message)
 
     def doModify(self, dn, fields, ignoreold=1, flushcache=0):
         """Modifies an entry in the LDAP directory."""
         fields = cidict(fields)
+        if (self.pipeline is not None) and ignoreold and not flushcache:
+            modentry = self.blindModlist(fields)
+            if modentry is not None:
+                if modentry:
+                    self.pipelineOperation("modify", dn, modentry)
+                if self.useldapcache:
+                    self.ldapcache.updateEntry(dn, modentry)
+                return dn
         for tryit in range(3):
             try:
-                # TODO : take care of, and update LDAP specific cache
-                if self.useldapcache and not flushcache:
-                    if self.ldapcache.has_key(dn):
-                        old = self.ldapcache[dn]
-                        self.tool.logdebug(f"LDAP cache hit {dn} => {old}")
-                        oldentry = {}
-                        for (k, v) in old.items():
-                            if k != "createTimestamp":
-                                oldentry[k] = v
-                    else:
-                        self.tool.logdebug(f"LDAP cache miss {dn}")
-                        oldentry = self.doSearch("objectClass=*", base=dn, scope=ldap.SCOPE_BASE)[0][1]
-                else:
-                    oldentry = self.doSearch("objectClass=*", base=dn, scope=ldap.SCOPE_BASE, flushcache=flushcache)[0][
-                        1]
+                # the LDAP cache, if any, is used unless flushcache is set
+                oldentry = {}
+                for (k, v) in self.doSearch("objectClass=*", base=dn, scope=ldap.SCOPE_BASE,
+                                            flushcache=flushcache)[0][1].items():
+                    if k.lower() != "createtimestamp":
+                        oldentry[k] = v
                 for (k, v) in fields.items():
                     if type(v) == type({}):
                         try:
@@ -289,7 +680,9 @@ class Storage(BaseStorage):
                         modentry.append((mop, mtyp, mval))
                 self.tool.logdebug(f"MODIFY : {fields} ==> {entry} ==> {modentry}")
                 if modentry:
+                    before = time.time()
                     self.database.modify_s(dn, modentry)
+                    self.recordQuery(self.queryTemplate("MODIFY", dn), time.time() - before, 1)
             except ldap.LDAPError as msg:
                 message = (f"Problem modifying LDAP entry ({dn}, {fields})")
                 f" : {str(msg)}"
@@ -299,16 +692,7 @@ class Storage(BaseStorage):
                 self.secondStageInit()
             else:
                 if self.useldapcache:
-                    cachedentry = self.ldapcache[dn]
-                    for (mop, mtyp, mval) in entry:
-                        if mop in (ldap.MOD_ADD, ldap.MOD_REPLACE):
-                            cachedentry[mtyp] = mval
-                        else:
-                            try:
-                                del cachedentry[mtyp]
-                            except KeyError:
-                                pass
-                    self.tool.logdebug(f"LDAP cache update {dn} => {cachedentry}")
+                    self.ldapcache.updateEntry(dn, modentry)
                 return dn
         raise PyKotaStorageError(message)
 
@@ -396,34 +780,7 @@ class Storage(BaseStorage):
                 raise PyKotaStorageError(
                     f"No pykotaAccountBalance object found for user {username}. Did you create LDAP entries manually ?")
             else:
-                fields = result[0][1]
-                user.idbalance = result[0][0]
-                user.AccountBalance = fields.get("pykotaBalance")
-                if user.AccountBalance is not None:
-                    if user.AccountBalance[0].upper() == "NONE":
-                        user.AccountBalance = None
-                    else:
-                        user.AccountBalance = float(user.AccountBalance[0])
-                user.AccountBalance = user.AccountBalance or 0.0
-                user.LifeTimePaid = fields.get("pykotaLifeTimePaid")
-                user.OverCharge = float(fields.get("pykotaOverCharge", [1.0])[0])
-                if user.LifeTimePaid is not None:
-                    if user.LifeTimePaid[0].upper() == "NONE":
-                        user.LifeTimePaid = None
-                    else:
-                        user.LifeTimePaid = float(user.LifeTimePaid[0])
-                user.LifeTimePaid = user.LifeTimePaid or 0.0
-                user.Payments = []
-                for payment in fields.get("pykotaPayments", []):
-                    try:
-                        (date, amount, description) = payment.split(" # ")
-                    except ValueError:
-                        # Payment with no description (old Payment)
-                        (date, amount) = payment.split(" # ")
-                        description = ""
-                    else:
-                        description = self.databaseToUserCharset(base64.decodestring(description))
-                    user.Payments.append((date, float(amount), description))
+                self.setUserBalanceFromEntry(user, result[0][0], result[0][1])
             user.Exists = True
         return user
 
@@ -461,19 +818,8 @@ class Storage(BaseStorage):
                                base=self.info["printerbase"])
         if result:
             fields = result[0][1]  # take only first matching printer, ignore the rest
-            printer.ident = result[0][0]
-            printer.Name = fields.get("pykotaPrinterName", [self.databaseToUserCharset(printername)])[0]
-            printer.PricePerJob = float(fields.get("pykotaPricePerJob", [0.0])[0])
-            printer.PricePerPage = float(fields.get("pykotaPricePerPage", [0.0])[0])
-            printer.MaxJobSize = int(fields.get("pykotaMaxJobSize", [0])[0])
-            printer.PassThrough = fields.get("pykotaPassThrough", [None])[0]
-            if printer.PassThrough in (1, "1", "t", "true", "TRUE", "True"):
-                printer.PassThrough = 1
-            else:
-                printer.PassThrough = 0
-            printer.uniqueMember = fields.get("uniqueMember", [])
-            printer.Description = self.databaseToUserCharset(fields.get("description", [""])[0])
-            printer.Exists = True
+            printer = self.storagePrinterFromEntry(
+                fields.get("pykotaPrinterName", [self.databaseToUserCharset(printername)])[0], result[0][0], fields)
         return printer
 
     def getUserPQuotaFromBackend(self, user, printer):
@@ -490,36 +836,7 @@ class Storage(BaseStorage):
                  "pykotaWarnCount", "pykotaMaxJobSize"],
                 base=base)
             if result:
-                fields = result[0][1]
-                userpquota.ident = result[0][0]
-                userpquota.PageCounter = int(fields.get("pykotaPageCounter", [0])[0])
-                userpquota.LifePageCounter = int(fields.get("pykotaLifePageCounter", [0])[0])
-                userpquota.WarnCount = int(fields.get("pykotaWarnCount", [0])[0])
-                userpquota.SoftLimit = fields.get("pykotaSoftLimit")
-                if userpquota.SoftLimit is not None:
-                    if userpquota.SoftLimit[0].upper() == "NONE":
-                        userpquota.SoftLimit = None
-                    else:
-                        userpquota.SoftLimit = int(userpquota.SoftLimit[0])
-                userpquota.HardLimit = fields.get("pykotaHardLimit")
-                if userpquota.HardLimit is not None:
-                    if userpquota.HardLimit[0].upper() == "NONE":
-                        userpquota.HardLimit = None
-                    elif userpquota.HardLimit is not None:
-                        userpquota.HardLimit = int(userpquota.HardLimit[0])
-                userpquota.DateLimit = fields.get("pykotaDateLimit")
-                if userpquota.DateLimit is not None:
-                    if userpquota.DateLimit[0].upper() == "NONE":
-                        userpquota.DateLimit = None
-                    else:
-                        userpquota.DateLimit = userpquota.DateLimit[0]
-                userpquota.MaxJobSize = fields.get("pykotaMaxJobSize")
-                if userpquota.MaxJobSize is not None:
-                    if userpquota.MaxJobSize[0].upper() == "NONE":
-                        userpquota.MaxJobSize = None
-                    else:
-                        userpquota.MaxJobSize = int(userpquota.MaxJobSize[0])
-                userpquota.Exists = True
+                self.setUserPQuotaFromEntry(userpquota, result[0][0], result[0][1])
         return userpquota
 
     def getGroupPQuotaFromBackend(self, group, printer):
@@ -535,32 +852,7 @@ class Storage(BaseStorage):
                 ["pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit", "pykotaMaxJobSize"], \
                 base=base)
             if result:
-                fields = result[0][1]
-                grouppquota.ident = result[0][0]
-                grouppquota.SoftLimit = fields.get("pykotaSoftLimit")
-                if grouppquota.SoftLimit is not None:
-                    if grouppquota.SoftLimit[0].upper() == "NONE":
-                        grouppquota.SoftLimit = None
-                    else:
-                        grouppquota.SoftLimit = int(grouppquota.SoftLimit[0])
-                grouppquota.HardLimit = fields.get("pykotaHardLimit")
-                if grouppquota.HardLimit is not None:
-                    if grouppquota.HardLimit[0].upper() == "NONE":
-                        grouppquota.HardLimit = None
-                    else:
-                        grouppquota.HardLimit = int(grouppquota.HardLimit[0])
-                grouppquota.DateLimit = fields.get("pykotaDateLimit")
-                if grouppquota.DateLimit is not None:
-                    if grouppquota.DateLimit[0].upper() == "NONE":
-                        grouppquota.DateLimit = None
-                    else:
-                        grouppquota.DateLimit = grouppquota.DateLimit[0]
-                grouppquota.MaxJobSize = fields.get("pykotaMaxJobSize")
-                if grouppquota.MaxJobSize is not None:
-                    if grouppquota.MaxJobSize[0].upper() == "NONE":
-                        grouppquota.MaxJobSize = None
-                    else:
-                        grouppquota.MaxJobSize = int(grouppquota.MaxJobSize[0])
+                self.setGroupPQuotaLimitsFromEntry(grouppquota, result[0][0], result[0][1])
                 grouppquota.PageCounter = 0
                 grouppquota.LifePageCounter = 0
                 usernamesfilter = "".join([f"(pykotaUserName={self.userCharsetToDatabase(member.Name)})" for member in
@@ -667,8 +959,11 @@ class Storage(BaseStorage):
             [self.info["groupmembers"]],
             base=self.info["groupbase"])
         if result:
-            for username in result[0][1].get(self.info["groupmembers"], []):
-                groupmembers.append(self.getUser(self.databaseToUserCharset(username)))
+            usernames = [self.databaseToUserCharset(username) for username in
+                         result[0][1].get(self.info["groupmembers"], [])]
+            users = self.loadUsers([u for u in usernames if self.getFromCache("USERS", u) is None])
+            for username in usernames:
+                groupmembers.append(users.get(username) or self.getUser(username))
         return groupmembers
 
     def getUserGroupsFromBackend(self, user):
@@ -756,106 +1051,19 @@ class Storage(BaseStorage):
 
     def getMatchingUsers(self, userpattern):
         """Returns the list of all users for which name matches a certain pattern."""
-        users = []
         # see comment at the same place in pgstorage.py
-        result = self.doSearch("objectClass=pykotaAccount",
-                               ["pykotaUserName", "pykotaLimitBy", self.info["usermail"], "description"],
-                               base=self.info["userbase"])
-        if result:
-            patterns = userpattern.split(",")
-            try:
-                patdict = {}.fromkeys(patterns)
-            except AttributeError:
-                # Python v2.2 or earlier
-                patdict = {}
-                for p in patterns:
-                    patdict[p] = None
-            for (userid, fields) in result:
-                username = self.databaseToUserCharset(
-                    fields.get("pykotaUserName", [""])[0] or fields.get(self.info["userrdn"], [""])[0])
-                if patdict.has_key(username) or self.tool.matchString(username, patterns):
-                    user = StorageUser(self, username)
-                    user.ident = userid
-                    user.Email = fields.get(self.info["usermail"], [None])[0]
-                    user.LimitBy = fields.get("pykotaLimitBy", ["quota"])[0]
-                    user.Description = self.databaseToUserCharset(fields.get("description", [""])[0])
-                    uname = self.userCharsetToDatabase(username)
-                    result = self.doSearch(
-                        f"(&(objectClass=pykotaAccountBalance)(|(pykotaUserName={uname})({self.info['balancerdn']}={uname})))",
-                        ["pykotaBalance", "pykotaLifeTimePaid", "pykotaPayments", "pykotaOverCharge"],
-                        base=self.info["balancebase"])
-                    if not result:
-                        raise PyKotaStorageError(
-                            f"No pykotaAccountBalance object found for user {username}. Did you create LDAP entries manually ?")
-                    else:
-                        fields = result[0][1]
-                        user.idbalance = result[0][0]
-                        user.OverCharge = float(fields.get("pykotaOverCharge", [1.0])[0])
-                        user.AccountBalance = fields.get("pykotaBalance")
-                        if user.AccountBalance is not None:
-                            if user.AccountBalance[0].upper() == "NONE":
-                                user.AccountBalance = None
-                            else:
-                                user.AccountBalance = float(user.AccountBalance[0])
-                        user.AccountBalance = user.AccountBalance or 0.0
-                        user.LifeTimePaid = fields.get("pykotaLifeTimePaid")
-                        if user.LifeTimePaid is not None:
-                            if user.LifeTimePaid[0].upper() == "NONE":
-                                user.LifeTimePaid = None
-                            else:
-                                user.LifeTimePaid = float(user.LifeTimePaid[0])
-                        user.LifeTimePaid = user.LifeTimePaid or 0.0
-                        user.Payments = []
-                        for payment in fields.get("pykotaPayments", []):
-                            try:
-                                (date, amount, description) = payment.split(" # ")
-                            except ValueError:
-                                # Payment with no description (old Payment)
-                                (date, amount) = payment.split(" # ")
-                                description = ""
-                            else:
-                                description = self.databaseToUserCharset(base64.decodestring(description))
-                            user.Payments.append((date, float(amount), description))
-                    user.Exists = True
-                    users.append(user)
-                    self.cacheEntry("USERS", user.Name, user)
-        return users
+        patterns = userpattern.split(",")
+        patdict = {}.fromkeys(patterns)
+        return [user for (username, user) in self.loadUsers().items()
+                if (username in patdict) or self.tool.matchString(username, patterns)]
 
     def getMatchingGroups(self, grouppattern):
         """Returns the list of all groups for which name matches a certain pattern."""
-        groups = []
         # see comment at the same place in pgstorage.py
-        result = self.doSearch("objectClass=pykotaGroup",
-                               ["pykotaGroupName", "pykotaLimitBy", "description"],
-                               base=self.info["groupbase"])
-        if result:
-            patterns = grouppattern.split(",")
-            try:
-                patdict = {}.fromkeys(patterns)
-            except AttributeError:
-                # Python v2.2 or earlier
-                patdict = {}
-                for p in patterns:
-                    patdict[p] = None
-            for (groupid, fields) in result:
-                groupname = self.databaseToUserCharset(
-                    fields.get("pykotaGroupName", [""])[0] or fields.get(self.info["grouprdn"], [""])[0])
-                if patdict.has_key(groupname) or self.tool.matchString(groupname, patterns):
-                    group = StorageGroup(self, groupname)
-                    group.ident = groupid
-                    group.Name = fields.get("pykotaGroupName", [self.databaseToUserCharset(groupname)])[0]
-                    group.LimitBy = fields.get("pykotaLimitBy", ["quota"])[0]
-                    group.Description = self.databaseToUserCharset(fields.get("description", [""])[0])
-                    group.AccountBalance = 0.0
-                    group.LifeTimePaid = 0.0
-                    for member in self.getGroupMembers(group):
-                        if member.Exists:
-                            group.AccountBalance += member.AccountBalance
-                            group.LifeTimePaid += member.LifeTimePaid
-                    group.Exists = True
-                    groups.append(group)
-                    self.cacheEntry("GROUPS", group.Name, group)
-        return groups
+        patterns = grouppattern.split(",")
+        patdict = {}.fromkeys(patterns)
+        return [group for (groupname, group) in self.loadGroups().items()
+                if (groupname in patdict) or self.tool.matchString(groupname, patterns)]
 
     def getPrinterUsersAndQuotas(self, printer, names=["*"]):
         """Returns the list of users who uses a given printer, along with their quotas."""
@@ -869,38 +1077,21 @@ class Storage(BaseStorage):
         result = self.doSearch(
             f"(&(objectClass=pykotaUserPQuota)(pykotaPrinterName={pname})(|{''.join([f'(pykotaUserName={uname})' for uname in names])}))",
             ["pykotaUserName", "pykotaPageCounter", "pykotaLifePageCounter", "pykotaSoftLimit", "pykotaHardLimit",
-             "pykotaDateLimit", "pykotaWarnCount"],
+             "pykotaDateLimit", "pykotaWarnCount", "pykotaMaxJobSize"],
             base=base)
         if result:
-            for (userquotaid, fields) in result:
-                user = self.getUser(self.databaseToUserCharset(fields.get("pykotaUserName")[0]))
+            usernames = [self.entryName(fields, "pykotaUserName") for (userquotaid, fields) in result]
+            if "*" in names:
+                users = self.loadUsers()  # a single search is cheaper than a huge filter
+            else:
+                users = self.loadUsers(usernames)
+            for ((userquotaid, fields), username) in zip(result, usernames):
+                user = users.get(username) or self.getUser(username)
                 userpquota = StorageUserPQuota(self, user, printer)
-                userpquota.ident = userquotaid
-                userpquota.PageCounter = int(fields.get("pykotaPageCounter", [0])[0])
-                userpquota.LifePageCounter = int(fields.get("pykotaLifePageCounter", [0])[0])
-                userpquota.WarnCount = int(fields.get("pykotaWarnCount", [0])[0])
-                userpquota.SoftLimit = fields.get("pykotaSoftLimit")
-                if userpquota.SoftLimit is not None:
-                    if userpquota.SoftLimit[0].upper() == "NONE":
-                        userpquota.SoftLimit = None
-                    else:
-                        userpquota.SoftLimit = int(userpquota.SoftLimit[0])
-                userpquota.HardLimit = fields.get("pykotaHardLimit")
-                if userpquota.HardLimit is not None:
-                    if userpquota.HardLimit[0].upper() == "NONE":
-                        userpquota.HardLimit = None
-                    elif userpquota.HardLimit is not None:
-                        userpquota.HardLimit = int(userpquota.HardLimit[0])
-                userpquota.DateLimit = fields.get("pykotaDateLimit")
-                if userpquota.DateLimit is not None:
-                    if userpquota.DateLimit[0].upper() == "NONE":
-                        userpquota.DateLimit = None
-                    else:
-                        userpquota.DateLimit = userpquota.DateLimit[0]
-                userpquota.Exists = True
+                self.setUserPQuotaFromEntry(userpquota, userquotaid, fields)
                 usersandquotas.append((user, userpquota))
                 self.cacheEntry("USERPQUOTAS", f"{user.Name}@{printer.Name}", userpquota)
-        usersandquotas.sort(lambda x, y: self.cmp(x[0].Name, y[0].Name))
+        usersandquotas.sort(key=lambda userandquota: userandquota[0].Name)
         return usersandquotas
 
     def cmp(self, a, b):
@@ -920,13 +1111,304 @@ class Storage(BaseStorage):
             ["pykotaGroupName"],
             base=base)
         if result:
-            for (groupquotaid, fields) in result:
-                group = self.getGroup(self.databaseToUserCharset(fields.get("pykotaGroupName")[0]))
-                grouppquota = self.getGroupPQuota(group, printer)
-                groupsandquotas.append((group, grouppquota))
-        groupsandquotas.sort(lambda x, y: self.cmp(x[0].Name, y[0].Name))
+            groupnames = sorted(set([self.entryName(fields, "pykotaGroupName") for (groupquotaid, fields) in result]))
+            groups = self.loadGroups(groupnames)
+            for grouppquota in self.loadGroupPQuotas(groups, {printer.Name: printer},
+                                                     groupnames=groupnames, printernames=[printer.Name]):
+                groupsandquotas.append((grouppquota.Group, grouppquota))
+        groupsandquotas.sort(key=lambda groupandquota: groupandquota[0].Name)
         return groupsandquotas
 
+    def namesFilter(self, objectclass, *restrictions):
+        """Returns an LDAP filter matching entries of a given object class.
+
+           Each restriction is an (attributes, names) tuple : matching entries
+           have one of the names as the value of one of the attributes.
+           A restriction with names set to None doesn't restrict anything.
+        """
+        ldapfilter = f"(objectClass={objectclass})"
+        restricted = False
+        for (attributes, names) in restrictions:
+            if names is not None:
+                ldapfilter += "(|%s)" % "".join([f"({attribute}={self.userCharsetToDatabase(name)})"
+                                                 for name in names for attribute in attributes])
+                restricted = True
+        if restricted:
+            ldapfilter = f"(&{ldapfilter})"
+        return ldapfilter
+
+    def entryName(self, fields, *attributes):
+        """Returns the first value found for one of the attributes, in the user's charset."""
+        for attribute in attributes:
+            value = fields.get(attribute)
+            if value:
+                return self.databaseToUserCharset(value[0])
+        return None
+
+    def filterEntries(self, entries, patterns=None):
+        """Returns the entries from a dictionary keyed by name whose name matches the optional patterns."""
+        if patterns and (not isinstance(patterns, (list, tuple))):
+            patterns = [patterns]
+        return [entry for (name, entry) in entries.items() if (not patterns) or self.tool.matchString(name, patterns)]
+
+    def optionalValue(self, fields, attribute, convert=str):
+        """Returns an attribute's value, or None if it's missing or set to 'None'."""
+        value = fields.get(attribute)
+        if (value is None) or (value[0].upper() == "NONE"):
+            return None
+        return convert(value[0])
+
+    def setUserBalanceFromEntry(self, user, ident, fields):
+        """Sets an user's account balance related attributes from a pykotaAccountBalance entry."""
+        user.idbalance = ident
+        user.AccountBalance = self.optionalValue(fields, "pykotaBalance", float) or 0.0
+        user.LifeTimePaid = self.optionalValue(fields, "pykotaLifeTimePaid", float) or 0.0
+        user.OverCharge = float(fields.get("pykotaOverCharge", [1.0])[0])
+        user.Payments = []
+        for payment in fields.get("pykotaPayments", []):
+            try:
+                (date, amount, description) = payment.split(" # ")
+            except ValueError:
+                # Payment with no description (old Payment)
+                (date, amount) = payment.split(" # ")
+                description = ""
+            else:
+                description = self.databaseToUserCharset(base64.decodestring(description))
+            user.Payments.append((date, float(amount), description))
+
+    def storagePrinterFromEntry(self, printername, ident, fields):
+        """Returns a StoragePrinter instance from a pykotaPrinter entry."""
+        printer = StoragePrinter(self, printername)
+        printer.ident = ident
+        printer.PricePerJob = float(fields.get("pykotaPricePerJob", [0.0])[0] or 0.0)
+        printer.PricePerPage = float(fields.get("pykotaPricePerPage", [0.0])[0] or 0.0)
+        printer.MaxJobSize = int(fields.get("pykotaMaxJobSize", [0])[0])
+        if fields.get("pykotaPassThrough", [None])[0] in (1, "1", "t", "true", "TRUE", "True"):
+            printer.PassThrough = 1
+        else:
+            printer.PassThrough = 0
+        printer.uniqueMember = fields.get("uniqueMember", [])
+        printer.Description = self.databaseToUserCharset(fields.get("description", [""])[0])
+        printer.Exists = True
+        return printer
+
+    def setUserPQuotaFromEntry(self, userpquota, ident, fields):
+        """Sets an user print quota's attributes from a pykotaUserPQuota entry."""
+        userpquota.ident = ident
+        userpquota.PageCounter = int(fields.get("pykotaPageCounter", [0])[0] or 0)
+        userpquota.LifePageCounter = int(fields.get("pykotaLifePageCounter", [0])[0] or 0)
+        userpquota.WarnCount = int(fields.get("pykotaWarnCount", [0])[0])
+        userpquota.SoftLimit = self.optionalValue(fields, "pykotaSoftLimit", int)
+        userpquota.HardLimit = self.optionalValue(fields, "pykotaHardLimit", int)
+        userpquota.DateLimit = self.optionalValue(fields, "pykotaDateLimit")
+        userpquota.MaxJobSize = self.optionalValue(fields, "pykotaMaxJobSize", int)
+        userpquota.Exists = True
+
+    def setGroupPQuotaLimitsFromEntry(self, grouppquota, ident, fields):
+        """Sets a group print quota's limits from a pykotaGroupPQuota entry."""
+        grouppquota.ident = ident
+        grouppquota.SoftLimit = self.optionalValue(fields, "pykotaSoftLimit", int)
+        grouppquota.HardLimit = self.optionalValue(fields, "pykotaHardLimit", int)
+        grouppquota.DateLimit = self.optionalValue(fields, "pykotaDateLimit")
+        grouppquota.MaxJobSize = self.optionalValue(fields, "pykotaMaxJobSize", int)
+
+    def storageBillingCodeFromEntry(self, label, ident, fields):
+        """Returns a StorageBillingCode instance from a pykotaBilling entry."""
+        code = StorageBillingCode(self, label)
+        code.ident = ident
+        code.PageCounter = int(fields.get("pykotaPageCounter", [0])[0])
+        code.Balance = float(fields.get("pykotaBalance", [0.0])[0])
+        code.Description = self.databaseToUserCharset(fields.get("description", [""])[0])
+        code.Exists = True
+        return code
+
+    def loadUsers(self, names=None):
+        """Loads users in bulk, returns a dictionary of StorageUser instances keyed by name.
+
+           Whatever the number of users, only two searches are done, one
+           for the accounts and one for the balances, which are joined here.
+           names is the optional list of users to load, all by default.
+        """
+        users = {}
+        if names is not None and not names:
+            return users
+        (userrdn, balancerdn) = (self.info["userrdn"], self.info["balancerdn"])
+        accounts = self.doSearch(self.namesFilter("pykotaAccount", (["pykotaUserName", userrdn], names)),
+                                 ["pykotaUserName", userrdn, "pykotaLimitBy", self.info["usermail"], "description"],
+                                 base=self.info["userbase"])
+        if not accounts:
+            return users
+        balances = {}
+        for (ident, fields) in self.doSearch(
+                self.namesFilter("pykotaAccountBalance", (["pykotaUserName", balancerdn], names)),
+                ["pykotaUserName", balancerdn, "pykotaBalance", "pykotaLifeTimePaid", "pykotaPayments",
+                 "pykotaOverCharge"],
+                base=self.info["balancebase"]):
+            for attribute in ("pykotaUserName", balancerdn):
+                for value in fields.get(attribute, []):
+                    balances.setdefault(self.databaseToUserCharset(value), (ident, fields))
+        for (ident, fields) in accounts:
+            username = self.entryName(fields, "pykotaUserName", userrdn)
+            if username not in balances:
+                raise PyKotaStorageError(
+                    f"No pykotaAccountBalance object found for user {username}. Did you create LDAP entries manually ?")
+            user = StorageUser(self, username)
+            user.ident = ident
+            user.Email = fields.get(self.info["usermail"], [None])[0]
+            user.LimitBy = fields.get("pykotaLimitBy", ["quota"])[0]
+            user.Description = self.databaseToUserCharset(fields.get("description", [""])[0])
+            self.setUserBalanceFromEntry(user, *balances[username])
+            user.Exists = True
+            users[username] = user
+            self.cacheEntry("USERS", username, user)
+        return users
+
+    def loadGroups(self, names=None, users=None):
+        """Loads groups in bulk, returns a dictionary of StorageGroup instances keyed by name.
+
+           The groups' members are taken from the users dictionary if
+           any, else they are loaded with loadUsers().
+        """
+        groups = {}
+        if names is not None and not names:
+            return groups
+        (grouprdn, groupmembers) = (self.info["grouprdn"], self.info["groupmembers"])
+        result = self.doSearch(self.namesFilter("pykotaGroup", (["pykotaGroupName", grouprdn], names)),
+                               ["pykotaGroupName", grouprdn, "pykotaLimitBy", "description", groupmembers],
+                               base=self.info["groupbase"])
+        if not result:
+            return groups
+        if users is None:
+            if names is None:
+                users = self.loadUsers()  # a single search is cheaper than a huge filter
+            else:
+                membernames = set()
+                for (ident, fields) in result:
+                    membernames.update([self.databaseToUserCharset(m) for m in fields.get(groupmembers, [])])
+                users = self.loadUsers(sorted(membernames))
+        for (ident, fields) in result:
+            group = StorageGroup(self, self.entryName(fields, "pykotaGroupName", grouprdn))
+            group.ident = ident
+            group.LimitBy = fields.get("pykotaLimitBy", ["quota"])[0]
+            group.Description = self.databaseToUserCharset(fields.get("description", [""])[0])
+            group.Members = [users[m] for m in [self.databaseToUserCharset(m) for m in fields.get(groupmembers, [])]
+                             if m in users]
+            group.AccountBalance = sum([member.AccountBalance for member in group.Members])
+            group.LifeTimePaid = sum([member.LifeTimePaid for member in group.Members])
+            group.Exists = True
+            groups[group.Name] = group
+            self.cacheEntry("GROUPS", group.Name, group)
+        return groups
+
+    def loadPrinters(self, names=None):
+        """Loads printers in bulk, returns a dictionary of StoragePrinter instances keyed by name."""
+        printers = {}
+        if names is not None and not names:
+            return printers
+        printerrdn = self.info["printerrdn"]
+        result = self.doSearch(self.namesFilter("pykotaPrinter", (["pykotaPrinterName", printerrdn], names)),
+                               ["pykotaPrinterName", printerrdn, "pykotaPricePerPage", "pykotaPricePerJob",
+                                "pykotaMaxJobSize", "pykotaPassThrough", "uniqueMember", "description"],
+                               base=self.info["printerbase"])
+        for (ident, fields) in result:
+            printer = self.storagePrinterFromEntry(self.entryName(fields, "pykotaPrinterName", printerrdn), ident,
+                                                   fields)
+            printers[printer.Name] = printer
+            self.cacheEntry("PRINTERS", printer.Name, printer)
+        return printers
+
+    def loadBillingCodes(self, names=None):
+        """Loads billing codes in bulk, returns a dictionary of StorageBillingCode instances keyed by label."""
+        codes = {}
+        if names is not None and not names:
+            return codes
+        result = self.doSearch(self.namesFilter("pykotaBilling", (["pykotaBillingCode"], names)),
+                               ["pykotaBillingCode", "pykotaBalance", "pykotaPageCounter", "description"],
+                               base=self.info["billingcodebase"])
+        for (ident, fields) in result:
+            code = self.storageBillingCodeFromEntry(self.entryName(fields, "pykotaBillingCode"), ident, fields)
+            codes[code.BillingCode] = code
+            self.cacheEntry("BILLINGCODES", code.BillingCode, code)
+        return codes
+
+    def loadUserPQuotas(self, users, printers, usernames=None, printernames=None):
+        """Loads users print quotas in bulk with a single search.
+
+           Returns a list of StorageUserPQuota instances, joined with the
+           users and printers dictionaries : quota entries for users or
+           printers not in these dictionaries are ignored.
+        """
+        if self.info["userquotabase"].lower() == "user":
+            base = self.info["userbase"]
+        else:
+            base = self.info["userquotabase"]
+        userpquotas = []
+        if (usernames is not None and not usernames) or (printernames is not None and not printernames):
+            return userpquotas
+        result = self.doSearch(self.namesFilter("pykotaUserPQuota",
+                                                (["pykotaUserName"], usernames),
+                                                (["pykotaPrinterName"], printernames)),
+                               ["pykotaUserName", "pykotaPrinterName", "pykotaPageCounter", "pykotaLifePageCounter",
+                                "pykotaSoftLimit", "pykotaHardLimit", "pykotaDateLimit", "pykotaWarnCount",
+                                "pykotaMaxJobSize"],
+                               base=base)
+        for (ident, fields) in result:
+            user = users.get(self.entryName(fields, "pykotaUserName"))
+            printer = printers.get(self.entryName(fields, "pykotaPrinterName"))
+            if (user is not None) and (printer is not None):
+                userpquota = StorageUserPQuota(self, user, printer)
+                self.setUserPQuotaFromEntry(userpquota, ident, fields)
+                userpquotas.append(userpquota)
+                self.cacheEntry("USERPQUOTAS", f"{user.Name}@{printer.Name}", userpquota)
+        return userpquotas
+
+    def loadGroupPQuotas(self, groups, printers, groupnames=None, printernames=None):
+        """Loads groups print quotas in bulk.
+
+           Returns a list of StorageGroupPQuota instances, joined with the
+           groups and printers dictionaries. Page counters are computed
+           from the members' print quotas, all loaded at once.
+        """
+        if self.info["groupquotabase"].lower() == "group":
+            base = self.info["groupbase"]
+        else:
+            base = self.info["groupquotabase"]
+        grouppquotas = []
+        if (groupnames is not None and not groupnames) or (printernames is not None and not printernames):
+            return grouppquotas
+        result = self.doSearch(self.namesFilter("pykotaGroupPQuota",
+                                                (["pykotaGroupName"], groupnames),
+                                                (["pykotaPrinterName"], printernames)),
+                               ["pykotaGroupName", "pykotaPrinterName", "pykotaSoftLimit", "pykotaHardLimit",
+                                "pykotaDateLimit", "pykotaMaxJobSize"],
+                               base=base)
+        for (ident, fields) in result:
+            group = groups.get(self.entryName(fields, "pykotaGroupName"))
+            printer = printers.get(self.entryName(fields, "pykotaPrinterName"))
+            if (group is not None) and (printer is not None):
+                grouppquota = StorageGroupPQuota(self, group, printer)
+                self.setGroupPQuotaLimitsFromEntry(grouppquota, ident, fields)
+                grouppquotas.append(grouppquota)
+        if grouppquotas:
+            members = {}
+            for grouppquota in grouppquotas:
+                for member in grouppquota.Group.Members:
+                    members[member.Name] = member
+            counters = {}
+            for userpquota in self.loadUserPQuotas(members, printers, printernames=printernames):
+                counters[(userpquota.User.Name, userpquota.Printer.Name)] = userpquota
+            for grouppquota in grouppquotas:
+                grouppquota.PageCounter = 0
+                grouppquota.LifePageCounter = 0
+                for member in grouppquota.Group.Members:
+                    userpquota = counters.get((member.Name, grouppquota.Printer.Name))
+                    if userpquota is not None:
+                        grouppquota.PageCounter += userpquota.PageCounter
+                        grouppquota.LifePageCounter += userpquota.LifePageCounter
+                grouppquota.Exists = True
+                self.cacheEntry("GROUPPQUOTAS", f"{grouppquota.Group.Name}@{grouppquota.Printer.Name}", grouppquota)
+        return grouppquotas
+
     def addPrinter(self, printer):
         """Adds a printer to the quota storage, returns the old value if it already exists."""
         oldentry = self.getPrinter(printer.Name)
@@ -1202,6 +1684,29 @@ class Storage(BaseStorage):
         }
         return self.doModify(userpquota.ident, fields)
 
+    def chargeJob(self, userpquotas, jobsize, jobprice):
+        """Charges a job to an user : increases the page counters of all the
+           user print quota entries given, and debits the user's account balance
+           if the job's price is not null.
+
+           Returns a tuple (balance, counters) where balance is the new account
+           balance (None if unchanged) and counters a mapping from each user
+           print quota entry's ident to a tuple (pagecounter, lifepagecounter).
+
+           Nothing is read back from the directory, the new values are
+           computed from the ones we already know.
+        """
+        user = userpquotas[0].User
+        balance = None
+        if jobprice:
+            self.decreaseUserAccountBalance(user, jobprice)
+            balance = float(user.AccountBalance or 0.0) - jobprice
+        counters = {}
+        for upq in userpquotas:
+            self.increaseUserPQuotaPagesCounters(upq, jobsize)
+            counters[upq.ident] = (int(upq.PageCounter or 0) + jobsize, int(upq.LifePageCounter or 0) + jobsize)
+        return (balance, counters)
+
     def decreaseUserAccountBalance(self, user, amount):
         """Decreases user's account balance from an amount."""
         fields = {
@@ -1365,31 +1870,38 @@ class Storage(BaseStorage):
         if jobid is not None:
             where.append(
                 f"(pykotaJobId={jobid})")  # TODO : jobid is text, so self.userCharsetToDatabase(jobid) but do all of them as well.
+        # let the server filter on dates : createTimestamp has an ordering matching rule
+        if start is not None:
+            where.append(f"(createTimestamp>={self.toGeneralizedTime(start)})")
+        if end is not None:
+            where.append(f"(createTimestamp<={self.toGeneralizedTime(end)})")
         if where:
             where = f"(&{''.join([precond] + where)})"
         else:
             where = precond
         jobs = []
-        result = self.doSearch(where, fields=["pykotaJobSizeBytes",
-                                              "pykotaHostName",
-                                              "pykotaUserName",
-                                              "pykotaPrinterName",
-                                              "pykotaJobId",
-                                              "pykotaPrinterPageCounter",
-                                              "pykotaAction",
-                                              "pykotaJobSize",
-                                              "pykotaJobPrice",
-                                              "pykotaFileName",
-                                              "pykotaTitle",
-                                              "pykotaCopies",
-                                              "pykotaOptions",
-                                              "pykotaBillingCode",
-                                              "pykotaPages",
-                                              "pykotaMD5Sum",
-                                              "pykotaPrecomputedJobSize",
-                                              "pykotaPrecomputedJobPrice",
-                                              "createTimestamp"],
-                               base=self.info["jobbase"])
+        result = self.doPagedSearch(where, fields=["pykotaJobSizeBytes",
+                                                   "pykotaHostName",
+                                                   "pykotaUserName",
+                                                   "pykotaPrinterName",
+                                                   "pykotaJobId",
+                                                   "pykotaPrinterPageCounter",
+                                                   "pykotaAction",
+                                                   "pykotaJobSize",
+                                                   "pykotaJobPrice",
+                                                   "pykotaFileName",
+                                                   "pykotaTitle",
+                                                   "pykotaCopies",
+                                                   "pykotaOptions",
+                                                   "pykotaBillingCode",
+                                                   "pykotaPages",
+                                                   "pykotaMD5Sum",
+                                                   "pykotaPrecomputedJobSize",
+                                                   "pykotaPrecomputedJobPrice",
+                                                   "createTimestamp"],
+                                    base=self.info["jobbase"],
+                                    sortkeys=["-createTimestamp"],
+                                    limit=limit and int(limit))
         if result:
             for (ident, fields) in result:
                 job = StorageJob(self)
@@ -1425,17 +1937,13 @@ class Storage(BaseStorage):
                 if job.JobTitle == job.JobFileName == job.JobOptions == "hidden":
                     (job.JobTitle, job.JobFileName, job.JobOptions) = ("Hidden because of privacy concerns",) * 3
                 date = fields.get("createTimestamp", ["19700101000000Z"])[0]  # It's in UTC !
-                mxtime = datetime.strptime(date[:14], "%Y%m%d%H%M%S").date()
+                mxtime = datetime.strptime(date[:14], "%Y%m%d%H%M%S")
                 job.JobDate = mxtime.strftime("%Y-%m-%d %H:%M:%S")
-                if ((start is None) and (end is None)) or \
-                        ((start is None) and (job.JobDate <= end)) or \
-                        ((end is None) and (job.JobDate >= start)) or \
-                        ((job.JobDate >= start) and (job.JobDate <= end)):
-                    job.UserName = self.databaseToUserCharset(fields.get("pykotaUserName")[0])
-                    job.PrinterName = self.databaseToUserCharset(fields.get("pykotaPrinterName")[0])
-                    job.Exists = True
-                    jobs.append(job)
-            jobs.sort(lambda x, y: self.cmp(y.JobDate, x.JobDate))
+                job.UserName = self.databaseToUserCharset(fields.get("pykotaUserName")[0])
+                job.PrinterName = self.databaseToUserCharset(fields.get("pykotaPrinterName")[0])
+                job.Exists = True
+                jobs.append(job)
+            jobs.sort(key=lambda job: job.JobDate, reverse=True)  # cheap if the server already sorted them
             if limit:
                 jobs = jobs[:int(limit)]
         return jobs
@@ -1640,26 +2148,15 @@ class Storage(BaseStorage):
                 if index is not None:
                     orderby.append((+1, index))
 
-        def compare(x, y, orderby=orderby):
-            """Compares two records."""
-            i = 0
-            nbkeys = len(orderby)
-            while i < nbkeys:
-                (sign, index) = orderby[i]
-                result = self.cmp(x[i], y[i])
-                if not result:
-                    i += 1
-                else:
-                    return sign * result
-            return 0  # identical keys
-
-        records.sort(compare)
+        # sorts are stable : sort on the least significant key first
+        for (sign, index) in reversed(orderby):
+            records.sort(key=lambda record: (record[index] is not None, record[index]), reverse=(sign < 0))
         return records
 
     def extractPrinters(self, extractonly={}, ordering=[]):
         """Extracts all printer records."""
         pname = extractonly.get("printername")
-        entries = [p for p in [self.getPrinter(name) for name in self.getAllPrintersNames(pname)] if p.Exists]
+        entries = self.filterEntries(self.loadPrinters(), pname)
         if entries:
             fields = ("dn", "printername", "priceperpage", "priceperjob", "description", "maxjobsize", "passthrough")
             result = []
@@ -1675,7 +2172,7 @@ class Storage(BaseStorage):
     def extractUsers(self, extractonly={}, ordering=[]):
         """Extracts all user records."""
         uname = extractonly.get("username")
-        entries = [u for u in [self.getUser(name) for name in self.getAllUsersNames(uname)] if u.Exists]
+        entries = self.filterEntries(self.loadUsers(), uname)
         if entries:
             fields = ("dn", "username", "balance", "lifetimepaid", "limitby", "email", "description", "overcharge")
             result = []
@@ -1687,8 +2184,7 @@ class Storage(BaseStorage):
     def extractBillingcodes(self, extractonly={}, ordering=[]):
         """Extracts all billing codes records."""
         billingcode = extractonly.get("billingcode")
-        entries = [b for b in [self.getBillingCode(label) for label in self.getAllBillingCodes(billingcode)] if
-                   b.Exists]
+        entries = self.filterEntries(self.loadBillingCodes(), billingcode)
         if entries:
             fields = ("dn", "billingcode", "balance", "pagecounter", "description")
             result = []
@@ -1699,7 +2195,7 @@ class Storage(BaseStorage):
     def extractGroups(self, extractonly={}, ordering=[]):
         """Extracts all group records."""
         gname = extractonly.get("groupname")
-        entries = [g for g in [self.getGroup(name) for name in self.getAllGroupsNames(gname)] if g.Exists]
+        entries = self.filterEntries(self.loadGroups(), gname)
         if entries:
             fields = ("dn", "groupname", "limitby", "balance", "lifetimepaid", "description")
             result = []
@@ -1708,13 +2204,16 @@ class Storage(BaseStorage):
                                entry.Description))
             return [fields] + self.sortRecords(fields, result, ["+dn"], ordering)
 
-    def extractPayments(self, extractonly={}, ordering=[]):
-        """Extracts all payment records."""
+    def extractPayments(self, extractonly={}, ordering=[], streaming=False):
+        """Extracts all payment records.
+
+           streaming is ignored, a list is always returned.
+        """
         startdate = extractonly.get("start")
         enddate = extractonly.get("end")
         (startdate, enddate) = self.cleanDates(startdate, enddate)
         uname = extractonly.get("username")
-        entries = [u for u in [self.getUser(name) for name in self.getAllUsersNames(uname)] if u.Exists]
+        entries = self.filterEntries(self.loadUsers(), uname)
         if entries:
             fields = ("username", "amount", "date", "description")
             result = []
@@ -1730,16 +2229,17 @@ class Storage(BaseStorage):
     def extractUpquotas(self, extractonly={}, ordering=[]):
         """Extracts all userpquota records."""
         pname = extractonly.get("printername")
-        entries = [p for p in [self.getPrinter(name) for name in self.getAllPrintersNames(pname)] if p.Exists]
-        if entries:
+        printers = dict([(p.Name, p) for p in self.filterEntries(self.loadPrinters(), pname)])
+        if printers:
             fields = (
             "username", "printername", "dn", "userdn", "printerdn", "lifepagecounter", "pagecounter", "softlimit",
             "hardlimit", "datelimit")
             result = []
             uname = extractonly.get("username")
-            for entry in entries:
-                for (user, userpquota) in self.getPrinterUsersAndQuotas(entry, names=[uname or "*"]):
-                    result.append((user.Name, entry.Name, userpquota.ident, user.ident, entry.ident,
+            for userpquota in self.loadUserPQuotas(self.loadUsers(), printers):
+                (user, printer) = (userpquota.User, userpquota.Printer)
+                if (uname is None) or self.tool.matchString(user.Name, [uname]):
+                    result.append((user.Name, printer.Name, userpquota.ident, user.ident, printer.ident,
                                    userpquota.LifePageCounter, userpquota.PageCounter, userpquota.SoftLimit,
                                    userpquota.HardLimit, userpquota.DateLimit))
             return [fields] + self.sortRecords(fields, result, ["+userdn"], ordering)
@@ -1747,24 +2247,25 @@ class Storage(BaseStorage):
     def extractGpquotas(self, extractonly={}, ordering=[]):
         """Extracts all grouppquota records."""
         pname = extractonly.get("printername")
-        entries = [p for p in [self.getPrinter(name) for name in self.getAllPrintersNames(pname)] if p.Exists]
-        if entries:
+        printers = dict([(p.Name, p) for p in self.filterEntries(self.loadPrinters(), pname)])
+        if printers:
             fields = (
             "groupname", "printername", "dn", "groupdn", "printerdn", "lifepagecounter", "pagecounter", "softlimit",
             "hardlimit", "datelimit")
             result = []
             gname = extractonly.get("groupname")
-            for entry in entries:
-                for (group, grouppquota) in self.getPrinterGroupsAndQuotas(entry, names=[gname or "*"]):
-                    result.append((group.Name, entry.Name, grouppquota.ident, group.ident, entry.ident,
-                                   grouppquota.LifePageCounter, grouppquota.PageCounter, grouppquota.SoftLimit,
-                                   grouppquota.HardLimit, grouppquota.DateLimit))
+            groups = dict([(g.Name, g) for g in self.filterEntries(self.loadGroups(), gname)])
+            for grouppquota in self.loadGroupPQuotas(groups, printers):
+                (group, printer) = (grouppquota.Group, grouppquota.Printer)
+                result.append((group.Name, printer.Name, grouppquota.ident, group.ident, printer.ident,
+                               grouppquota.LifePageCounter, grouppquota.PageCounter, grouppquota.SoftLimit,
+                               grouppquota.HardLimit, grouppquota.DateLimit))
             return [fields] + self.sortRecords(fields, result, ["+groupdn"], ordering)
 
     def extractUmembers(self, extractonly={}, ordering=[]):
         """Extracts all user groups members."""
         gname = extractonly.get("groupname")
-        entries = [g for g in [self.getGroup(name) for name in self.getAllGroupsNames(gname)] if g.Exists]
+        entries = self.filterEntries(self.loadGroups(), gname)
         if entries:
             fields = ("groupname", "username", "groupdn", "userdn")
             result = []
@@ -1778,19 +2279,36 @@ class Storage(BaseStorage):
     def extractPmembers(self, extractonly={}, ordering=[]):
         """Extracts all printer groups members."""
         pname = extractonly.get("printername")
-        entries = [p for p in [self.getPrinter(name) for name in self.getAllPrintersNames(pname)] if p.Exists]
+        printers = self.loadPrinters()
+        entries = self.filterEntries(printers, pname)
         if entries:
             fields = ("pgroupname", "printername", "pgroupdn", "printerdn")
             result = []
             pgname = extractonly.get("pgroupname")
+            directparents = {}
+            for pgroup in printers.values():
+                for member in pgroup.uniqueMember:
+                    if member != pgroup.ident:  # In case of integrity violation.
+                        directparents.setdefault(member, []).append(pgroup)
             for entry in entries:
-                for parent in self.getParentPrinters(entry):
+                # all parents, recursively, like getParentPrinters() does
+                parents = {}
+                tovisit = [entry]
+                while tovisit:
+                    for parent in directparents.get(tovisit.pop().ident, []):
+                        if parent.ident not in parents:
+                            parents[parent.ident] = parent
+                            tovisit.append(parent)
+                for parent in parents.values():
                     if (pgname is None) or (parent.Name == pgname):
                         result.append((parent.Name, entry.Name, parent.ident, entry.ident))
             return [fields] + self.sortRecords(fields, result, ["+pgroupdn", "+printerdn"], ordering)
 
-    def extractHistory(self, extractonly={}, ordering=[]):
-        """Extracts all jobhistory records."""
+    def extractHistory(self, extractonly={}, ordering=[], streaming=False):
+        """Extracts all jobhistory records.
+
+           streaming is ignored, a list is always returned.
+        """
         uname = extractonly.get("username")
         if uname:
             user = self.getUser(uname)
@@ -1830,12 +2348,8 @@ class Storage(BaseStorage):
                                base=self.info["billingcodebase"])
         if result:
             fields = result[0][1]  # take only first matching code, ignore the rest
-            code.ident = result[0][0]
-            code.BillingCode = self.databaseToUserCharset(fields.get("pykotaBillingCode", [ulabel])[0])
-            code.PageCounter = int(fields.get("pykotaPageCounter", [0])[0])
-            code.Balance = float(fields.get("pykotaBalance", [0.0])[0])
-            code.Description = self.databaseToUserCharset(fields.get("description", [""])[0])
-            code.Exists = True
+            code = self.storageBillingCodeFromEntry(
+                self.databaseToUserCharset(fields.get("pykotaBillingCode", [ulabel])[0]), result[0][0], fields)
         return code
 
     def addBillingCode(self, bcode):
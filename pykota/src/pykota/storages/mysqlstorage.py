@@ -28,10 +28,11 @@
 import time
 
 from pykota.storage import PyKotaStorageError, BaseStorage
-from pykota.storages.sql import SQLStorage
+from pykota.storages.sql import SQLStorage, STREAMINGBATCHSIZE, ROLLUPCOUNTERS
 
 try:
     import MySQLdb
+    import MySQLdb.cursors
 except ImportError:
     import sys
 
@@ -76,6 +77,7 @@ class Storage(BaseStorage, SQLStorage):
             self.database.close()
             self.closed = 1
             self.tool.logdebug("Database closed.")
+            self.reportStatistics()
 
     def beginTransaction(self):
         """Starts a transaction."""
@@ -86,16 +88,14 @@ class Storage(BaseStorage, SQLStorage):
     def commitTransaction(self):
         """Commits a transaction."""
         self.database.commit()
-        after = time.time()
+        self.recordQuery("BEGIN ... COMMIT", time.time() - self.before)
         self.tool.logdebug("Transaction committed.")
-        # self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
 
     def rollbackTransaction(self):
         """Rollbacks a transaction."""
         self.database.rollback()
-        after = time.time()
+        self.recordQuery("BEGIN ... ROLLBACK", time.time() - self.before)
         self.tool.logdebug("Transaction aborted.")
-        # self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
 
     def doRawSearch(self, query):
         """Does a raw search query."""
@@ -111,10 +111,43 @@ class Storage(BaseStorage, SQLStorage):
         else:
             # This returns a list of lists. Integers are returned as longs.
             result = self.cursor.fetchall()
-            after = time.time()
-            # self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            self.recordQuery(query, time.time() - before, len(result))
             return result
 
+    def doStreamingSearch(self, query, batchsize=STREAMINGBATCHSIZE):
+        """Does a raw search query through an unbuffered cursor.
+
+           Yields the headers first, then each record, fetching them
+           in batches of batchsize records. Yields nothing if there's no record.
+        """
+        query = query.strip()
+        if not query.endswith(';'):
+            query += ';'
+        cursor = self.database.cursor(MySQLdb.cursors.SSCursor)
+        duration = 0.0  # time spent in the database only
+        nbrows = 0
+        try:
+            try:
+                self.tool.logdebug(f"QUERY : {query}")
+                before = time.time()
+                cursor.execute(query)
+                result = cursor.fetchmany(batchsize)
+                duration += time.time() - before
+                if result:
+                    yield tuple([f[0] for f in cursor.description])
+                while result:
+                    nbrows += len(result)
+                    for record in result:
+                        yield self.prepareRawRecord(record)
+                    before = time.time()
+                    result = cursor.fetchmany(batchsize)
+                    duration += time.time() - before
+            except self.database.Error as msg:
+                raise PyKotaStorageError(str(msg))
+        finally:
+            cursor.close()
+            self.recordQuery(query, duration, nbrows)
+
     def doSearch(self, query):
         """Does a search query."""
         result = self.doRawSearch(query)
@@ -149,8 +182,7 @@ class Storage(BaseStorage, SQLStorage):
             self.tool.logdebug(f"Query failed : {repr(msg)}")
             raise PyKotaStorageError(str(msg))
         else:
-            after = time.time()
-            # self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            self.recordQuery(query, time.time() - before, max(self.cursor.rowcount, 0))
 
     def doQuote(self, field):
         """Quotes a field for use as a string in SQL queries."""
@@ -170,6 +202,48 @@ class Storage(BaseStorage, SQLStorage):
             self.tool.logdebug("WARNING: field has no type, returning NULL")
             return "NULL"
 
+    def replicationLag(self):
+        """Returns the number of seconds this server lags behind the primary server, or None if unknown."""
+        try:
+            self.tool.logdebug("QUERY : SHOW SLAVE STATUS;")
+            self.cursor.execute("SHOW SLAVE STATUS;")
+            result = self.cursor.fetchone()
+        except self.database.Error as msg:
+            raise PyKotaStorageError(str(msg))
+        if result is None:
+            return 0.0  # not a replica
+        lag = dict(zip([f[0] for f in self.cursor.description], result)).get("Seconds_Behind_Master")
+        if lag is None:
+            return None  # replication is stopped
+        return float(lag)
+
+    def lastInsertedIdExpression(self, table):
+        """Returns an SQL expression giving the id of the last record inserted into table."""
+        return "LAST_INSERT_ID()"
+
+    def monthExpression(self, field):
+        """Returns an SQL expression giving the YYYY-MM month of a date field."""
+        return f"DATE_FORMAT({field}, '%Y-%m')"
+
+    def rollupConflictClause(self):
+        """Returns the SQL clause which adds the counters to already existing daily usage rollups."""
+        updates = ", ".join([f"jobrollup.{counter}=jobrollup.{counter}+VALUES({counter})" for counter in ROLLUPCOUNTERS])
+        return f"ON DUPLICATE KEY UPDATE {updates}"
+
+    def insertManyRecords(self, table, fields, records):
+        """Inserts many records into a table at once, see SQLStorage.insertManyRecords()."""
+        if not records:
+            return
+        try:
+            before = time.time()
+            self.tool.logdebug(f"QUERY : INSERT INTO {table} ({', '.join(fields)}) ({len(records)} records)")
+            self.cursor.executemany(f"INSERT INTO {table} ({', '.join(fields)}) VALUES ({', '.join(['%s'] * len(fields))})",
+                                    records)
+            self.recordQuery(f"INSERT INTO {table} ({', '.join(fields)}) VALUES (?, ...)", time.time() - before, len(records))
+        except self.database.Error as msg:
+            self.tool.logdebug(f"Query failed : {repr(msg)}")
+            raise PyKotaStorageError(str(msg))
+
     def prepareRawResult(self, result):
         """Prepares a raw result by including the headers."""
         if result:
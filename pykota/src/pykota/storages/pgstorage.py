@@ -24,13 +24,15 @@
 
 """This module defines a class to access to a PostgreSQL database backend."""
 
+import io
+import os
 import time
 from types import NoneType
 
 # from types import StringType
 
 from pykota.storage import PyKotaStorageError, BaseStorage
-from pykota.storages.sql import SQLStorage
+from pykota.storages.sql import SQLStorage, STREAMINGBATCHSIZE
 
 try:
     import psycopg2
@@ -69,6 +71,7 @@ class Storage(BaseStorage, SQLStorage):
                 **locals())
             raise PGError(msg)
         self.closed = 0
+        self.historypartitions = set()  # months known to have a job history partition
         # try:
         #    self.quote = self.database._quote
         # except AttributeError:  # pg <v4.x
@@ -85,6 +88,7 @@ class Storage(BaseStorage, SQLStorage):
             self.database.close()
             self.closed = 1
             self.tool.logdebug("Database closed.")
+            self.reportStatistics()
 
     def beginTransaction(self):
         """Starts a transaction."""
@@ -95,16 +99,14 @@ class Storage(BaseStorage, SQLStorage):
     def commitTransaction(self):
         """Commits a transaction."""
         self.database.execute("COMMIT;")
-        after = time.time()
+        self.recordQuery("BEGIN ... COMMIT", time.time() - self.before)
         self.tool.logdebug("Transaction committed.")
-        # self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
 
     def rollbackTransaction(self):
         """Rollbacks a transaction."""
         self.database.execute("ROLLBACK;")
-        after = time.time()
+        self.recordQuery("BEGIN ... ROLLBACK", time.time() - self.before)
         self.tool.logdebug("Transaction aborted.")
-        # self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
 
     def doRawSearch(self, query):
         """Does a raw search query."""
@@ -119,10 +121,46 @@ class Storage(BaseStorage, SQLStorage):
         except PGError as msg:
             raise PyKotaStorageError(str(msg))
         else:
-            after = time.time()
-            # self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            self.recordQuery(query, time.time() - before, len(result))
             return result
 
+    def doStreamingSearch(self, query, batchsize=STREAMINGBATCHSIZE):
+        """Does a raw search query through a server side cursor.
+
+           Yields the headers first, then each record, fetching them
+           in batches of batchsize records. Yields nothing if there's no record.
+        """
+        query = query.strip().rstrip(';')
+        self.streamingcursors = getattr(self, "streamingcursors", 0) + 1
+        cursorname = f"pykota_{os.getpid()}_{self.streamingcursors}"
+        try:
+            self.tool.logdebug(f"QUERY ({cursorname}) : {query}")
+            before = time.time()
+            cursor = self.database.connection.cursor(cursorname)
+            cursor.itersize = batchsize
+            cursor.execute(query)
+            result = cursor.fetchmany(batchsize)
+            duration = time.time() - before  # time spent in the database only
+        except PGError as msg:
+            raise PyKotaStorageError(str(msg))
+        nbrows = 0
+        try:
+            if result:
+                yield tuple([f[0] for f in cursor.description])
+            while result:
+                nbrows += len(result)
+                for record in result:
+                    yield self.prepareRawRecord(record)
+                try:
+                    before = time.time()
+                    result = cursor.fetchmany(batchsize)
+                    duration += time.time() - before
+                except PGError as msg:
+                    raise PyKotaStorageError(str(msg))
+        finally:
+            cursor.close()
+            self.recordQuery(query, duration, nbrows)
+
     def doSearch(self, query):
         """Does a search query."""
         result = self.doRawSearch(query)
@@ -142,8 +180,7 @@ class Storage(BaseStorage, SQLStorage):
             self.tool.logdebug(f"Query failed : {repr(msg)}")
             raise PyKotaStorageError(str(msg))
         else:
-            after = time.time()
-            # self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            self.recordQuery(query, time.time() - before, max(self.database.rowcount, 0))
             return result
 
     def doQuote(self, field):
@@ -158,19 +195,97 @@ class Storage(BaseStorage, SQLStorage):
             typ = "text"
         return self.quote(field, typ)
 
+    def chargeJob(self, userpquotas, jobsize, jobprice):
+        """Charges a job to an user in a single round trip, see SQLStorage.chargeJob()."""
+        user = userpquotas[0].User
+        upqids = ", ".join([f"{self.doQuote(upq.ident)}" for upq in userpquotas])
+        if jobprice:
+            balanceupdate = f"UPDATE users SET balance=balance - {self.doQuote(jobprice)} WHERE id={self.doQuote(user.ident)} RETURNING balance"
+        else:
+            balanceupdate = "SELECT NULL::float AS balance"
+        result = self.doRawSearch(
+            f"WITH upq AS (UPDATE userpquota SET pagecounter=pagecounter + {self.doQuote(jobsize)}, lifepagecounter=lifepagecounter + {self.doQuote(jobsize)} WHERE id IN ({upqids}) RETURNING id, pagecounter, lifepagecounter), usr AS ({balanceupdate}) SELECT upq.id, upq.pagecounter, upq.lifepagecounter, usr.balance FROM upq LEFT JOIN usr ON TRUE")
+        balance = None
+        counters = {}
+        for (upqid, pagecounter, lifepagecounter, newbalance) in result:
+            counters[upqid] = (int(pagecounter or 0), int(lifepagecounter or 0))
+            if jobprice:
+                balance = float(newbalance or 0.0)
+        return (balance, counters)
+
+    def replicationLag(self):
+        """Returns the number of seconds this server lags behind the primary server, or None if unknown."""
+        result = self.doRawSearch(
+            "SELECT pg_is_in_recovery(), pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn(), EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())")
+        (inrecovery, caughtup, lag) = result[0]
+        if (not inrecovery) or caughtup:
+            return 0.0
+        elif lag is None:
+            return None
+        return float(lag)
+
+    def lastInsertedIdExpression(self, table):
+        """Returns an SQL expression giving the id of the last record inserted into table."""
+        return f"currval('{table}_id_seq')"
+
+    def prepareHistoryPartition(self, date=None):
+        """Creates the job history's monthly partition for jobs printed at date, now if None, if needed.
+
+           Jobs are written to the default partition when their month's
+           partition doesn't exist, so this is only done ahead by pkarchive,
+           and when importing jobs, not for each job printed.
+        """
+        month = (date or time.strftime("%Y-%m-%d %H:%M:%S"))[:7]
+        if month not in self.historypartitions:
+            if date is None:
+                self.doSearch("SELECT jobhistory_partition(now())")
+            else:
+                self.doSearch(f"SELECT jobhistory_partition({self.doQuote(date)})")
+            self.historypartitions.add(month)
+
+    def archiveHistoryMonth(self, month, tablespace=None):
+        """Moves the jobs of a month from the job history to the archive of old jobs.
+
+           This is done by the database, which directly moves the month's
+           partition to the archive, optionally to another tablespace,
+           whenever no printer's last job is part of it.
+        """
+        result = self.doRawSearch(f"SELECT jobhistory_archive({self.doQuote(self.monthLimits(month)[0])}, {self.doQuote(tablespace)})")
+        self.lastarchiveddate = None
+        return int(result[0][0] or 0)
+
+    def monthExpression(self, field):
+        """Returns an SQL expression giving the YYYY-MM month of a date field."""
+        return f"to_char({field}, 'YYYY-MM')"
+
+    def insertManyRecords(self, table, fields, records):
+        """Inserts many records into a table at once with COPY, see SQLStorage.insertManyRecords()."""
+        if not records:
+            return
+        lines = []
+        for record in records:
+            values = []
+            for value in record:
+                if value is None:
+                    values.append("\\N")
+                else:
+                    values.append(str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r"))
+            lines.append("\t".join(values))
+        try:
+            before = time.time()
+            self.tool.logdebug(f"QUERY : COPY {table} ({', '.join(fields)}) FROM STDIN ({len(records)} records)")
+            self.database.copy_expert(f"COPY {table} ({', '.join(fields)}) FROM STDIN",
+                                      io.StringIO("".join([f"{line}\n" for line in lines])))
+            self.recordQuery(f"COPY {table} ({', '.join(fields)}) FROM STDIN", time.time() - before, len(records))
+        except PGError as msg:
+            self.tool.logdebug(f"Query failed : {repr(msg)}")
+            raise PyKotaStorageError(str(msg))
+
     def prepareRawResult(self, result):
         """Prepares a raw result by including the headers."""
         if result.ntuples() > 0:
             entries = [result.listfields()]
-            entries.extend(result.getresult())
-            nbfields = len(entries[0])
-            for i in range(1, len(entries)):
-                fields = list(entries[i])
-                for j in range(nbfields):
-                    field = fields[j]
-                    if type(field) == str:
-                        fields[j] = self.databaseToUserCharset(field)
-                entries[i] = tuple(fields)
+            entries.extend([self.prepareRawRecord(record) for record in result.getresult()])
             return entries
 
     def quote(self, field, typ):
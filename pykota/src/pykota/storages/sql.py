@@ -24,12 +24,36 @@
 
 """This module defines methods common to all relational backends."""
 
+import time
+
 from pykota.storage import StorageUser, StorageGroup, StoragePrinter, \
     StorageJob, StorageLastJob, StorageUserPQuota, \
     StorageGroupPQuota, StorageBillingCode
 
+STREAMINGBATCHSIZE = 1000  # number of records fetched at once when streaming results
+
+# the daily usage rollups' keys and counters, see the jobrollup table
+ROLLUPKEYS = ("day", "userid", "printerid", "action", "billingcode", "hostname")
+ROLLUPCOUNTERS = ("nbjobs", "nbprintedjobs", "jobsize", "jobsizebytes", "jobprice", "printedjobprice",
+                  "precomputedjobsize", "precomputedjobprice")
+
+# the job history's fields restored by pkimport
+IMPORTJOBFIELDS = ("jobid", "userid", "printerid", "pagecounter", "jobsizebytes", "jobsize", "jobprice", "action",
+                   "filename", "title", "copies", "options", "hostname", "md5sum", "pages", "billingcode",
+                   "precomputedjobsize", "precomputedjobprice", "jobdate")
+
 
 class SQLStorage:
+    lastarchiveddate = None  # date of the most recent archived job, see historyTable()
+
+    def prepareRawRecord(self, record):
+        """Returns a raw record as a tuple, its text values converted to the user's charset."""
+        fields = list(record)
+        for i in range(len(fields)):
+            if type(fields[i]) == str:
+                fields[i] = self.databaseToUserCharset(fields[i])
+        return tuple(fields)
+
     def storageUserFromRecord(self, username, record):
         """Returns a StorageUser instance from a database record."""
         user = StorageUser(self, username)
@@ -171,6 +195,69 @@ class SQLStorage:
                 statements.append(f"{field} ASC")
         return ", ".join(statements)
 
+    def createDatedFilter(self, extractonly, datefield):
+        """Returns the appropriate SQL filter, prefixed with AND, including
+           the 'start' and 'end' date limits on datefield if any.
+
+           The date limits are removed from extractonly.
+        """
+        startdate = extractonly.get("start")
+        enddate = extractonly.get("end")
+        for limit in ("start", "end"):
+            try:
+                del extractonly[limit]
+            except KeyError:
+                pass
+        thefilter = self.createFilter(extractonly)
+        if thefilter:
+            thefilter = f"AND {thefilter}"
+        (startdate, enddate) = self.cleanDates(startdate, enddate)
+        if startdate:
+            thefilter = f"{thefilter} AND {datefield}>={self.doQuote(startdate)}"
+        if enddate:
+            thefilter = f"{thefilter} AND {datefield}<={self.doQuote(enddate)}"
+        return thefilter
+
+    def summarizeRecords(self, fields, fromwhere, keys, totalize, totalsfromwhere=None):
+        """Returns summarized records computed by the database.
+
+           There's one record per distinct value of the keys, ordered by keys,
+           with the sum of each field listed in totalize, a list of
+           (fieldname, conversion function) tuples. Records have the same
+           fields in the same order as the extracted ones : the fields
+           which are neither keys nor totals contain '*'.
+
+           If totalsfromwhere is set the sums are computed from it instead,
+           and fromwhere is only used to know which fields are extracted.
+        """
+        if totalsfromwhere is None:
+            totalsfromwhere = fromwhere
+        sample = list(self.doStreamingSearch(f"SELECT {fields} {fromwhere} LIMIT 1"))
+        if sample:
+            headers = sample[0]
+            totalnames = [fieldname for (fieldname, convert) in totalize]
+            totals = ", ".join([f"SUM({fieldname}) AS {fieldname}" for fieldname in totalnames] + ["COUNT(*) AS nbrecords"])
+            if keys:
+                keynames = ", ".join(keys)
+                query = f"SELECT {keynames}, {totals} {totalsfromwhere} GROUP BY {keynames} ORDER BY {keynames}"
+            else:
+                query = f"SELECT {totals} {totalsfromwhere}"
+            converters = dict(totalize)
+            entries = [headers]
+            for record in self.doRawSearch(query) or []:
+                values = dict(zip(keys + totalnames + ["nbrecords"], record))
+                if not values["nbrecords"]:
+                    continue  # nothing matched
+                summary = ["*"] * len(headers)
+                for (i, fieldname) in enumerate(headers):
+                    if fieldname in converters:
+                        summary[i] = converters[fieldname](values[fieldname] or 0.0)
+                    elif fieldname in values:
+                        summary[i] = values[fieldname]
+                entries.append(summary)
+            if len(entries) > 1:
+                return entries
+
     def extractPrinters(self, extractonly={}, ordering=[]):
         """Extracts all printer records."""
         thefilter = self.createFilter(extractonly)
@@ -209,28 +296,25 @@ class SQLStorage:
                 **locals()))
         return self.prepareRawResult(result)
 
-    def extractPayments(self, extractonly={}, ordering=[]):
-        """Extracts all payment records."""
-        startdate = extractonly.get("start")
-        enddate = extractonly.get("end")
-        for limit in ("start", "end"):
-            try:
-                del extractonly[limit]
-            except KeyError:
-                pass
-        thefilter = self.createFilter(extractonly)
-        if thefilter:
-            thefilter = f"AND {thefilter}"
-        (startdate, enddate) = self.cleanDates(startdate, enddate)
-        if startdate:
-            thefilter = f"{thefilter} AND date>={self.doQuote(startdate)}"
-        if enddate:
-            thefilter = f"{thefilter} AND date<={self.doQuote(enddate)}"
+    def extractPayments(self, extractonly={}, ordering=[], streaming=False):
+        """Extracts all payment records.
+
+           If streaming is set, returns a generator instead of a list.
+        """
+        thefilter = self.createDatedFilter(extractonly, "date")
         orderby = self.createOrderBy(["+payments.id"], ordering)
-        result = self.doRawSearch(
-            "SELECT username,payments.* FROM users,payments WHERE users.id=payments.userid {thefilter} ORDER BY {orderby}".format(
-                **locals()))
-        return self.prepareRawResult(result)
+        query = "SELECT username,payments.* FROM users,payments WHERE users.id=payments.userid {thefilter} ORDER BY {orderby}".format(
+            **locals())
+        if streaming:
+            return self.doStreamingSearch(query)
+        return self.prepareRawResult(self.doRawSearch(query))
+
+    def extractPaymentsSummary(self, extractonly, keys, totalize):
+        """Extracts payment records summarized by the database, see summarizeRecords()."""
+        thefilter = self.createDatedFilter(extractonly, "date")
+        return self.summarizeRecords("username,payments.*",
+                                     f"FROM users,payments WHERE users.id=payments.userid {thefilter}",
+                                     keys, totalize)
 
     def extractUpquotas(self, extractonly={}, ordering=[]):
         """Extracts all userpquota records."""
@@ -283,28 +367,82 @@ class SQLStorage:
                 **locals()))
         return self.prepareRawResult(result)
 
-    def extractHistory(self, extractonly={}, ordering=[]):
-        """Extracts all jobhistory records."""
-        startdate = extractonly.get("start")
-        enddate = extractonly.get("end")
-        for limit in ("start", "end"):
-            try:
-                del extractonly[limit]
-            except KeyError:
-                pass
-        thefilter = self.createFilter(extractonly)
+    def extractHistory(self, extractonly={}, ordering=[], streaming=False):
+        """Extracts all jobhistory records.
+
+           If streaming is set, returns a generator instead of a list.
+        """
+        historytable = self.historyTable(self.cleanDates(extractonly.get("start"), extractonly.get("end"))[0])
+        thefilter = self.createDatedFilter(extractonly, "jobdate")
+        orderby = self.createOrderBy(["+jobhistory.id"], ordering)
+        query = "SELECT users.username,printers.printername,jobhistory.* FROM users,printers,{historytable} WHERE users.id=jobhistory.userid AND printers.id=jobhistory.printerid {thefilter} ORDER BY {orderby}".format(
+            **locals())
+        if streaming:
+            return self.doStreamingSearch(query)
+        return self.prepareRawResult(self.doRawSearch(query))
+
+    def extractHistorySummary(self, extractonly, keys, totalize):
+        """Extracts jobhistory records summarized by the database, see summarizeRecords().
+
+           The sums are read from the daily usage rollups instead of the job
+           history whenever they hold everything needed to compute them.
+        """
+        fields = "users.username,printers.printername,jobhistory.*"
+        fromwhere = "FROM users,printers,{} WHERE users.id=jobhistory.userid AND printers.id=jobhistory.printerid"
+        if self.rollupsCanSummarize(extractonly, keys, totalize):
+            counters = ", ".join([f"jobrollup.{counter} AS {counter}" for counter in ROLLUPCOUNTERS])
+            rollups = f"SELECT users.username AS username, printers.printername AS printername, NULLIF(jobrollup.hostname, '') AS hostname, NULLIF(jobrollup.billingcode, '') AS billingcode, {counters} FROM users,printers,jobrollup WHERE users.id=jobrollup.userid AND printers.id=jobrollup.printerid {self.createRollupFilter(extractonly)}"
+            return self.summarizeRecords(fields, fromwhere.format("jobhistory"), keys, totalize, f"FROM ({rollups}) AS rollups")
+        historytable = self.historyTable(self.cleanDates(extractonly.get("start"), extractonly.get("end"))[0])
+        thefilter = self.createDatedFilter(extractonly, "jobdate")
+        return self.summarizeRecords(fields, f"{fromwhere.format(historytable)} {thefilter}", keys, totalize)
+
+    def extractJobTimings(self, extractonly={}):
+        """Extracts the time spent in each phase of the jobs, see writeJobTimings().
+
+           Returns a generator yielding the headers first, then the
+           records ordered by printer, phase and duration.
+        """
+        thefilter = self.createDatedFilter(extractonly, "jobtimings.jobdate")
+        return self.doStreamingSearch(
+            f"SELECT printers.printername,jobtimings.phase,jobtimings.duration FROM printers,jobtimings WHERE printers.id=jobtimings.printerid {thefilter} ORDER BY printers.printername, jobtimings.phase, jobtimings.duration")
+
+    def coversWholeDays(self, startdate, enddate):
+        """Returns True if the dates, as returned by cleanDates(), delimit whole days."""
+        return ((not startdate) or startdate.endswith(" 00:00:00")) \
+            and ((not enddate) or enddate.endswith(" 23:59:59"))
+
+    def rollupDay(self, date):
+        """Returns the day of a date as returned by cleanDates(), as stored in the daily usage rollups."""
+        return date[:10]
+
+    def rollupsCanSummarize(self, extractonly, keys, totalize):
+        """Returns True if the daily usage rollups can be summarized instead of the job history.
+
+           The rollups aren't maintained when the history is disabled, and they
+           only know about whole days and a subset of the job history's fields.
+        """
+        if self.disablehistory:
+            return False
+        rollupfields = ("username", "printername", "hostname", "billingcode")
+        if [k for k in extractonly.keys() if k not in rollupfields + ("start", "end")] \
+                or [k for k in keys if k not in rollupfields] \
+                or [f for (f, convert) in totalize if f not in ROLLUPCOUNTERS]:
+            return False
+        return self.coversWholeDays(*self.cleanDates(extractonly.get("start"), extractonly.get("end")))
+
+    def createRollupFilter(self, extractonly):
+        """Returns the appropriate SQL filter on the daily usage rollups, prefixed with AND."""
+        only = extractonly.copy()
+        (startdate, enddate) = self.cleanDates(only.pop("start", None), only.pop("end", None))
+        thefilter = self.createFilter(only)
         if thefilter:
             thefilter = f"AND {thefilter}"
-        (startdate, enddate) = self.cleanDates(startdate, enddate)
         if startdate:
-            thefilter = f"{thefilter} AND jobdate>={self.doQuote(startdate)}"
+            thefilter = f"{thefilter} AND day>={self.doQuote(self.rollupDay(startdate))}"
         if enddate:
-            thefilter = f"{thefilter} AND jobdate<={self.doQuote(enddate)}"
-        orderby = self.createOrderBy(["+jobhistory.id"], ordering)
-        result = self.doRawSearch(
-            "SELECT users.username,printers.printername,jobhistory.* FROM users,printers,jobhistory WHERE users.id=jobhistory.userid AND printers.id=jobhistory.printerid {thefilter} ORDER BY {orderby}".format(
-                **locals()))
-        return self.prepareRawResult(result)
+            thefilter = f"{thefilter} AND day<={self.doQuote(self.rollupDay(enddate))}"
+        return thefilter
 
     def filterNames(self, records, attribute, patterns=None):
         """Returns a list of 'attribute' from a list of records.
@@ -361,10 +499,15 @@ class SQLStorage:
 
     def getUserNbJobsFromHistory(self, user):
         """Returns the number of jobs the user has in history."""
-        result = self.doSearch(f"SELECT COUNT(*) AS count FROM jobhistory WHERE userid={self.doQuote(user.ident)}")
-        if result:
-            return result[0]["count"]
-        return 0
+        nbjobs = 0
+        tables = ["jobhistory"]
+        if self.historyTable() != "jobhistory":
+            tables.append("jobhistoryarchive")  # old jobs count too
+        for table in tables:
+            result = self.doSearch(f"SELECT COUNT(*) AS count FROM {table} WHERE userid={self.doQuote(user.ident)}")
+            if result:
+                nbjobs += int(result[0]["count"] or 0)
+        return nbjobs
 
     def getUserFromBackend(self, username):
         """Extracts user information given its name."""
@@ -423,9 +566,13 @@ class SQLStorage:
     def getPrinterLastJobFromBackend(self, printer):
         """Extracts a printer's last job information."""
         result = self.doSearch(
-            "SELECT jobhistory.id, jobid, userid, username, pagecounter, jobsize, jobprice, filename, title, copies, options, hostname, jobdate, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice FROM jobhistory, users WHERE printerid={} AND userid=users.id ORDER BY jobdate DESC LIMIT 1".format(
-                self.doQuote(
-                    printer.ident)))
+            f"SELECT jobhistory.id, jobid, userid, username, pagecounter, jobsize, jobprice, filename, title, copies, options, hostname, jobdate, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice FROM printerlastjob, jobhistory, users WHERE printerlastjob.printerid={self.doQuote(printer.ident)} AND jobhistory.id=printerlastjob.jobhistoryid AND userid=users.id")
+        if not result:
+            # no pointer to the last job yet, e.g. database not fully upgraded
+            result = self.doSearch(
+                "SELECT jobhistory.id, jobid, userid, username, pagecounter, jobsize, jobprice, filename, title, copies, options, hostname, jobdate, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice FROM jobhistory, users WHERE printerid={} AND userid=users.id ORDER BY jobdate DESC LIMIT 1".format(
+                    self.doQuote(
+                        printer.ident)))
         if result:
             return self.storageLastJobFromRecord(printer, result[0])
         else:
@@ -712,6 +859,34 @@ class SQLStorage:
         self.doModify(
             f"UPDATE userpquota SET pagecounter=pagecounter + {self.doQuote(nbpages)},lifepagecounter=lifepagecounter + {self.doQuote(nbpages)} WHERE id={self.doQuote(userpquota.ident)}")
 
+    def chargeJob(self, userpquotas, jobsize, jobprice):
+        """Charges a job to an user : increases the page counters of all the
+           user print quota entries given, and debits the user's account balance
+           if the job's price is not null.
+
+           Returns a tuple (balance, counters) where balance is the new account
+           balance (None if unchanged) and counters a mapping from each user
+           print quota entry's ident to a tuple (pagecounter, lifepagecounter).
+
+           MUST be called from within a transaction : the UPDATE statements
+           lock the modified rows until it ends, so the values read
+           back can't be modified by concurrent jobs in the meantime.
+        """
+        user = userpquotas[0].User
+        upqids = ", ".join([f"{self.doQuote(upq.ident)}" for upq in userpquotas])
+        self.doModify(
+            f"UPDATE userpquota SET pagecounter=pagecounter + {self.doQuote(jobsize)}, lifepagecounter=lifepagecounter + {self.doQuote(jobsize)} WHERE id IN ({upqids})")
+        balance = None
+        if jobprice:
+            self.decreaseUserAccountBalance(user, jobprice)
+            result = self.doRawSearch(f"SELECT balance FROM users WHERE id={self.doQuote(user.ident)}")
+            balance = float(result[0][0] or 0.0)
+        counters = {}
+        result = self.doRawSearch(f"SELECT id, pagecounter, lifepagecounter FROM userpquota WHERE id IN ({upqids})")
+        for (upqid, pagecounter, lifepagecounter) in result:
+            counters[upqid] = (int(pagecounter or 0), int(lifepagecounter or 0))
+        return (balance, counters)
+
     def saveBillingCode(self, bcode):
         """Saves the billing code to the database."""
         self.doModify(
@@ -724,7 +899,9 @@ class SQLStorage:
 
     def refundJob(self, jobident):
         """Marks a job as refunded in the history."""
+        self.updateRollups(f"id={self.doQuote(jobident)}", -1)
         self.doModify(f"UPDATE jobhistory SET action='REFUND' WHERE id={self.doQuote(jobident)};")
+        self.updateRollups(f"id={self.doQuote(jobident)}")
 
     def decreaseUserAccountBalance(self, user, amount):
         """Decreases user's account balance from an amount."""
@@ -742,8 +919,10 @@ class SQLStorage:
 
     def writeLastJobSize(self, lastjob, jobsize, jobprice):
         """Sets the last job's size permanently."""
+        self.updateRollups(f"id={self.doQuote(lastjob.ident)}", -1)
         self.doModify(
             f"UPDATE jobhistory SET jobsize={self.doQuote(jobsize)}, jobprice={self.doQuote(jobprice)} WHERE id={self.doQuote(lastjob.ident)}")
+        self.updateRollups(f"id={self.doQuote(lastjob.ident)}")
 
     def writeJobNew(self, printer, user, jobid, pagecounter, action, jobsize=None, jobprice=None, filename=None,
                     title=None, copies=None, options=None, clienthost=None, jobsizebytes=None, jobmd5sum=None,
@@ -763,10 +942,191 @@ class SQLStorage:
             else:
                 self.doModify(
                     f"INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES ({self.doQuote(user.ident)}, {self.doQuote(printer.ident)}, {self.doQuote(jobid)}, {self.doQuote(pagecounter)}, {self.doQuote(action)}, {self.doQuote(filename)}, {self.doQuote(title)}, {self.doQuote(copies)}, {self.doQuote(options)}, {self.doQuote(clienthost)}, {self.doQuote(jobsizebytes)}, {self.doQuote(jobmd5sum)}, {self.doQuote(jobpages)}, {self.doQuote(jobbilling)}, {self.doQuote(precomputedsize)}, {self.doQuote(precomputedprice)})")
+            self.writePrinterLastJob(printer, self.lastInsertedIdExpression("jobhistory"))
+            self.updateRollups(f"id=(SELECT jobhistoryid FROM printerlastjob WHERE printerid={self.doQuote(printer.ident)})")
         else:
             # here we explicitly want to reset jobsize to NULL if needed
             self.doModify(
                 f"UPDATE jobhistory SET userid={self.doQuote(user.ident)}, jobid={self.doQuote(jobid)}, pagecounter={self.doQuote(pagecounter)}, action={self.doQuote(action)}, jobsize={self.doQuote(jobsize)}, jobprice={self.doQuote(jobprice)}, filename={self.doQuote(filename)}, title={self.doQuote(title)}, copies={self.doQuote(copies)}, options={self.doQuote(options)}, hostname={self.doQuote(clienthost)}, jobsizebytes={self.doQuote(jobsizebytes)}, md5sum={self.doQuote(jobmd5sum)}, pages={self.doQuote(jobpages)}, billingcode={self.doQuote(jobbilling)}, precomputedjobsize={self.doQuote(precomputedsize)}, precomputedjobprice={self.doQuote(precomputedprice)}, jobdate=now() WHERE id={self.doQuote(printer.LastJob.ident)}")
+            self.writePrinterLastJob(printer, self.doQuote(printer.LastJob.ident))
+
+    def writePrinterLastJob(self, printer, jobhistoryid):
+        """Makes a printer's last job pointer refer to a job history entry.
+
+           jobhistoryid is an SQL expression, not necessarily a value.
+        """
+        self.doModify(f"DELETE FROM printerlastjob WHERE printerid={self.doQuote(printer.ident)}")
+        self.doModify(
+            f"INSERT INTO printerlastjob (printerid, jobhistoryid) VALUES ({self.doQuote(printer.ident)}, {jobhistoryid})")
+
+    def rollupConflictClause(self):
+        """Returns the SQL clause which adds the counters to already existing daily usage rollups."""
+        updates = ", ".join([f"{counter}=jobrollup.{counter}+excluded.{counter}" for counter in ROLLUPCOUNTERS])
+        return f"ON CONFLICT ({', '.join(ROLLUPKEYS)}) DO UPDATE SET {updates}"
+
+    def updateRollups(self, where, sign=1):
+        """Adds the jobhistory records matching where to the daily usage rollups.
+
+           If sign is -1 they are subtracted instead, which is needed
+           before modifying a job already accounted for.
+        """
+        if not self.disablehistory:
+            rollupkeys = "DATE(jobdate), userid, printerid, COALESCE(action, ''), COALESCE(billingcode, ''), COALESCE(hostname, '')"
+            self.doModify(
+                f"INSERT INTO jobrollup ({', '.join(ROLLUPKEYS + ROLLUPCOUNTERS)}) SELECT {rollupkeys}, {sign}*COUNT(*), {sign}*SUM(CASE WHEN jobsize<>0 THEN 1 ELSE 0 END), {sign}*COALESCE(SUM(jobsize), 0), {sign}*COALESCE(SUM(jobsizebytes), 0), {sign}*COALESCE(SUM(jobprice), 0.0), {sign}*COALESCE(SUM(CASE WHEN jobsize<>0 THEN jobprice ELSE 0.0 END), 0.0), {sign}*COALESCE(SUM(precomputedjobsize), 0), {sign}*COALESCE(SUM(precomputedjobprice), 0.0) FROM jobhistory WHERE {where} GROUP BY {rollupkeys} {self.rollupConflictClause()}")
+
+    def prepareHistoryPartition(self, date=None):
+        """Makes sure the job history can receive jobs printed at date, now if None.
+
+           Nothing to do unless the job history is partitioned.
+        """
+        pass
+
+    def journalDateToDatabase(self, timestamp):
+        """Converts a journalled job's timestamp to the database's date format."""
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+    def writeManyJobs(self, records):
+        """Inserts many journalled jobs into the history at once.
+
+           Records already present, identified by their printer, job id
+           and MD5 sum, are skipped, so replaying a journal is idempotent.
+        """
+        jobids = ", ".join(set([f"{self.doQuote(r['jobid'])}" for r in records]))
+        printerids = ", ".join(set([f"{self.doQuote(r['printerid'])}" for r in records]))
+        firstdate = self.journalDateToDatabase(min([r["jobdate"] for r in records]))
+        lastdate = self.journalDateToDatabase(max([r["jobdate"] for r in records]))
+        existing = set()
+        # bounded by printer and date, so that the (printerid, jobdate) index is used
+        result = self.doRawSearch(
+            f"SELECT printerid, jobid, md5sum FROM jobhistory WHERE printerid IN ({printerids}) AND jobdate>={self.doQuote(firstdate)} AND jobdate<={self.doQuote(lastdate)} AND jobid IN ({jobids})")
+        for (printerid, jobid, md5sum) in (result or []):
+            existing.add((printerid, jobid, md5sum))
+        values = []
+        rollups = {}
+        for r in records:
+            key = (r["printerid"], r["jobid"], r["md5sum"])
+            if key in existing:
+                self.tool.logdebug(f"Job {r['jobid']} on printer {r['printername']} already in history, skipped.")
+                continue
+            existing.add(key)
+            self.addToRollups(rollups, self.journalDateToDatabase(r["jobdate"]), r)
+            values.append(
+                f"({self.doQuote(r['userid'])}, {self.doQuote(r['printerid'])}, {self.doQuote(r['jobid'])}, {self.doQuote(r['pagecounter'])}, {self.doQuote(r['action'])}, {self.doQuote(r['jobsize'])}, {self.doQuote(r['jobprice'])}, {self.doQuote(r['filename'])}, {self.doQuote(r['title'])}, {self.doQuote(r['copies'])}, {self.doQuote(r['options'])}, {self.doQuote(r['hostname'])}, {self.doQuote(r['jobsizebytes'])}, {self.doQuote(r['md5sum'])}, {self.doQuote(r['pages'])}, {self.doQuote(r['billingcode'])}, {self.doQuote(r['precomputedjobsize'])}, {self.doQuote(r['precomputedjobprice'])}, {self.doQuote(self.journalDateToDatabase(r['jobdate']))})")
+        if values:
+            queries = [
+                "INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice, jobdate) VALUES " + ", ".join(values),
+                f"DELETE FROM printerlastjob WHERE printerid IN ({printerids})",
+                f"INSERT INTO printerlastjob (printerid, jobhistoryid) SELECT printerid, MAX(id) FROM jobhistory WHERE printerid IN ({printerids}) AND jobdate>={self.doQuote(firstdate)} GROUP BY printerid"]
+            queries.append(self.rollupsQuery(rollups))
+            self.multipleQueriesInTransaction(queries)
+
+    def addToRollups(self, rollups, jobdate, record):
+        """Adds a job's counters to the daily usage rollups being computed in rollups."""
+        counters = rollups.setdefault((jobdate[:10], record["userid"], record["printerid"],
+                                       record["action"] or "", record["billingcode"] or "", record["hostname"] or ""),
+                                      [0] * len(ROLLUPCOUNTERS))
+        jobsize = record["jobsize"] or 0
+        jobprice = record["jobprice"] or 0.0
+        for (i, value) in enumerate((1, jobsize and 1, jobsize, record["jobsizebytes"] or 0, jobprice,
+                                     jobsize and jobprice, record["precomputedjobsize"] or 0,
+                                     record["precomputedjobprice"] or 0.0)):
+            counters[i] += value
+
+    def rollupsQuery(self, rollups):
+        """Returns the query which adds the daily usage rollups computed by addToRollups()."""
+        rollupvalues = ", ".join(["(" + ", ".join([f"{self.doQuote(v)}" for v in key + tuple(counters)]) + ")"
+                                  for (key, counters) in rollups.items()])
+        return f"INSERT INTO jobrollup ({', '.join(ROLLUPKEYS + ROLLUPCOUNTERS)}) VALUES {rollupvalues} {self.rollupConflictClause()}"
+
+    def writeJobTimings(self, printer, jobid, timings):
+        """Saves the time spent in each phase of a job, timings being a list of (phase, seconds) tuples."""
+        if timings:
+            jobdate = self.journalDateToDatabase(time.time())
+            values = ", ".join([f"({self.doQuote(printer.ident)}, {self.doQuote(jobid)}, {self.doQuote(phase)}, {self.doQuote(float(duration))}, {self.doQuote(jobdate)})"
+                                for (phase, duration) in timings])
+            self.doModify(f"INSERT INTO jobtimings (printerid, jobid, phase, duration, jobdate) VALUES {values}")
+
+    def retrieveIdentifiers(self, table, namefield):
+        """Returns a mapping from the names to the ids of all the records of a table, see pkimport."""
+        return dict([(name, ident) for (ident, name) in (self.doRawSearch(f"SELECT id, {namefield} FROM {table}") or [])])
+
+    def retrieveExistingPairs(self, table, fields):
+        """Returns the set of the values of a pair of fields in all the records of a table, see pkimport."""
+        return set([tuple(record) for record in (self.doRawSearch(f"SELECT {', '.join(fields)} FROM {table}") or [])])
+
+    def insertManyRecords(self, table, fields, records):
+        """Inserts many records into a table at once, see pkimport.
+
+           Each record is a sequence of values in the same order as fields.
+        """
+        for i in range(0, len(records), STREAMINGBATCHSIZE):
+            values = ", ".join(["(" + ", ".join([f"{self.doQuote(value)}" for value in record]) + ")"
+                                for record in records[i:i + STREAMINGBATCHSIZE]])
+            self.doModify(f"INSERT INTO {table} ({', '.join(fields)}) VALUES {values}")
+
+    def importPayments(self, records, checkexisting=False):
+        """Inserts many payments from a dump at once, see pkimport.
+
+           records are dicts with the payments table's fields. If
+           checkexisting is set, payments already present, identified
+           by their user, amount and date, are skipped.
+           Returns the number of payments inserted.
+        """
+        if checkexisting and records:
+            userids = ", ".join(set([f"{self.doQuote(r['userid'])}" for r in records]))
+            dates = [r["date"] for r in records if r["date"] is not None]
+            where = f"userid IN ({userids})"
+            if dates:
+                where += f" AND date>={self.doQuote(min(dates))} AND date<={self.doQuote(max(dates))}"
+            existing = set([(userid, float(amount or 0.0), str(date)[:19])
+                            for (userid, amount, date) in (self.doRawSearch(f"SELECT userid, amount, date FROM payments WHERE {where}") or [])])
+            records = [r for r in records
+                       if (r["userid"], float(r["amount"] or 0.0), str(r["date"])[:19]) not in existing]
+        self.insertManyRecords("payments", ("userid", "amount", "description", "date"),
+                               [(r["userid"], r["amount"], r["description"], r["date"]) for r in records])
+        return len(records)
+
+    def importJobs(self, records, checkexisting=False):
+        """Inserts many jobs from a dump into the history at once, see pkimport.
+
+           records are dicts with the jobhistory table's fields. If
+           checkexisting is set, jobs already present, identified by
+           their printer, job id and MD5 sum, are skipped. The daily
+           usage rollups are maintained, but not the printers' last
+           jobs, see updatePrinterLastJobs().
+           Returns the number of jobs inserted.
+        """
+        if checkexisting and records:
+            jobids = ", ".join(set([f"{self.doQuote(r['jobid'])}" for r in records]))
+            printerids = ", ".join(set([f"{self.doQuote(r['printerid'])}" for r in records]))
+            dates = [r["jobdate"] for r in records if r["jobdate"] is not None]
+            where = f"printerid IN ({printerids}) AND jobid IN ({jobids})"
+            if dates:
+                where += f" AND jobdate>={self.doQuote(min(dates))} AND jobdate<={self.doQuote(max(dates))}"
+            existing = set([tuple(record)
+                            for record in (self.doRawSearch(f"SELECT printerid, jobid, md5sum FROM jobhistory WHERE {where}") or [])])
+            records = [r for r in records if (r["printerid"], r["jobid"], r["md5sum"]) not in existing]
+        if records:
+            rollups = {}
+            months = {}
+            for r in records:
+                months.setdefault(r["jobdate"][:7], r["jobdate"])
+                self.addToRollups(rollups, r["jobdate"], r)
+            for jobdate in months.values():
+                self.prepareHistoryPartition(jobdate)
+            self.insertManyRecords("jobhistory", IMPORTJOBFIELDS, [[r[field] for field in IMPORTJOBFIELDS] for r in records])
+            if not self.disablehistory:
+                self.doModify(self.rollupsQuery(rollups))
+        return len(records)
+
+    def updatePrinterLastJobs(self, printerids):
+        """Sets the last job of each printer to its most recently printed one, see pkimport."""
+        if printerids:
+            printerids = ", ".join([f"{self.doQuote(printerid)}" for printerid in printerids])
+            self.doModify(f"DELETE FROM printerlastjob WHERE printerid IN ({printerids})")
+            self.doModify(
+                f"INSERT INTO printerlastjob (printerid, jobhistoryid) SELECT printerid, MAX(id) FROM jobhistory WHERE (printerid, jobdate) IN (SELECT printerid, MAX(jobdate) FROM jobhistory WHERE printerid IN ({printerids}) GROUP BY printerid) GROUP BY printerid")
 
     def saveUserPQuota(self, userpquota):
         """Saves an user print quota entry."""
@@ -808,7 +1168,7 @@ class SQLStorage:
                         start=None, end=None):
         """Retrieves all print jobs for user on printer (or all) between start and end date, limited to first 100
         results. """
-        query = "SELECT jobhistory.*,username,printername FROM jobhistory,users,printers WHERE users.id=userid AND " \
+        query = f"SELECT jobhistory.*,username,printername FROM {self.historyTable(start)},users,printers WHERE users.id=userid AND " \
                 "printers.id=printerid "
         where = []
         if user is not None:  # user.ident is None anyway if user doesn't exist
@@ -839,6 +1199,112 @@ class SQLStorage:
                 jobs.append(job)
         return jobs
 
+    def historyTable(self, startdate=None):
+        """Returns the job history table to read jobs printed since startdate from.
+
+           The archive of old jobs is only read if startdate, as returned
+           by cleanDates(), is older than the most recent archived job.
+        """
+        if self.lastarchiveddate is None:
+            result = self.doRawSearch("SELECT MAX(jobdate) FROM jobhistoryarchive")
+            self.lastarchiveddate = str((result and result[0][0]) or "")
+        if self.lastarchiveddate and ((not startdate) or (str(startdate) <= self.lastarchiveddate)):
+            return "(SELECT * FROM jobhistory UNION ALL SELECT * FROM jobhistoryarchive) AS jobhistory"
+        return "jobhistory"
+
+    def monthLimits(self, month):
+        """Returns the first second of a YYYY-MM month and of the next one."""
+        (year, month) = [int(part) for part in month.split("-")]
+        (nextyear, nextmonth) = divmod(year * 12 + month, 12)
+        return (f"{year:04d}-{month:02d}-01 00:00:00", f"{nextyear:04d}-{nextmonth + 1:02d}-01 00:00:00")
+
+    def archivableHistoryFilter(self, table, month):
+        """Returns the SQL filter on the jobs of a month which can leave table.
+
+           The printers' last jobs always stay in the job history.
+        """
+        (first, following) = self.monthLimits(month)
+        return f"{table}.jobdate>={self.doQuote(first)} AND {table}.jobdate<{self.doQuote(following)} AND {table}.id NOT IN (SELECT jobhistoryid FROM printerlastjob)"
+
+    def getHistoryMonths(self, before):
+        """Returns the months before a date in which jobs were printed.
+
+           Each month is a (month, archived, nbjobs) tuple, month being
+           formatted as YYYY-MM and archived telling if the jobs are
+           in the archive of old jobs or still in the job history.
+        """
+        months = []
+        month = self.monthExpression("jobdate")
+        for (table, archived) in (("jobhistory", False), ("jobhistoryarchive", True)):
+            result = self.doRawSearch(
+                f"SELECT {month}, COUNT(*) FROM {table} WHERE jobdate<{self.doQuote(before)} GROUP BY {month}")
+            for (jobmonth, nbjobs) in (result or []):
+                months.append((str(jobmonth), archived, int(nbjobs)))
+        months.sort()
+        return months
+
+    def extractHistoryMonth(self, month, archived=False):
+        """Extracts the jobs of a month which can be exported, see extractHistory().
+
+           Returns a generator yielding the headers first.
+        """
+        table = (archived and "jobhistoryarchive") or "jobhistory"
+        return self.doStreamingSearch(
+            f"SELECT users.username,printers.printername,{table}.* FROM users,printers,{table} WHERE users.id={table}.userid AND printers.id={table}.printerid AND {self.archivableHistoryFilter(table, month)} ORDER BY {table}.id")
+
+    def deleteHistoryMonth(self, month, archived=False):
+        """Deletes the jobs of a month which can be exported, see extractHistoryMonth()."""
+        table = (archived and "jobhistoryarchive") or "jobhistory"
+        self.doModify(f"DELETE FROM {table} WHERE {self.archivableHistoryFilter(table, month)}")
+        self.lastarchiveddate = None
+
+    def archiveHistoryMonth(self, month, tablespace=None):
+        """Moves the jobs of a month from the job history to the archive of old jobs.
+
+           Returns the number of jobs moved. tablespace is only
+           meaningful with PostgreSQL.
+        """
+        where = self.archivableHistoryFilter("jobhistory", month)
+        result = self.doRawSearch(f"SELECT COUNT(*) FROM jobhistory WHERE {where}")
+        nbjobs = int(result[0][0])
+        if nbjobs:
+            self.doModify(f"INSERT INTO jobhistoryarchive SELECT * FROM jobhistory WHERE {where}")
+            self.doModify(f"DELETE FROM jobhistory WHERE {where}")
+        self.lastarchiveddate = None
+        return nbjobs
+
+    def retrieveUsageSummary(self, user=None, printer=None, hostname=None, billingcode=None, start=None, end=None):
+        """Retrieves each user's number of jobs, pages and credits from the daily usage rollups.
+
+           Only jobs which were neither denied, cancelled nor refunded, and
+           which have a size, are counted. Returns None if the rollups can't
+           be used, in which case the job history has to be read instead.
+        """
+        if self.disablehistory or not self.coversWholeDays(start, end):
+            return None
+        where = []
+        if user is not None:  # user.ident is None anyway if user doesn't exist
+            where.append(f"userid={self.doQuote(user.ident)}")
+        if printer is not None:  # printer.ident is None anyway if printer doesn't exist
+            where.append(f"printerid={self.doQuote(printer.ident)}")
+        if hostname is not None:
+            where.append(f"hostname={self.doQuote(hostname)}")
+        if billingcode is not None:
+            where.append(f"billingcode={self.doQuote(self.userCharsetToDatabase(billingcode))}")
+        if start is not None:
+            where.append(f"day>={self.doQuote(self.rollupDay(start))}")
+        if end is not None:
+            where.append(f"day<={self.doQuote(self.rollupDay(end))}")
+        thefilter = "".join([f" AND {expression}" for expression in where])
+        result = self.doSearch(
+            f"SELECT username, SUM(nbprintedjobs) AS nbjobs, SUM(jobsize) AS nbpages, SUM(printedjobprice) AS nbcredits FROM jobrollup, users WHERE users.id=userid AND action NOT IN ('DENY', 'CANCEL', 'REFUND'){thefilter} GROUP BY username HAVING SUM(nbprintedjobs) > 0")
+        peruser = {}
+        for fields in (result or []):
+            peruser[self.databaseToUserCharset(fields["username"])] = {"nbjobs": int(fields["nbjobs"]),
+                                                                       "nbpages": int(fields["nbpages"] or 0),
+                                                                       "nbcredits": float(fields["nbcredits"] or 0.0)}
+        return peruser
+
     def deleteUser(self, user):
         """Completely deletes an user from the database."""
         # TODO : What should we do if we delete the last person who used a given printer ?
@@ -847,7 +1313,10 @@ class SQLStorage:
         for q in [
             f"DELETE FROM payments WHERE userid={self.doQuote(user.ident)}",
             f"DELETE FROM groupsmembers WHERE userid={self.doQuote(user.ident)}",
+            f"DELETE FROM printerlastjob WHERE jobhistoryid IN (SELECT id FROM jobhistory WHERE userid={self.doQuote(user.ident)})",
             f"DELETE FROM jobhistory WHERE userid={self.doQuote(user.ident)}",
+            f"DELETE FROM jobhistoryarchive WHERE userid={self.doQuote(user.ident)}",
+            f"DELETE FROM jobrollup WHERE userid={self.doQuote(user.ident)}",
             f"DELETE FROM userpquota WHERE userid={self.doQuote(user.ident)}",
             f"DELETE FROM users WHERE id={self.doQuote(user.ident)}",
         ]:
@@ -879,7 +1348,10 @@ class SQLStorage:
             self.multipleQueriesInTransaction([
                 f"DELETE FROM payments WHERE userid IN ({userids})",
                 f"DELETE FROM groupsmembers WHERE userid IN ({userids})",
+                f"DELETE FROM printerlastjob WHERE jobhistoryid IN (SELECT id FROM jobhistory WHERE userid IN ({userids}))",
                 f"DELETE FROM jobhistory WHERE userid IN ({userids})",
+                f"DELETE FROM jobhistoryarchive WHERE userid IN ({userids})",
+                f"DELETE FROM jobrollup WHERE userid IN ({userids})",
                 f"DELETE FROM userpquota WHERE userid IN ({userids})",
                 f"DELETE FROM users WHERE id IN ({userids})", ])
 
@@ -898,7 +1370,11 @@ class SQLStorage:
         if printerids:
             self.multipleQueriesInTransaction([
                 f"DELETE FROM printergroupsmembers WHERE groupid IN ({printerids}) OR printerid IN ({printerids})",
+                f"DELETE FROM printerlastjob WHERE printerid IN ({printerids})",
                 f"DELETE FROM jobhistory WHERE printerid IN ({printerids})",
+                f"DELETE FROM jobhistoryarchive WHERE printerid IN ({printerids})",
+                f"DELETE FROM jobrollup WHERE printerid IN ({printerids})",
+                f"DELETE FROM jobtimings WHERE printerid IN ({printerids})",
                 f"DELETE FROM grouppquota WHERE printerid IN ({printerids})",
                 f"DELETE FROM userpquota WHERE printerid IN ({printerids})",
                 f"DELETE FROM printers WHERE id IN ({printerids})", ])
@@ -909,7 +1385,10 @@ class SQLStorage:
         userids = ", ".join([f"{self.doQuote(u.ident)}" for u in users])
         if userids and printerids:
             self.multipleQueriesInTransaction([
+                f"DELETE FROM printerlastjob WHERE jobhistoryid IN (SELECT id FROM jobhistory WHERE userid IN ({userids}) AND printerid IN ({printerids}))",
                 f"DELETE FROM jobhistory WHERE userid IN ({userids}) AND printerid IN ({printerids})",
+                f"DELETE FROM jobhistoryarchive WHERE userid IN ({userids}) AND printerid IN ({printerids})",
+                f"DELETE FROM jobrollup WHERE userid IN ({userids}) AND printerid IN ({printerids})",
                 f"DELETE FROM userpquota WHERE userid IN ({userids}) AND printerid IN ({printerids})", ])
 
     def deleteManyGroupPQuotas(self, printers, groups):
@@ -923,7 +1402,10 @@ class SQLStorage:
     def deleteUserPQuota(self, upquota):
         """Completely deletes an user print quota entry from the database."""
         for q in [
+            f"DELETE FROM printerlastjob WHERE jobhistoryid IN (SELECT id FROM jobhistory WHERE userid={self.doQuote(upquota.User.ident)} AND printerid={self.doQuote(upquota.Printer.ident)})",
             f"DELETE FROM jobhistory WHERE userid={self.doQuote(upquota.User.ident)} AND printerid={self.doQuote(upquota.Printer.ident)}",
+            f"DELETE FROM jobhistoryarchive WHERE userid={self.doQuote(upquota.User.ident)} AND printerid={self.doQuote(upquota.Printer.ident)}",
+            f"DELETE FROM jobrollup WHERE userid={self.doQuote(upquota.User.ident)} AND printerid={self.doQuote(upquota.Printer.ident)}",
             f"DELETE FROM userpquota WHERE id={self.doQuote(upquota.ident)}",
         ]:
             self.doModify(q)
@@ -948,7 +1430,11 @@ class SQLStorage:
         """Completely deletes a printer from the database."""
         for q in [
             f"DELETE FROM printergroupsmembers WHERE groupid={self.doQuote(printer.ident)} OR printerid={self.doQuote(printer.ident)}",
+            f"DELETE FROM printerlastjob WHERE printerid={self.doQuote(printer.ident)}",
             f"DELETE FROM jobhistory WHERE printerid={self.doQuote(printer.ident)}",
+            f"DELETE FROM jobhistoryarchive WHERE printerid={self.doQuote(printer.ident)}",
+            f"DELETE FROM jobrollup WHERE printerid={self.doQuote(printer.ident)}",
+            f"DELETE FROM jobtimings WHERE printerid={self.doQuote(printer.ident)}",
             f"DELETE FROM grouppquota WHERE printerid={self.doQuote(printer.ident)}",
             f"DELETE FROM userpquota WHERE printerid={self.doQuote(printer.ident)}",
             f"DELETE FROM printers WHERE id={self.doQuote(printer.ident)}",
@@ -25,11 +25,14 @@
 """This module defines a class to access to a SQLite database backend."""
 
 import time
+import random
 
 from pykota.storage import PyKotaStorageError, BaseStorage
-from pykota.storages.sql import SQLStorage
+from pykota.storages.sql import SQLStorage, STREAMINGBATCHSIZE
 import sqlite3 as sqlite
 
+BUSYRETRIES = 5  # number of retries when the database stays locked after the busy timeout
+
 
 class Storage(BaseStorage, SQLStorage):
     def __init__(self, pykotatool, host, dbname, user, passwd):
@@ -37,11 +40,41 @@ class Storage(BaseStorage, SQLStorage):
         BaseStorage.__init__(self, pykotatool)
 
         self.tool.logdebug(f"Trying to open database (dbname={dbname})...")
-        self.database = sqlite.connect(dbname, isolation_level=None)
+        busytimeout = pykotatool.config.get_sqlite_busy_timeout()
+        self.database = sqlite.connect(dbname, isolation_level=None, timeout=busytimeout / 1000.0)
         self.cursor = self.database.cursor()
         self.closed = 0
+        # concurrent readers don't block the writer with WAL, and fsync
+        # is only needed at checkpoints, which is still crash safe.
+        for pragma in ("journal_mode=WAL",
+                       "synchronous=NORMAL",
+                       f"busy_timeout={busytimeout}",
+                       f"cache_size=-{pykotatool.config.get_sqlite_cache_size()}",
+                       f"mmap_size={pykotatool.config.get_sqlite_mmap_size()}"):
+            try:
+                self.cursor.execute(f"PRAGMA {pragma};")
+            except self.database.Error as msg:
+                self.tool.logdebug(f"PRAGMA {pragma} failed : {repr(msg)}")
         self.tool.logdebug(f"Database opened (dbname={dbname})")
 
+    def retryWhenBusy(self, function, *args):
+        """Calls function, retrying after a random delay while the database is locked.
+
+           SQLite already waits up to the busy timeout for the lock,
+           the jitter spreads the retries of processes which gave up
+           at the same time.
+        """
+        for attempt in range(BUSYRETRIES):
+            try:
+                return function(*args)
+            except sqlite.OperationalError as msg:
+                if "locked" not in str(msg):
+                    raise
+                delay = random.uniform(0.0, 0.05 * (2 ** attempt))
+                self.tool.logdebug(f"Database locked, retrying in {delay:.3f} seconds...")
+                time.sleep(delay)
+        return function(*args)
+
     def close(self):
         """Closes the database connection."""
         if not self.closed:
@@ -49,26 +82,26 @@ class Storage(BaseStorage, SQLStorage):
             self.database.close()
             self.closed = 1
             self.tool.logdebug("Database closed.")
+            self.reportStatistics()
 
     def beginTransaction(self):
         """Starts a transaction."""
         self.before = time.time()
-        self.cursor.execute("BEGIN;")
+        # takes the write lock at once, so that the transaction can't fail midway
+        self.retryWhenBusy(self.cursor.execute, "BEGIN IMMEDIATE;")
         self.tool.logdebug("Transaction begins...")
 
     def commitTransaction(self):
         """Commits a transaction."""
-        self.cursor.execute("COMMIT;")
-        after = time.time()
+        self.retryWhenBusy(self.cursor.execute, "COMMIT;")
+        self.recordQuery("BEGIN ... COMMIT", time.time() - self.before)
         self.tool.logdebug("Transaction committed.")
-        # self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
 
     def rollbackTransaction(self):
         """Rollbacks a transaction."""
         self.cursor.execute("ROLLBACK;")
-        after = time.time()
+        self.recordQuery("BEGIN ... ROLLBACK", time.time() - self.before)
         self.tool.logdebug("Transaction aborted.")
-        # self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
 
     def doRawSearch(self, query):
         """Does a raw search query."""
@@ -83,10 +116,43 @@ class Storage(BaseStorage, SQLStorage):
             raise PyKotaStorageError(str(msg))
         else:
             result = self.cursor.fetchall()
-            after = time.time()
-            # self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            self.recordQuery(query, time.time() - before, len(result))
             return result
 
+    def doStreamingSearch(self, query, batchsize=STREAMINGBATCHSIZE):
+        """Does a raw search query, fetching records iteratively.
+
+           Yields the headers first, then each record, fetching them
+           in batches of batchsize records. Yields nothing if there's no record.
+        """
+        query = query.strip()
+        if not query.endswith(';'):
+            query += ';'
+        cursor = self.database.cursor()
+        duration = 0.0  # time spent in the database only
+        nbrows = 0
+        try:
+            try:
+                self.tool.logdebug(f"QUERY : {query}")
+                before = time.time()
+                cursor.execute(query)
+                result = cursor.fetchmany(batchsize)
+                duration += time.time() - before
+                if result:
+                    yield tuple([f[0] for f in cursor.description])
+                while result:
+                    nbrows += len(result)
+                    for record in result:
+                        yield self.prepareRawRecord(record)
+                    before = time.time()
+                    result = cursor.fetchmany(batchsize)
+                    duration += time.time() - before
+            except self.database.Error as msg:
+                raise PyKotaStorageError(str(msg))
+        finally:
+            cursor.close()
+            self.recordQuery(query, duration, nbrows)
+
     def doSearch(self, query):
         """Does a search query."""
         result = self.doRawSearch(query)
@@ -115,13 +181,12 @@ class Storage(BaseStorage, SQLStorage):
         try:
             before = time.time()
             self.tool.logdebug(f"QUERY : {query}")
-            self.cursor.execute(query)
+            self.retryWhenBusy(self.cursor.execute, query)
         except self.database.Error as msg:
             self.tool.logdebug(f"Query failed : {repr(msg)}")
             raise PyKotaStorageError(str(msg))
         else:
-            after = time.time()
-            # self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            self.recordQuery(query, time.time() - before, max(self.cursor.rowcount, 0))
 
     def doQuote(self, field):
         """Quotes a field for use as a string in SQL queries."""
@@ -136,6 +201,36 @@ class Storage(BaseStorage, SQLStorage):
         else:
             return "NULL"
 
+    def journalDateToDatabase(self, timestamp):
+        """Converts a journalled job's timestamp to the database's date format.
+
+           SQLite's CURRENT_TIMESTAMP is in UTC.
+        """
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp))
+
+    def lastInsertedIdExpression(self, table):
+        """Returns an SQL expression giving the id of the last record inserted into table."""
+        return "last_insert_rowid()"
+
+    def monthExpression(self, field):
+        """Returns an SQL expression giving the YYYY-MM month of a date field."""
+        return f"strftime('%Y-%m', {field})"
+
+    def insertManyRecords(self, table, fields, records):
+        """Inserts many records into a table at once, see SQLStorage.insertManyRecords()."""
+        if not records:
+            return
+        try:
+            before = time.time()
+            self.tool.logdebug(f"QUERY : INSERT INTO {table} ({', '.join(fields)}) ({len(records)} records)")
+            self.retryWhenBusy(self.cursor.executemany,
+                               f"INSERT INTO {table} ({', '.join(fields)}) VALUES ({', '.join(['?'] * len(fields))})",
+                               records)
+            self.recordQuery(f"INSERT INTO {table} ({', '.join(fields)}) VALUES (?, ...)", time.time() - before, len(records))
+        except self.database.Error as msg:
+            self.tool.logdebug(f"Query failed : {repr(msg)}")
+            raise PyKotaStorageError(str(msg))
+
     def prepareRawResult(self, result):
         """Prepares a raw result by including the headers."""
         if result:
@@ -29,28 +29,22 @@ import os
 import pwd
 import fnmatch
 import getopt
-import smtplib
 import gettext
 import locale
 import socket
 import time
-from email.mime import text
-from email.header import Header
-import email.utils
 
 
 from datetime import datetime
 
-try:
-    import chardet
-except ImportError:
-    def detectCharset(text_charset):
-        """Fakes a charset detection if the chardet module is not installed."""
+
+def detectCharset(text_charset):
+    """Uses the chardet module if installed to workaround CUPS lying to us."""
+    try:
+        import chardet
+    except ImportError:
         return "UTF-8"
-else:
-    def detectCharset(text_charset):
-        """Uses the chardet module to workaround CUPS lying to us."""
-        return chardet.detect(text_charset)["encoding"] or "UTF-8"
+    return chardet.detect(text_charset)["encoding"] or "UTF-8"
 
 from pykota import config, storage, logger
 from pykota.version import __version__, __author__, __years__, __gplblurb__
@@ -141,6 +135,7 @@ class Tool:
     def __init__(self, lang="", charset=None, doc="PyKota v%(__version__)s (c) %(__years__)s %(__author__)s"):
         """Initializes the command line tool."""
         self.storage = None
+        self.showstats = False  # see --stats
         self.debug = True  # in case of early failure
         self.logger = logger.open_logger("stderr")
 
@@ -217,6 +212,8 @@ class Tool:
                     f"The 'pykota' system account is missing. Configuration files were searched in {confdir} instead.",
                     "warn")
 
+        if self.config.fromSnapshot:
+            self.logdebug(f"Configuration read from {self.config.snapshotfilename}")
         self.logdebug(f"Language in use : {self.language}")
         self.logdebug(f"Charset in use : {self.charset}")
 
@@ -377,6 +374,10 @@ class Tool:
         try:
             crashrecipient = self.config.get_crash_recipient()
             if crashrecipient:
+                import smtplib
+                import email.utils
+                from email.mime import text
+                from email.header import Header
                 admin = self.config.get_admin_mail("global")  # Nice trick, isn't it ?
                 server = smtplib.SMTP(self.smtpserver)
                 msg = text.MIMEText(fullmessage, _charset=self.charset)
@@ -396,6 +397,7 @@ class Tool:
         # split options in two lists: those which need an argument, those which don't need any
         short = f"{short}A:"
         long.append("arguments=")
+        long.append("stats")  # all tools can report their storage statistics when done
         withoutarg = []
         witharg = []
         lgs = len(short)
@@ -465,11 +467,13 @@ class Tool:
                             argv[i] = argi[1:-1]
                 else:
                     done = 1
+        self.showstats = parsed["stats"]
         return (parsed, args)
 
 
 class PyKotaTool(Tool):
     """Base class for all PyKota command line tools."""
+    readonlystorage = False  # tools which never write can use a replica, see storagereplicas
 
     def __init__(self, lang="", charset=None, doc="PyKota v%(__version__)s (c) %(__years__)s %(__author__)s"):
         """Initializes the command line tool and opens the database."""
@@ -501,6 +505,7 @@ class PyKotaTool(Tool):
 
     def sendMessage(self, adminmail, touser, fullmessage):
         """Sends an email message containing headers to some user."""
+        import smtplib
         try:
             server = smtplib.SMTP(self.smtpserver)
         except socket.error as msg:
@@ -519,6 +524,9 @@ class PyKotaTool(Tool):
         usermail = user.Email or user.Name
         if "@" not in usermail:
             usermail = f"{usermail}@{self.maildomain or self.smtpserver or 'localhost'}"
+        import email.utils
+        from email.mime import text
+        from email.header import Header
         msg = text.MIMEText(message, _charset=self.charset)
         msg["Subject"] = Header(subject, charset=self.charset)
         msg["From"] = adminmail
@@ -530,6 +538,8 @@ class PyKotaTool(Tool):
         """Sends an email message to the Print Quota administrator."""
         if "@" not in adminmail:
             adminmail = "%s@%s" % (adminmail, self.maildomain or self.smtpserver or "localhost")
+        from email.mime import text
+        from email.header import Header
         msg = text.MIMEText(message, _charset=self.charset)
         msg["Subject"] = Header(subject, charset=self.charset)
         msg["From"] = adminmail